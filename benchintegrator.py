@@ -0,0 +1,122 @@
+# Integrator accuracy and cost comparison
+#
+# Runs a long scripted drive with each of roverengine's integrators, at a few
+# step lengths and numbers of substeps, and compares where the rover ends up
+# (and how far it strays along the way) against the exact integrator. It also
+# times each one, and picks the cheapest that stays within a given tolerance:
+#
+#   python benchintegrator.py --duration 600 --tolerance 1.0
+#
+# Use --json to write the results somewhere a program can read them.
+
+import argparse
+import json
+import math
+import random
+import time
+
+from roverengine import Rover, servo_FL, servo_FR, servo_RL, servo_RR
+
+# Makes a drive of the given length: a random series of segments, each of
+# which sets the motors and the four steerable wheels and then runs for a
+# few seconds. The same seed always gives the same drive.
+def makeDrive(duration, seed):
+    rng = random.Random(seed)
+    segments = []
+    total = 0
+    while total < duration:
+        length = rng.uniform(1, 10)
+        kind = rng.choice(["straight", "steer", "steer", "spin", "mixed"])
+        speed = rng.choice([30, 60, 100])
+        if kind == "straight":
+            servos = [0, 0, 0, 0]
+            motors = [speed, speed]
+        elif kind == "steer":
+            angle = rng.choice([-30, -20, -10, 10, 20, 30])
+            servos = [angle, angle, -angle, -angle]
+            motors = [speed, speed]
+        elif kind == "spin":
+            servos = [0, 0, 0, 0]
+            motors = [speed, -speed] if rng.random() < 0.5 else [-speed, speed]
+        else:
+            servos = [rng.uniform(-30, 30) for i in range(4)]
+            motors = [rng.choice([30, 60, 100]), rng.choice([30, 60, 100])]
+        segments.append((length, motors, servos))
+        total += length
+    return segments
+
+def applySegment(rover, motors, servos):
+    [left, right] = motors
+    rover.setWheelMotorLeft(max(left, 0), max(-left, 0))
+    rover.setWheelMotorRight(max(right, 0), max(-right, 0))
+    for (servoId, angle) in zip((servo_FL, servo_FR, servo_RL, servo_RR), servos):
+        rover.setServo(servoId, angle)
+
+# Drives a rover through the segments, and returns its pose at the end of
+# each segment, plus how long that took.
+def runDrive(rover, segments):
+    poses = []
+    simTime = 0
+    rover.timeOfLastUpdate = 0
+    start = time.perf_counter()
+    for (length, motors, servos) in segments:
+        applySegment(rover, motors, servos)
+        simTime += length
+        rover.advanceTo(simTime)
+        poses.append((rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees))
+    return poses, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare accuracy and cost of roverengine integrators")
+    parser.add_argument("--duration", type=float, default=600, help="simulated seconds of driving")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=1.0, help="largest acceptable position error (cm)")
+    parser.add_argument("--json", help="file to write the results to")
+    args = parser.parse_args()
+
+    segments = makeDrive(args.duration, args.seed)
+    simulatedSeconds = sum(length for (length, motors, servos) in segments)
+    (reference, referenceTime) = runDrive(Rover(integrator="exact"), segments)
+
+    results = []
+    configurations = [("exact", 0.1, 1)]
+    for integrator in ("stepped", "euler", "rk4"):
+        for stepSeconds in (0.2, 0.1, 0.05):
+            for substeps in (1, 2, 4, 8):
+                configurations.append((integrator, stepSeconds, substeps))
+
+    print("%-8s %6s %8s %14s %14s %14s" % ("method", "step", "substeps", "max err (cm)", "end err (cm)", "us/sim second"))
+    for (integrator, stepSeconds, substeps) in configurations:
+        rover = Rover(integrator=integrator, substeps=substeps)
+        rover.stepSeconds = stepSeconds
+        (poses, elapsed) = runDrive(rover, segments)
+        errors = [math.hypot(x - rx, y - ry) for ((x, y, h), (rx, ry, rh)) in zip(poses, reference)]
+        result = {
+            'integrator': integrator,
+            'stepSeconds': stepSeconds,
+            'substeps': substeps,
+            'maxErrorCm': max(errors),
+            'endErrorCm': errors[-1],
+            'microsecondsPerSimulatedSecond': elapsed / simulatedSeconds * 1e6,
+        }
+        results.append(result)
+        print("%-8s %6.2f %8d %14.3g %14.3g %14.1f" % (integrator, stepSeconds, substeps,
+              result['maxErrorCm'], result['endErrorCm'], result['microsecondsPerSimulatedSecond']))
+
+    # The exact integrator is the reference, so it's always within tolerance.
+    # The interesting question is which of the stepping ones is cheapest.
+    stepping = [r for r in results if r['integrator'] != "exact" and r['maxErrorCm'] <= args.tolerance]
+    best = min(stepping, key=lambda r: r['microsecondsPerSimulatedSecond']) if stepping else None
+    if best:
+        print("Cheapest stepping integrator within %g cm: %s, step %gs, %d substeps" % (
+            args.tolerance, best['integrator'], best['stepSeconds'], best['substeps']))
+    else:
+        print("No stepping integrator stays within %g cm" % args.tolerance)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({ 'simulatedSeconds': simulatedSeconds, 'tolerance': args.tolerance,
+                        'results': results, 'cheapest': best }, f, indent=2)
+
+if __name__ == "__main__":
+    main()
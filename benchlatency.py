@@ -0,0 +1,103 @@
+# Command latency comparison
+#
+# Measures how long a round trip to the simulator takes for each way of
+# sending commands: JSON over HTTP, the binary socket protocol, and (for
+# reference) the in-process simulator. Start the simulator UI first:
+#
+#   python roversimui.py
+#   python benchlatency.py
+#
+# Or use --standalone to start headless HTTP and socket servers in this
+# process instead (this still needs Flask, but not Qt or a display).
+
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+
+import roversimulator
+import roverprotocol
+import roverengine
+
+# Starts an HTTP server and a socket server which both apply messages to the
+# same simulated rover, the same way the UI does, but without any UI.
+def startStandaloneServers(httpPort, socketAddress):
+    from flask import Flask, request
+
+    rover = roverengine.Rover()
+    lock = threading.Lock()
+
+    def handleCommand(command, roverId=None):
+        with lock:
+            rover.updateState()
+            rover.applyCommand(command)
+            return rover.snapshot()
+
+    # Werkzeug logs every request, which would swamp the results
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    httpServer = Flask("RoverSimBench")
+    def result():
+        response = handleCommand(roverengine.RoverCommand.fromMessage(request.json))
+        return json.dumps(response), 200, { 'Content-Type': 'application/json' }
+    httpServer.route('/', methods=['POST'])(result)
+    threading.Thread(target=lambda: httpServer.run(port=httpPort), daemon=True).start()
+
+    socketServer = roverprotocol.createServer(socketAddress, handleCommand)
+    threading.Thread(target=socketServer.serve_forever, daemon=True).start()
+    time.sleep(1)
+
+def measure(transport, count):
+    messages = [
+        { 'servos': { roverengine.servo_FL: 10 } },
+        { 'wheelMotors': { 'l': [50, 0], 'r': [50, 0] } },
+        { 'servos': { roverengine.servo_FL: 0 } },
+        { 'wheelMotors': { 'l': [0, 0], 'r': [0, 0] } },
+    ]
+    # Get any connection setup out of the way first
+    transport.send(messages[0])
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        transport.send(messages[i % len(messages)])
+        timings.append(time.perf_counter() - start)
+    return summarise(timings)
+
+# Returns the mean, median and 99th percentile of a list of timings.
+def summarise(timings):
+    timings = sorted(timings)
+    return {
+        'mean': statistics.mean(timings),
+        'median': statistics.median(timings),
+        'p99': timings[int(len(timings) * 0.99)],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare command round trip latency")
+    parser.add_argument("--count", type=int, default=2000, help="round trips per transport")
+    parser.add_argument("--url", default=roversimulator.simulatorUiUrl)
+    parser.add_argument("--socket", default=roverprotocol.defaultAddress)
+    parser.add_argument("--standalone", action="store_true",
+                        help="run headless servers in this process instead of using the UI")
+    args = parser.parse_args()
+
+    if args.standalone:
+        port = int(args.url.rstrip("/").rsplit(":", 1)[1])
+        startStandaloneServers(port, args.socket)
+
+    transports = [
+        ("http", roversimulator.HttpTransport(args.url)),
+        ("socket", roversimulator.SocketTransport(args.socket)),
+        ("inprocess", roversimulator.InProcessTransport(roversimulator.clock)),
+    ]
+    results = {}
+    print("%-10s %12s %12s %12s" % ("transport", "mean (us)", "median (us)", "p99 (us)"))
+    for (name, transport) in transports:
+        results[name] = measure(transport, args.count)
+        r = results[name]
+        print("%-10s %12.1f %12.1f %12.1f" % (name, r['mean'] * 1e6, r['median'] * 1e6, r['p99'] * 1e6))
+    print("socket is %.1fx faster than http (median)" % (results['http']['median'] / results['socket']['median']))
+
+if __name__ == "__main__":
+    main()
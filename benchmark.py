@@ -0,0 +1,234 @@
+# Benchmark suite
+#
+# Measures three separate things, so that a change to the transport or the
+# engine shows up where it belongs:
+#
+#   latency     how long each roversimulator call takes to get to the
+#               simulator and back, for each backend
+#   engine      how many Rover.updateState steps per second the engine
+#               manages, for straight, steered and spinning motion, with
+#               each integrator
+#   scenarios   how long example programs such as square.py take to run from
+#               start to finish (as fast as possible, in process, by default)
+#
+# The latency measurements need the simulator UI to be running, unless you
+# use --standalone to start headless servers in this process (see
+# benchlatency.py). E.g.:
+#
+#   python benchmark.py --standalone --json results.json
+#   python benchmark.py --only engine --baseline results.json
+#
+# --json writes all of the results to a file, and --baseline compares this
+# run with one written earlier, so regressions stand out.
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import benchlatency
+import roverengine
+import roverprotocol
+import roversimulator
+import simclock
+from roverengine import Rover, servo_FL, servo_FR, servo_RL, servo_RR
+
+sections = ("latency", "engine", "scenarios")
+
+#======================================================================
+# Latency
+
+# The roversimulator calls to time. Each one is called repeatedly, so none of
+# them changes direction (which would add a brake and a pause) except on
+# the first call, which isn't timed.
+latencyCalls = [
+    ("forward", lambda: roversimulator.forward(50)),
+    ("turnForward", lambda: roversimulator.turnForward(40, 60)),
+    ("spinLeft", lambda: roversimulator.spinLeft(50)),
+    ("stop", lambda: roversimulator.stop()),
+    ("setServo", lambda: roversimulator.setServo(servo_FL, 10)),
+]
+
+def useBackend(backend, args):
+    if backend == "http":
+        roversimulator.useHttpSimulator(args.url)
+    elif backend == "socket":
+        roversimulator.useSocketSimulator(args.socket)
+    else:
+        roversimulator.useInProcessSimulator()
+
+def benchmarkLatency(args):
+    results = {}
+    print("%-10s %-12s %12s %12s %12s" % ("backend", "call", "mean (us)", "median (us)", "p99 (us)"))
+    for backend in args.backends:
+        useBackend(backend, args)
+        results[backend] = {}
+        for (name, call) in latencyCalls:
+            call()
+            timings = []
+            for i in range(args.count):
+                start = time.perf_counter()
+                call()
+                timings.append(time.perf_counter() - start)
+            r = benchlatency.summarise(timings)
+            results[backend][name] = r
+            print("%-10s %-12s %12.1f %12.1f %12.1f" % (backend, name, r['mean'] * 1e6, r['median'] * 1e6, r['p99'] * 1e6))
+        roversimulator.stop()
+    return results
+
+# End of Latency
+#======================================================================
+
+#======================================================================
+# Engine
+
+# Motor speeds and servo angles (FL, FR, RL, RR) for each kind of motion.
+motions = {
+    'straight': ([100, 100], [0, 0, 0, 0]),
+    'steered': ([100, 100], [-20, -20, 20, 20]),
+    'spin': ([100, -100], [0, 0, 0, 0]),
+}
+
+# Runs updateState over and over on a clock running as fast as possible, so
+# each update is exactly one step, and returns how many steps it managed per
+# second of real time.
+def measureSteps(integrator, motors, servos, seconds):
+    clock = simclock.SimClock(simclock.asFastAsPossible)
+    rover = Rover(clock, integrator)
+    [left, right] = motors
+    rover.setWheelMotorLeft(max(left, 0), max(-left, 0))
+    rover.setWheelMotorRight(max(right, 0), max(-right, 0))
+    for (servoId, angle) in zip((servo_FL, servo_FR, servo_RL, servo_RR), servos):
+        rover.setServo(servoId, angle)
+
+    steps = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        # Check the time every so often, rather than after every step, so
+        # that the check doesn't dominate what's being measured.
+        for i in range(1000):
+            clock.sleep(rover.stepSeconds)
+            rover.updateState()
+        steps += 1000
+    return steps / (time.perf_counter() - start)
+
+def benchmarkEngine(args):
+    results = {}
+    print("%-10s %-10s %14s" % ("integrator", "motion", "steps/second"))
+    for integrator in roverengine.integrators:
+        results[integrator] = {}
+        for (motion, (motors, servos)) in motions.items():
+            stepsPerSecond = measureSteps(integrator, motors, servos, args.engine_seconds)
+            results[integrator][motion] = { 'stepsPerSecond': stepsPerSecond }
+            print("%-10s %-10s %14.0f" % (integrator, motion, stepsPerSecond))
+    return results
+
+# End of Engine
+#======================================================================
+
+#======================================================================
+# Scenarios
+
+# Runs a program in a separate process, with the simulator picked by the
+# environment variables that roversimulator reads, and returns how long it
+# took.
+def runScenario(script, backend, timeWarp):
+    env = dict(os.environ)
+    env['ROVERSIM_BACKEND'] = backend
+    env['ROVERSIM_TIMEWARP'] = timeWarp
+    start = time.perf_counter()
+    subprocess.run([sys.executable, script], env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def benchmarkScenarios(args):
+    results = {}
+    print("%-26s %14s %14s" % ("scenario", "best (s)", "median (s)"))
+    for script in args.scenarios:
+        timings = sorted(runScenario(script, args.scenario_backend, args.scenario_timewarp) for i in range(args.repeat))
+        r = { 'best': timings[0], 'median': timings[len(timings) // 2], 'runs': args.repeat,
+              'backend': args.scenario_backend, 'timeWarp': args.scenario_timewarp }
+        results[os.path.basename(script)] = r
+        print("%-26s %14.3f %14.3f" % (os.path.basename(script), r['best'], r['median']))
+    return results
+
+# End of Scenarios
+#======================================================================
+
+# Finds the numbers in a set of results, with a name for each made from the
+# keys leading to it, e.g. "engine.exact.spin.stepsPerSecond".
+def flatten(results, prefix=""):
+    values = {}
+    for (key, value) in results.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            values.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+# Prints how each measurement has changed since the baseline. For steps per
+# second bigger is better; for everything else (all times) smaller is.
+def compareWithBaseline(results, baseline):
+    current = flatten({ s: results[s] for s in sections if s in results })
+    previous = flatten({ s: baseline[s] for s in sections if s in baseline })
+    print("%-50s %14s %14s %8s" % ("measurement", "baseline", "now", "change"))
+    for name in sorted(current):
+        if name not in previous or name.endswith(".runs") or previous[name] == 0:
+            continue
+        change = current[name] / previous[name] - 1
+        worse = change < 0 if name.endswith("stepsPerSecond") else change > 0
+        print("%-50s %14.6g %14.6g %+7.1f%%%s" % (name, previous[name], current[name], change * 100,
+              " worse" if worse and abs(change) > 0.1 else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark command latency, engine throughput and scenarios")
+    parser.add_argument("--only", action="append", choices=sections,
+                        help="run only this section (can be given more than once)")
+    parser.add_argument("--count", type=int, default=1000, help="round trips per call and backend")
+    parser.add_argument("--backends", nargs="+", default=["http", "socket", "inprocess"],
+                        choices=["http", "socket", "inprocess"])
+    parser.add_argument("--url", default=roversimulator.simulatorUiUrl)
+    parser.add_argument("--socket", default=roverprotocol.defaultAddress)
+    parser.add_argument("--standalone", action="store_true",
+                        help="run headless servers in this process instead of using the UI")
+    parser.add_argument("--engine-seconds", type=float, default=0.5,
+                        help="how long to run each engine measurement for")
+    parser.add_argument("--scenarios", nargs="+", default=["square.py", "very-simple-example.py"])
+    parser.add_argument("--scenario-backend", default="inprocess", choices=["http", "socket", "inprocess"])
+    parser.add_argument("--scenario-timewarp", default="max")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each scenario")
+    parser.add_argument("--json", help="file to write the results to")
+    parser.add_argument("--baseline", help="results written by an earlier --json to compare against")
+    args = parser.parse_args()
+
+    if args.standalone and "latency" in (args.only or sections):
+        port = int(args.url.rstrip("/").rsplit(":", 1)[1])
+        benchlatency.startStandaloneServers(port, args.socket)
+
+    results = {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+    for (section, run) in (("latency", benchmarkLatency), ("engine", benchmarkEngine), ("scenarios", benchmarkScenarios)):
+        if args.only and section not in args.only:
+            continue
+        print()
+        print("== " + section)
+        results[section] = run(args)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        compareWithBaseline(results, baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# Command logs
+#
+# Captures every command sent to a rover, with the simulated time at which
+# it arrived, into a compact binary file, and replays it later through
+# roverengine as fast as possible. Replaying a log captured by the simulator
+# UI (or the in-process simulator) ends up with the rover exactly where it
+# was when the log was captured, so a session of driveRover.py can be kept
+# and used to check that a change to the engine hasn't changed how the rover
+# drives, in milliseconds and without anyone at the keyboard:
+#
+#   python roversimui.py --capture session.cmdlog
+#   python driveRover.py
+#   python commandlog.py session.cmdlog --check
+#
+# --check makes this fail unless the replay ends up where the rover did when
+# the log was captured. Programs using roversimulator can also capture what
+# they send, by setting ROVERSIM_CAPTURE or calling captureCommands().
+#
+# Replaying gives exactly the same results because the log records not just
+# the commands but every time the rover was updated (the UI updates it
+# several times a second, as well as whenever a command arrives), and the
+# replay repeats exactly the same updates. The file is:
+#
+#   header      "ROVERCMD", uint16 version, uint32 length of the settings
+#   settings    JSON: the rover's integrator, step settings, starting state
+#               and world (see roverworld.py), if it has one
+#   entries     each starting with uint8 type and float64 simulated time:
+#     ENTRY_ADVANCE             the rover was updated to the time given
+#     ENTRY_COMMAND             the rover was updated to the time given, and
+#                               then a command, which follows as a COMMAND
+#                               frame as in roverprotocol.py, was applied
+#     ENTRY_COMMAND_NO_ADVANCE  as ENTRY_COMMAND, but without an update first
+#     ENTRY_END                 the rover's final x, y and heading (float64s)
+#
+# All values are little-endian.
+
+import argparse
+import json
+import struct
+import time
+
+import roverprotocol
+import roverworld
+import simclock
+from roverengine import Rover
+
+magic = b"ROVERCMD"
+version = 1
+headerFormat = struct.Struct("<8sHI")
+entryHeader = struct.Struct("<Bd")
+poseFormat = struct.Struct("<ddd")
+
+ENTRY_ADVANCE = 1
+ENTRY_COMMAND = 2
+ENTRY_COMMAND_NO_ADVANCE = 3
+ENTRY_END = 4
+
+# Raised when a file isn't a command log this module can read.
+class CommandLogError(Exception):
+    pass
+
+# Returns everything about a rover that a replay needs to start from the
+# same place.
+def roverSettings(rover):
+    return {
+        'integrator': rover.integrator,
+        'stepSeconds': rover.stepSeconds,
+        'substeps': rover.substeps,
+        'fixedStep': rover.fixedStep,
+        'startTime': rover.timeOfLastUpdate,
+        'pose': [rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees],
+        'speeds': [rover.speedL, rover.speedR],
+        'servos': list(rover.servos),
+        'wheelDistances': [rover.wheelDistanceLcm, rover.wheelDistanceRcm],
+        'encoderTargets': [rover.encoderTargetLeft, rover.encoderTargetRight],
+        'world': rover.world.toData() if rover.world is not None else None,
+    }
+
+# Writes a command log. Set it as a Rover's commandLog to capture everything
+# that happens to that rover. Or, when the rover is somewhere else (e.g. in
+# the simulator UI), call advanced() and applied() as each command is sent;
+# in that case the replay will only be as close as the updates are to the
+# ones the real simulator did.
+class CommandLogWriter:
+    def __init__(self, path, rover=None):
+        self.rover = rover
+        self.file = open(path, "wb")
+        settings = json.dumps(roverSettings(rover) if rover is not None else {}).encode("utf-8")
+        self.file.write(headerFormat.pack(magic, version, len(settings)))
+        self.file.write(settings)
+        # advanced() doesn't write anything straight away, in case a command
+        # follows, in which case they're written together.
+        self.pendingAdvance = None
+        self.lastAdvance = rover.timeOfLastUpdate if rover is not None else 0.0
+        self.commandCount = 0
+
+    def advanced(self, simTime):
+        if self.pendingAdvance is not None:
+            self.file.write(entryHeader.pack(ENTRY_ADVANCE, self.pendingAdvance))
+        self.pendingAdvance = simTime
+        self.lastAdvance = simTime
+
+    def applied(self, command):
+        message = command.toMessage()
+        if not message:
+            # Nothing to apply (just a query for the sensors).
+            return
+        # Encoded before anything is written, so that if it can't be, the
+        # log isn't left with an entry that has no command.
+        frame = roverprotocol.encodeCommand(message)
+        if self.pendingAdvance is not None:
+            self.file.write(entryHeader.pack(ENTRY_COMMAND, self.pendingAdvance) + frame)
+            self.pendingAdvance = None
+        else:
+            self.file.write(entryHeader.pack(ENTRY_COMMAND_NO_ADVANCE, self.lastAdvance) + frame)
+        self.commandCount += 1
+
+    def flush(self):
+        self.file.flush()
+
+    # Finishes the log, recording where the rover got to (if this is
+    # capturing a rover).
+    def close(self):
+        if self.pendingAdvance is not None:
+            self.file.write(entryHeader.pack(ENTRY_ADVANCE, self.pendingAdvance))
+            self.pendingAdvance = None
+        if self.rover is not None:
+            self.file.write(entryHeader.pack(ENTRY_END, self.rover.timeOfLastUpdate))
+            self.file.write(poseFormat.pack(self.rover.vehicleXcm, self.rover.vehicleYcm, self.rover.vehicleHeadingDegrees))
+        self.file.close()
+
+# Reads a command log, returning its settings and a list of entries, each
+# (entry type, simulated time, command or final pose or None).
+def read(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < headerFormat.size:
+        raise CommandLogError(path + " is not a command log")
+    (fileMagic, fileVersion, settingsLength) = headerFormat.unpack_from(data, 0)
+    if fileMagic != magic:
+        raise CommandLogError(path + " is not a command log")
+    if fileVersion != version:
+        raise CommandLogError(path + " is a command log in an unsupported format (version " + str(fileVersion) + ")")
+    offset = headerFormat.size
+    settings = json.loads(data[offset:offset + settingsLength].decode("utf-8"))
+    offset += settingsLength
+
+    entries = []
+    try:
+        while offset < len(data):
+            (entryType, simTime) = entryHeader.unpack_from(data, offset)
+            offset += entryHeader.size
+            if entryType == ENTRY_ADVANCE:
+                entries.append((entryType, simTime, None))
+            elif entryType in (ENTRY_COMMAND, ENTRY_COMMAND_NO_ADVANCE):
+                (frameType, length) = roverprotocol.frameHeader.unpack_from(data, offset)
+                offset += roverprotocol.frameHeader.size
+                if frameType != roverprotocol.FRAME_COMMAND:
+                    raise CommandLogError(path + " has a bad command at offset " + str(offset))
+                if offset + length > len(data):
+                    break
+                entries.append((entryType, simTime, roverprotocol.decodeCommand(data[offset:offset + length])))
+                offset += length
+            elif entryType == ENTRY_END:
+                entries.append((entryType, simTime, list(poseFormat.unpack_from(data, offset))))
+                offset += poseFormat.size
+            else:
+                raise CommandLogError(path + " has an unknown entry type " + str(entryType))
+    except struct.error:
+        # The log was cut short, e.g. because the program capturing it was
+        # killed. Everything up to there is still good.
+        pass
+    return (settings, entries)
+
+# Creates a rover set up the way the one in the log was at the start.
+def createRover(settings, integrator=None):
+    rover = Rover(simclock.SimClock(simclock.asFastAsPossible), integrator or settings.get('integrator'), settings.get('substeps'))
+    rover.stepSeconds = settings.get('stepSeconds', rover.stepSeconds)
+    rover.fixedStep = settings.get('fixedStep', rover.fixedStep)
+    rover.timeOfLastUpdate = settings.get('startTime', 0.0)
+    [rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees] = settings.get('pose', [0, 0, 0])
+    [rover.speedL, rover.speedR] = settings.get('speeds', [0, 0])
+    rover.servos = list(settings.get('servos', rover.servos))
+    [rover.wheelDistanceLcm, rover.wheelDistanceRcm] = settings.get('wheelDistances', [0.0, 0.0])
+    [rover.encoderTargetLeft, rover.encoderTargetRight] = settings.get('encoderTargets', [None, None])
+    if settings.get('world') is not None:
+        rover.world = roverworld.World.fromData(settings['world'])
+    return rover
+
+# Repeats everything in a command log on a new rover, and returns the rover
+# and the final pose recorded in the log (None if there isn't one). If
+# endTime is given, the rover is then advanced to that time, e.g. to find
+# out where a rover would be after a captured program had finished.
+def replay(path, integrator=None, endTime=None):
+    (settings, entries) = read(path)
+    rover = createRover(settings, integrator)
+    expectedPose = None
+    for (entryType, simTime, detail) in entries:
+        if entryType == ENTRY_ADVANCE:
+            rover.advanceTo(simTime)
+        elif entryType == ENTRY_COMMAND:
+            rover.advanceTo(simTime)
+            rover.applyCommand(detail)
+        elif entryType == ENTRY_COMMAND_NO_ADVANCE:
+            rover.applyCommand(detail)
+        elif entryType == ENTRY_END:
+            expectedPose = detail
+    if endTime is not None:
+        rover.advanceTo(endTime)
+    return (rover, expectedPose)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a command log as fast as possible")
+    parser.add_argument("path")
+    parser.add_argument("--integrator", help="replay with this integrator instead of the one in the log")
+    parser.add_argument("--until", type=float, metavar="SECONDS",
+                        help="carry on until this simulated time after the log ends")
+    parser.add_argument("--check", action="store_true",
+                        help="fail unless the replay ends where the rover did when the log was captured")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="how far (cm or degrees) the replay may be from the captured pose for --check")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    (rover, expectedPose) = replay(args.path, args.integrator, args.until)
+    elapsed = time.perf_counter() - start
+
+    pose = [rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees]
+    print("Replayed to %.3f s in %.1f ms" % (rover.timeOfLastUpdate, elapsed * 1000))
+    print("Final pose:    x=%r y=%r heading=%r" % tuple(pose))
+    if expectedPose is not None:
+        print("Captured pose: x=%r y=%r heading=%r" % tuple(expectedPose))
+    if args.check:
+        if expectedPose is None:
+            print("The log has no captured pose to check against")
+            return 2
+        difference = max(abs(a - b) for (a, b) in zip(pose, expectedPose))
+        if not difference <= args.tolerance:
+            print("MISMATCH: differs by up to %g" % difference)
+            return 1
+        print("OK")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -5,11 +5,15 @@
 
 from __future__ import print_function
 import time
+import contextlib
 
 # choose between real rover and simulator
 import roversimulator as rover
 #import rover
 
+# The simulator can send several commands as one message, so the wheels all
+# change at once. The real rover doesn't need (or have) this.
+batch = getattr(rover, 'batch', contextlib.nullcontext)
 
 # Servo numbers
 servo_FL = 9
@@ -73,30 +77,34 @@ def readkey(getchar_fn=None):
 #======================================================================
 
 def goForward():
-    rover.setServo(servo_FL, 0)
-    rover.setServo(servo_FR, 0)
-    rover.setServo(servo_RL, 0)
-    rover.setServo(servo_RR, 0)
-    rover.forward(speed)
+    with batch():
+        rover.setServo(servo_FL, 0)
+        rover.setServo(servo_FR, 0)
+        rover.setServo(servo_RL, 0)
+        rover.setServo(servo_RR, 0)
+        rover.forward(speed)
 
 def goReverse():
-    rover.setServo(servo_FL, 0)
-    rover.setServo(servo_FR, 0)
-    rover.setServo(servo_RL, 0)
-    rover.setServo(servo_RR, 0)
-    rover.reverse(speed)
+    with batch():
+        rover.setServo(servo_FL, 0)
+        rover.setServo(servo_FR, 0)
+        rover.setServo(servo_RL, 0)
+        rover.setServo(servo_RR, 0)
+        rover.reverse(speed)
 
 def goLeft():
-    rover.setServo(servo_FL, -20)
-    rover.setServo(servo_FR, -20)
-    rover.setServo(servo_RL, 20)
-    rover.setServo(servo_RR, 20)
+    with batch():
+        rover.setServo(servo_FL, -20)
+        rover.setServo(servo_FR, -20)
+        rover.setServo(servo_RL, 20)
+        rover.setServo(servo_RR, 20)
 
 def goRight():
-    rover.setServo(servo_FL, 20)
-    rover.setServo(servo_FR, 20)
-    rover.setServo(servo_RL, -20)
-    rover.setServo(servo_RR, -20)
+    with batch():
+        rover.setServo(servo_FL, 20)
+        rover.setServo(servo_FR, 20)
+        rover.setServo(servo_RL, -20)
+        rover.setServo(servo_RR, -20)
 
 
 
@@ -139,11 +147,12 @@ try:
             rover.stop()
             print ('Stop')
         elif keyp == 'b':
-            rover.brake()
-            rover.setServo(servo_FL, 0)
-            rover.setServo(servo_FR, 0)
-            rover.setServo(servo_RL, 0)
-            rover.setServo(servo_RR, 0)
+            with batch():
+                rover.brake()
+                rover.setServo(servo_FL, 0)
+                rover.setServo(servo_FR, 0)
+                rover.setServo(servo_RL, 0)
+                rover.setServo(servo_RR, 0)
             print ('Brake')
         elif ord(keyp) == 3:
             break
@@ -0,0 +1,871 @@
+# 4tronix M.A.R.S. Rover Simulation Engine
+#
+# This is the kinematic model of the rover, with no dependency on Qt, Flask or
+# anything else that needs a display or a network. The simulator UI
+# (roversimui.py) is just one consumer of this: it feeds incoming messages into
+# a Rover and draws wherever the Rover says it is. But the model can equally
+# be stepped directly, e.g.:
+#
+#   import roverengine
+#   rover = roverengine.Rover()
+#   rover.setWheelMotorLeft(100, 0)
+#   rover.setWheelMotorRight(100, 0)
+#   for i in range(1000):
+#       rover.step(0.1)
+#   print(rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees)
+#
+# Nothing in here looks at the clock unless you call updateState(). step(dt)
+# advances the simulation by exactly dt seconds, however long that actually
+# takes to compute, so it can run many thousands of steps per second.
+#
+# updateState() uses a simclock.SimClock to work out how much time has
+# passed. By default that's real time, but pass in a clock with a time warp to
+# run faster than real time (or as fast as possible).
+
+import math
+
+import simclock
+
+# Servo assignments
+servo_FL = 9
+servo_FR = 15
+servo_RL = 11
+servo_RR = 13
+servo_MA = 0
+
+numServos = 16
+numRgbLeds = 4
+
+fullSpeedCmPerSecond = 9
+
+# Full speed spin in place = 36 degrees per second
+fullSpinSpeedDegreesPerSecond = 36.0
+
+showSteeringCalcs = False
+
+# The ways a Rover can work out its motion (see Rover.integrator):
+#   stepped     move each steerable wheel around its own turning circle for
+#               the length of the step, and average where they end up. This
+#               is the original model. The answer depends a little on how
+#               long the steps are.
+#   euler       work out the rover's speed and rate of turn (see
+#               motionRates) and move in a straight line at that speed and
+#               heading for the length of the step, then turn.
+#   rk4         the classic fourth-order Runge-Kutta method applied to the
+#               same speed and rate of turn. Far more accurate than euler or
+#               stepped for the same step length when steering.
+#   exact       work out the motion those steps tend towards as they get
+#               shorter (a straight line, a circular arc, or a spin on the
+#               spot), and jump straight to the answer. The answer doesn't
+#               depend on the steps at all.
+# benchintegrator.py compares the accuracy and cost of each.
+integrators = ("stepped", "euler", "rk4", "exact")
+
+# sin(x)/x, without the trouble when x is (nearly) 0.
+def sinc(x):
+    if abs(x) < 1e-4:
+        return 1.0 - x * x / 6.0
+    return math.sin(x) / x
+
+# Raised when a message can't be turned into a RoverCommand.
+class InvalidCommand(ValueError):
+    pass
+
+def checkNumber(value, description):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise InvalidCommand(description + " must be a number, not " + repr(value))
+    return value
+
+# LED colours are sent as bytes, so each must be a whole number from 0 to
+# 255 (a float is fine if it's whole, e.g. 255.0).
+def checkColour(value):
+    checkNumber(value, "LED colour")
+    if value != int(value) or not 0 <= value <= 255:
+        raise InvalidCommand("LED colour must be a whole number from 0 to 255, not " + repr(value))
+    return int(value)
+
+def checkIndex(key, count, description):
+    try:
+        index = int(key)
+    except (TypeError, ValueError):
+        raise InvalidCommand(description + " must be a number, not " + repr(key))
+    if index < 0 or index >= count:
+        raise InvalidCommand(description + " " + str(index) + " is out of range")
+    return index
+
+# A single message for the rover, already checked and in a form that can be
+# applied directly to a Rover. Use fromMessage() to create one from a message
+# in the format described at the top of roversimui.py.
+class RoverCommand:
+    def __init__(self):
+        # [fwd, rev], or None to leave unchanged
+        self.wheelMotorLeft = None
+        self.wheelMotorRight = None
+        # (servoId, degrees) pairs
+        self.servos = []
+        # (ledId, [red, green, blue]) pairs
+        self.rgbLeds = []
+        # How many more encoder counts each motor should run for before
+        # stopping, or None to leave unchanged
+        self.encoderTargetLeft = None
+        self.encoderTargetRight = None
+
+    @classmethod
+    def fromMessage(cls, data):
+        if not isinstance(data, dict):
+            raise InvalidCommand("Message must be an object")
+        command = cls()
+        for key in data:
+            if key == 'wheelMotors':
+                wheelMotors = data['wheelMotors']
+                if not isinstance(wheelMotors, dict):
+                    raise InvalidCommand("wheelMotors must be an object")
+                for side in wheelMotors:
+                    if side not in ('l', 'r'):
+                        raise InvalidCommand("Unknown wheel motor '" + str(side) + "'")
+                    speeds = wheelMotors[side]
+                    if not isinstance(speeds, (list, tuple)) or len(speeds) != 2:
+                        raise InvalidCommand("Wheel motor settings must be [fwd, rev]")
+                    speeds = [checkNumber(speed, "Wheel motor speed") for speed in speeds]
+                    if side == 'l':
+                        command.wheelMotorLeft = speeds
+                    else:
+                        command.wheelMotorRight = speeds
+            elif key == 'servos':
+                servos = data['servos']
+                if not isinstance(servos, dict):
+                    raise InvalidCommand("servos must be an object")
+                for servo in servos:
+                    servoId = checkIndex(servo, numServos, "Servo")
+                    command.servos.append((servoId, checkNumber(servos[servo], "Servo position")))
+            elif key == 'rgbLeds':
+                rgbLeds = data['rgbLeds']
+                if not isinstance(rgbLeds, dict):
+                    raise InvalidCommand("rgbLeds must be an object")
+                for led in rgbLeds:
+                    ledId = checkIndex(led, numRgbLeds, "LED")
+                    rgbValues = rgbLeds[led]
+                    if not isinstance(rgbValues, (list, tuple)) or len(rgbValues) != 3:
+                        raise InvalidCommand("LED colours must be [red, green, blue]")
+                    command.rgbLeds.append((ledId, [checkColour(value) for value in rgbValues]))
+            elif key == 'encoderTargets':
+                encoderTargets = data['encoderTargets']
+                if not isinstance(encoderTargets, dict):
+                    raise InvalidCommand("encoderTargets must be an object")
+                for side in encoderTargets:
+                    if side not in ('l', 'r'):
+                        raise InvalidCommand("Unknown wheel motor '" + str(side) + "'")
+                    counts = checkNumber(encoderTargets[side], "Encoder target")
+                    if side == 'l':
+                        command.encoderTargetLeft = counts
+                    else:
+                        command.encoderTargetRight = counts
+            else:
+                raise InvalidCommand("Unknown message property '" + str(key) + "'")
+        return command
+
+    # Turns this back into a message dictionary.
+    def toMessage(self):
+        message = {}
+        wheelMotors = {}
+        if self.wheelMotorLeft is not None:
+            wheelMotors['l'] = self.wheelMotorLeft
+        if self.wheelMotorRight is not None:
+            wheelMotors['r'] = self.wheelMotorRight
+        if wheelMotors:
+            message['wheelMotors'] = wheelMotors
+        if self.servos:
+            message['servos'] = { servoId: degrees for (servoId, degrees) in self.servos }
+        if self.rgbLeds:
+            message['rgbLeds'] = { ledId: rgbValues for (ledId, rgbValues) in self.rgbLeds }
+        encoderTargets = {}
+        if self.encoderTargetLeft is not None:
+            encoderTargets['l'] = self.encoderTargetLeft
+        if self.encoderTargetRight is not None:
+            encoderTargets['r'] = self.encoderTargetRight
+        if encoderTargets:
+            message['encoderTargets'] = encoderTargets
+        return message
+
+    def __str__(self):
+        return str(self.toMessage())
+
+# Something to wait for a rover to do, e.g. for its motors to reach the
+# encoder targets they were given. Use fromMessage() to create one from a
+# message such as:
+#
+#   { "distanceCm": 100, "rangeBelowCm": 20, "timeout": 30 }
+#
+# which waits until the rover has travelled another 100cm, or the ultrasonic
+# sensor sees something closer than 20cm, whichever happens first, but gives
+# up after 30 simulated seconds. The things that can be waited for are:
+#
+#   encoderTargets          neither motor has an encoder target it hasn't
+#                           yet reached (if true)
+#   distanceCm              the rover has travelled this much further
+#                           (along whatever path it takes)
+#   headingChangeDegrees    the rover's heading has changed by this much,
+#                           either way
+#   rangeBelowCm            the ultrasonic sensor can see something closer
+#                           than this
+#
+# The simulator works out when the wait is over, so the program waiting
+# doesn't have to keep asking.
+class WaitCondition:
+    def __init__(self):
+        self.encoderTargets = False
+        self.distanceCm = None
+        self.headingChangeDegrees = None
+        self.rangeBelowCm = None
+        self.timeout = None
+        # Set by start()
+        self.startTime = None
+        self.startDistanceCm = None
+        self.startHeadingDegrees = None
+
+    @classmethod
+    def fromMessage(cls, data):
+        if not isinstance(data, dict):
+            raise InvalidCommand("Wait must be an object")
+        condition = cls()
+        for key in data:
+            if key == 'encoderTargets':
+                if not isinstance(data[key], bool):
+                    raise InvalidCommand("encoderTargets must be true or false")
+                condition.encoderTargets = data[key]
+            elif key in ('distanceCm', 'headingChangeDegrees', 'rangeBelowCm', 'timeout'):
+                if data[key] is not None:
+                    setattr(condition, key, checkNumber(data[key], "Wait " + key))
+            else:
+                raise InvalidCommand("Unknown wait property '" + str(key) + "'")
+        return condition
+
+    def toMessage(self):
+        message = {}
+        if self.encoderTargets:
+            message['encoderTargets'] = True
+        for key in ('distanceCm', 'headingChangeDegrees', 'rangeBelowCm', 'timeout'):
+            if getattr(self, key) is not None:
+                message[key] = getattr(self, key)
+        return message
+
+    def __str__(self):
+        return "wait " + str(self.toMessage())
+
+    # Called when the wait begins, with the rover brought up to date.
+    def start(self, rover):
+        self.startTime = rover.timeOfLastUpdate
+        self.startDistanceCm = rover.distanceTravelledCm
+        self.startHeadingDegrees = rover.vehicleHeadingDegrees
+
+    # Returns whether any of the things being waited for has happened (or
+    # True if there's nothing to wait for).
+    def met(self, rover):
+        checks = []
+        if self.encoderTargets:
+            checks.append(rover.encoderTargetLeft is None and rover.encoderTargetRight is None)
+        # These allow for rounding errors, so that when something advancing
+        # the rover stops exactly where the wait is over (see
+        # secondsUntilCheck), it is.
+        if self.distanceCm is not None:
+            checks.append(rover.distanceTravelledCm - self.startDistanceCm >= self.distanceCm - 1e-9)
+        if self.headingChangeDegrees is not None:
+            checks.append(abs(rover.vehicleHeadingDegrees - self.startHeadingDegrees) >= self.headingChangeDegrees - 1e-9)
+        if self.rangeBelowCm is not None:
+            checks.append(0 < rover.ultrasonicRange() < self.rangeBelowCm)
+        return any(checks) if checks else True
+
+    def timedOut(self, rover):
+        return self.timeout is not None and rover.timeOfLastUpdate - self.startTime >= self.timeout
+
+    def finished(self, rover):
+        return self.met(rover) or self.timedOut(rover)
+
+    # How long (in simulated seconds) the rover can be left to run before
+    # this might be finished, for something that's advancing the rover
+    # itself while it waits. The distance and heading change are worked out
+    # from how fast the rover is going, so a rover running as fast as
+    # possible ends up (very nearly) exactly where the wait is over. The
+    # range can only be found by looking, so that's checked every step.
+    def secondsUntilCheck(self, rover):
+        seconds = rover.stepSeconds
+        if self.encoderTargets:
+            seconds = rover.untilEncoderTarget(seconds)
+        [forwardSpeed, headingRate] = rover.motionRates()
+        if self.distanceCm is not None and forwardSpeed != 0:
+            distanceLeftCm = self.startDistanceCm + self.distanceCm - rover.distanceTravelledCm
+            seconds = min(seconds, distanceLeftCm / abs(forwardSpeed))
+        if self.headingChangeDegrees is not None and headingRate != 0:
+            degreesLeft = self.headingChangeDegrees - abs(rover.vehicleHeadingDegrees - self.startHeadingDegrees)
+            seconds = min(seconds, degreesLeft / abs(headingRate))
+        if self.timeout is not None:
+            seconds = min(seconds, self.startTime + self.timeout - rover.timeOfLastUpdate)
+        return max(seconds, 0)
+
+class Rover:
+    vehicleWidthCm = 16
+    vehicleHeightCm = 18
+    distanceBetweenWheelPairsCm = 8
+    fullSpeedCmPerSecond = fullSpeedCmPerSecond
+
+    # The length of the steps advanceTo() takes. This matches the rate at
+    # which the UI has always updated, so a long gap between updates gives the
+    # same results as if the UI had been updating all along.
+    stepSeconds = 0.1
+
+    # Each step is worked out in this many equal parts. More substeps are
+    # more accurate, but take longer.
+    substeps = 1
+
+    # When this is False, advanceTo() finishes with a shorter step if it
+    # needs to, so that the rover is exactly where it should be at the time
+    # asked for. When it's True, the rover only ever moves in whole steps of
+    # stepSeconds: any time left over is carried forward to the next update
+    # (so timeOfLastUpdate, the time the rover's position is for, may be up
+    # to a step behind). That way the steps are always the same, however
+    # irregularly updates happen, and so are the results.
+    fixedStep = False
+
+    # One of the integrators listed above.
+    integrator = "stepped"
+
+    # If set, advanceTo() calls recorder.record(rover) after every step, e.g.
+    # with a trajectory.TrajectoryRecorder.
+    recorder = None
+
+    # If set, commandLog.advanced(simTime) is called whenever advanceTo() is,
+    # and commandLog.applied(command) whenever applyCommand() is, e.g. with a
+    # commandlog.CommandLogWriter. That's everything needed to repeat exactly
+    # what this rover did.
+    commandLog = None
+
+    # What the rover's sensors can detect: a roverworld.World, or None for
+    # an empty world.
+    world = None
+
+    # The ultrasonic sensor is on the mast at the front of the rover, and
+    # turns with the mast servo. Like the real one, it reports 0 if nothing
+    # is in range.
+    ultrasonicOffsetCm = vehicleHeightCm / 2
+    ultrasonicMaxRangeCm = 400
+
+    # The IR obstacle sensors are at the front corners, looking straight
+    # ahead, and detect anything within irObstacleRangeCm. The IR line
+    # sensors are underneath, near the front, either side of the middle.
+    irObstacleSideCm = vehicleWidthCm / 2 - 2
+    irObstacleForwardCm = vehicleHeightCm / 2
+    irObstacleRangeCm = 10
+    irLineSideCm = 1.5
+    irLineForwardCm = vehicleHeightCm / 2 - 2
+
+    # The area the rover takes up, for bumping into things. This includes
+    # the wheels, which stick out at the sides, and a little at each end.
+    footprintWidthCm = vehicleWidthCm + 14
+    footprintLengthCm = vehicleHeightCm + 4
+
+    # Each motor has an encoder, which counts encoderCountsPerRevolution
+    # times for each turn of the wheel. Give a motor an encoder target (see
+    # setEncoderTargetLeft) and it stops by itself once it has turned that
+    # far, as the real rover's wheel sensor interrupts make it do.
+    wheelCircumferenceCm = 13.5
+    encoderCountsPerRevolution = 20
+
+    def __init__(self, clock=None, integrator=None, substeps=None):
+        # All of the state lives on the instance (and not the class) so that
+        # any number of rovers can be simulated side by side.
+        self.clock = clock if clock is not None else simclock.SimClock()
+        if integrator is not None:
+            if integrator not in integrators:
+                raise ValueError("Unknown integrator '" + str(integrator) + "'")
+            self.integrator = integrator
+        if substeps is not None:
+            if substeps < 1:
+                raise ValueError("substeps must be at least 1")
+            self.substeps = substeps
+        self.timeOfLastUpdate = self.clock.time()
+        self.vehicleXcm = 0
+        self.vehicleYcm = 0
+        self.vehicleHeadingDegrees = 0
+        self.speedL = 0
+        self.speedR = 0
+        self.servos = [0] * numServos
+        self.rgbLeds = [[0,0,0] for i in range(numRgbLeds)]
+        # Whether the rover is currently up against something in its world,
+        # and how many times it has run into something.
+        self.colliding = False
+        self.collisionCount = 0
+        # How far the rover has travelled altogether.
+        self.distanceTravelledCm = 0.0
+        # How far each side's wheels have turned (in cm, whichever way they
+        # were going), and the encoder count at which that side's motor
+        # should stop, or None.
+        self.wheelDistanceLcm = 0.0
+        self.wheelDistanceRcm = 0.0
+        self.encoderTargetLeft = None
+        self.encoderTargetRight = None
+
+    def setServo(self, servoId, value):
+        self.servos[servoId] = value
+
+    def setWheelMotorLeft(self, fwd, rev):
+        if fwd > 0 and rev > 0:
+            self.speedL = 0
+        else:
+            self.speedL = fwd - rev
+
+    def setWheelMotorRight(self, fwd, rev):
+        if fwd > 0 and rev > 0:
+            self.speedR = 0
+        else:
+            self.speedR = fwd - rev
+
+    def setRgbLed(self, ledId, rgbValues):
+        self.rgbLeds[ledId] = rgbValues
+
+    # Returns the [left, right] encoder counts: how many times each encoder
+    # has counted since the rover was created.
+    def encoderCounts(self):
+        countsPerCm = self.encoderCountsPerRevolution / self.wheelCircumferenceCm
+        # Allow for rounding errors, so that landing exactly on a count
+        # (as advanceTo() does for encoder targets) counts.
+        return [math.floor(self.wheelDistanceLcm * countsPerCm + 1e-9),
+                math.floor(self.wheelDistanceRcm * countsPerCm + 1e-9)]
+
+    # Makes the left motor stop once its encoder has counted this many more
+    # times. If that's no more at all, it stops straight away.
+    def setEncoderTargetLeft(self, counts):
+        self.encoderTargetLeft = self.encoderCounts()[0] + counts
+        self.stopAtEncoderTargets()
+
+    def setEncoderTargetRight(self, counts):
+        self.encoderTargetRight = self.encoderCounts()[1] + counts
+        self.stopAtEncoderTargets()
+
+    # Stops any motor that has reached its encoder target.
+    def stopAtEncoderTargets(self):
+        [countL, countR] = self.encoderCounts()
+        if self.encoderTargetLeft is not None and countL >= self.encoderTargetLeft:
+            self.speedL = 0
+            self.encoderTargetLeft = None
+        if self.encoderTargetRight is not None and countR >= self.encoderTargetRight:
+            self.speedR = 0
+            self.encoderTargetRight = None
+
+    # Returns how long (in simulated seconds) it will be until a motor
+    # reaches its encoder target, or None if none will.
+    def timeUntilEncoderTarget(self):
+        countsPerCm = self.encoderCountsPerRevolution / self.wheelCircumferenceCm
+        soonest = None
+        for (target, distanceCm, speed) in ((self.encoderTargetLeft, self.wheelDistanceLcm, self.speedL),
+                                            (self.encoderTargetRight, self.wheelDistanceRcm, self.speedR)):
+            if target is None or speed == 0:
+                continue
+            wheelSpeedCmPerSecond = abs(speed) / 100.0 * self.fullSpeedCmPerSecond
+            seconds = max(0, (math.ceil(target) / countsPerCm - distanceCm) / wheelSpeedCmPerSecond)
+            soonest = seconds if soonest is None else min(soonest, seconds)
+        return soonest
+
+    # Returns dt, or less if a motor will reach its encoder target sooner
+    # than that, so that a step can end exactly when the motor stops.
+    def untilEncoderTarget(self, dt):
+        seconds = self.timeUntilEncoderTarget()
+        if seconds is not None and 0 < seconds < dt:
+            return seconds
+        return dt
+
+    def applyCommand(self, command):
+        for (servoId, degrees) in command.servos:
+            self.setServo(servoId, degrees)
+
+        if command.wheelMotorLeft is not None:
+            [fwd, rev] = command.wheelMotorLeft
+            self.setWheelMotorLeft(fwd, rev)
+        if command.wheelMotorRight is not None:
+            [fwd, rev] = command.wheelMotorRight
+            self.setWheelMotorRight(fwd, rev)
+
+        for (ledId, rgbValues) in command.rgbLeds:
+            self.setRgbLed(ledId, rgbValues)
+
+        # After the motors, so a message can start a motor and say how far
+        # it should go.
+        if command.encoderTargetLeft is not None:
+            self.setEncoderTargetLeft(command.encoderTargetLeft)
+        if command.encoderTargetRight is not None:
+            self.setEncoderTargetRight(command.encoderTargetRight)
+
+        if self.commandLog is not None:
+            self.commandLog.applied(command)
+
+    # Applies a message in the format described at the top of roversimui.py,
+    # i.e. a dictionary with any of wheelMotors, servos and rgbLeds. Raises
+    # InvalidCommand (without changing anything) if the message is no good.
+    def applyMessage(self, data):
+        self.applyCommand(RoverCommand.fromMessage(data))
+
+    # Returns the distance in cm from the ultrasonic sensor to the nearest
+    # thing in front of it, or 0 if there's nothing in range.
+    def ultrasonicRange(self):
+        if self.world is None:
+            return 0
+        [sensorX, sensorY] = self.pointOnRover(0, self.ultrasonicOffsetCm)
+        distance = self.world.castRay(sensorX, sensorY, self.vehicleHeadingDegrees + self.servos[servo_MA], self.ultrasonicMaxRangeCm)
+        return distance if distance is not None else 0
+
+    # Returns the readings of the IR sensors: irLeft and irRight are True if
+    # the obstacle sensors on that side can see something (and irAll if
+    # either can), and irLeftLine and irRightLine are True if the line
+    # sensor on that side is over a line.
+    def irSensors(self):
+        if self.world is None:
+            return { 'irLeft': False, 'irRight': False, 'irAll': False, 'irLeftLine': False, 'irRightLine': False }
+        readings = {}
+        for (name, side) in (('irLeft', -1), ('irRight', 1)):
+            [sensorX, sensorY] = self.pointOnRover(side * self.irObstacleSideCm, self.irObstacleForwardCm)
+            readings[name] = self.world.castRay(sensorX, sensorY, self.vehicleHeadingDegrees, self.irObstacleRangeCm) is not None
+        readings['irAll'] = readings['irLeft'] or readings['irRight']
+        for (name, side) in (('irLeftLine', -1), ('irRightLine', 1)):
+            readings[name] = self.world.isOnLine(*self.pointOnRover(side * self.irLineSideCm, self.irLineForwardCm))
+        return readings
+
+    # Returns where a point on the rover is in the world, given how far it is
+    # to the right of the middle of the rover, and how far forward.
+    def pointOnRover(self, rightCm, forwardCm):
+        headingRadians = math.radians(self.vehicleHeadingDegrees)
+        sinHeading = math.sin(headingRadians)
+        cosHeading = math.cos(headingRadians)
+        return [self.vehicleXcm + rightCm * cosHeading + forwardCm * sinHeading,
+                self.vehicleYcm - rightCm * sinHeading + forwardCm * cosHeading]
+
+    # Returns what the rover's sensors can currently detect.
+    def sensorReadings(self):
+        readings = { 'ultrasonicRange': self.ultrasonicRange() }
+        readings.update(self.irSensors())
+        return readings
+
+    # Returns everything a program watching the rover might want to know
+    # about it right now, as a dictionary that can be turned straight into
+    # JSON: its pose, motors, servos, encoders and sensor readings. This is
+    # the response to a message, as described at the top of roversimui.py.
+    def snapshot(self):
+        snapshot = {
+            'time': self.timeOfLastUpdate,
+            'vehicleXcm': self.vehicleXcm,
+            'vehicleYcm': self.vehicleYcm,
+            'vehicleHeadingDegrees': self.vehicleHeadingDegrees,
+            'speedL': self.speedL,
+            'speedR': self.speedR,
+            'servos': list(self.servos),
+            'encoderCounts': self.encoderCounts(),
+            'distanceTravelledCm': self.distanceTravelledCm,
+            'colliding': self.colliding,
+        }
+        snapshot.update(self.sensorReadings())
+        return snapshot
+
+    # Advances the simulation by however much time has passed on the clock
+    # since the last update. This is what you want when something is watching
+    # the rover move. Use step(dt) to control the passage of time yourself.
+    def updateState(self):
+        self.advanceTo(self.clock.time())
+
+    # Advances the simulation up to the specified simulated time, in steps of
+    # stepSeconds (see fixedStep). The exact integrator doesn't need steps, so
+    # it goes there in one. Either way, a step ends early if a motor reaches
+    # its encoder target, so that it stops in exactly the right place
+    # (except with fixedStep, where it stops at the end of the step).
+    def advanceTo(self, simTime):
+        if self.commandLog is not None:
+            self.commandLog.advanced(simTime)
+        remaining = simTime - self.timeOfLastUpdate
+        if self.integrator == "exact":
+            while remaining > 0:
+                dt = self.untilEncoderTarget(remaining)
+                self.step(dt)
+                remaining -= dt
+                self.timeOfLastUpdate = simTime if remaining <= 0 else self.timeOfLastUpdate + dt
+                self.recordStep()
+            self.timeOfLastUpdate = simTime
+            return
+        if self.fixedStep:
+            steps = int(remaining / self.stepSeconds)
+            startTime = self.timeOfLastUpdate
+            for i in range(steps):
+                self.step(self.stepSeconds)
+                self.timeOfLastUpdate = startTime + (i + 1) * self.stepSeconds
+                self.recordStep()
+            return
+        while remaining > 0:
+            dt = self.untilEncoderTarget(min(remaining, self.stepSeconds))
+            self.step(dt)
+            remaining -= dt
+            # Land exactly on simTime, rather than wherever the rounding
+            # errors in adding up the steps would put it.
+            self.timeOfLastUpdate = simTime if remaining <= 0 else self.timeOfLastUpdate + dt
+            self.recordStep()
+        self.timeOfLastUpdate = simTime
+
+    def recordStep(self):
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    # Working out the direction and distance of travel is surprisingly
+    # complex, not least because there's no guarantee that all 4 steerable
+    # wheels are working together - they could be fighting one another.
+    # There are a few ways we could try to work it out:
+    #   1. an idealised model in which we presume the wheels cannot slip
+    #       sideways and work out the rotation and direction of travel
+    #   2. determine the resultant force and moment on the rover by
+    #       considering the forces from all 6 driven wheels.
+    #   3. work out where each wheel is trying to travel and by how much,
+    #       and then average these to work out the net motion and
+    #       separately calculate the rotation
+    # With 1, we can do this one steerable wheel at a time. If the
+    # steerable wheel is pointing dead ahead, then it won't be attempting
+    # to turn - it will just be trying to push forwards or backwards. But
+    # if it is not dead ahead, then it will be attempting to steer. The two
+    # fixed middle wheels constrain it to turn around a point somewhere
+    # along the imaginary line joining those two wheels together. We need
+    # to calculate the size of that turning circle, because from that, we
+    # can calculate the rate of turn for a given speed.
+    # We have the angle and also the length of the 'opposite' (the distance
+    # between the middle and front wheel), and we want the radius.
+    # r*sin(a) = opp, so r = opp/(sin(a))
+    def calculateSteeredPosition(self, left, front, wheelAngleRelativeToVehicleDegrees, wheelSpeed, dt):
+        # The motor speed is just a number from 0 (not moving)
+        # to 100 (full speed). We need to convert that to an
+        # actual speed:
+        wheelSpeedCmPerSecond = wheelSpeed / 100.0 * self.fullSpeedCmPerSecond
+
+        if wheelAngleRelativeToVehicleDegrees == 0:
+            # We're moving in a straight line, so we just need to work
+            # out what that means given the way we're facing
+            headingInRadians = (self.vehicleHeadingDegrees / 180.0) * math.pi
+
+            distanceMovedCmSinceLastUpdate = wheelSpeedCmPerSecond * dt
+            xChangeCm = distanceMovedCmSinceLastUpdate * math.sin(headingInRadians)
+            yChangeCm = distanceMovedCmSinceLastUpdate * math.cos(headingInRadians)
+            headingChangeDegrees = 0
+
+            updatedVehicleX = self.vehicleXcm + xChangeCm
+            updatedVehicleY = self.vehicleYcm + yChangeCm
+        else:
+            # Trying to steer
+            wheelDistanceFromCentreX = self.vehicleWidthCm / 2
+            steerablePosRelativeToRoverX = -wheelDistanceFromCentreX if left else wheelDistanceFromCentreX
+            steerablePosRelativeToRoverY = self.distanceBetweenWheelPairsCm if front else self.distanceBetweenWheelPairsCm
+            distanceBetweenWheelsCm = steerablePosRelativeToRoverY
+
+            wheelAngleRelativeToVehicleRadians = (wheelAngleRelativeToVehicleDegrees / 180.0) * math.pi
+            turningRadiusToSteerableWheelCm = distanceBetweenWheelsCm / math.sin(wheelAngleRelativeToVehicleRadians)
+            circumferenceCm = 2*math.pi*turningRadiusToSteerableWheelCm
+
+            # Now work out the rate of turn, then the amount of turn given the time difference
+            revolutionsPerSecond = wheelSpeedCmPerSecond / circumferenceCm
+            revolutionsTurned = revolutionsPerSecond * dt
+            headingChangeDegrees = revolutionsTurned * 360
+            headingChangeRadians = revolutionsTurned * 2 * math.pi
+
+            # Now work out the turning circle centre.
+            turningCircleCentreDistanceFromVehicleCentre = math.cos(wheelAngleRelativeToVehicleRadians) * turningRadiusToSteerableWheelCm - steerablePosRelativeToRoverX
+            vehicleHeadingRadians = math.radians(self.vehicleHeadingDegrees)
+            turningCircleRelativeToVehicleX = turningCircleCentreDistanceFromVehicleCentre * math.cos(-vehicleHeadingRadians)
+            turningCircleRelativeToVehicleY = turningCircleCentreDistanceFromVehicleCentre * math.sin(-vehicleHeadingRadians)
+            turningCircleX = turningCircleRelativeToVehicleX + self.vehicleXcm
+            turningCircleY = turningCircleRelativeToVehicleY + self.vehicleYcm
+
+            if showSteeringCalcs:
+                print("Turning circle centre: " + str([int(turningCircleX),int(turningCircleY)]))
+
+            # Work out where vehicle will go as it moves around the turning circle
+            currentAngleOnTurningCircleRadians = math.atan2(self.vehicleYcm - turningCircleY, self.vehicleXcm - turningCircleX)
+            updatedAngleOnTurningCircleRadians = currentAngleOnTurningCircleRadians - headingChangeRadians
+            updatedVehicleX = turningCircleX + abs(turningCircleCentreDistanceFromVehicleCentre) * math.cos(updatedAngleOnTurningCircleRadians)
+            updatedVehicleY = turningCircleY + abs(turningCircleCentreDistanceFromVehicleCentre) * math.sin(updatedAngleOnTurningCircleRadians)
+
+        return [updatedVehicleX, updatedVehicleY, self.vehicleHeadingDegrees + headingChangeDegrees]
+
+    # Returns how fast the rover is moving forwards (in cm per second), and
+    # how quickly its heading is changing (in degrees per second), with the
+    # motors and servos as they are now. These stay the same until the next
+    # command, so they describe the whole of the rover's motion until then.
+    #
+    # Each steerable wheel in the stepped model moves the rover around that
+    # wheel's turning circle. In the limit of very short steps, that means a
+    # wheel with speed v at angle a turns the rover at v*sin(a)/d radians per
+    # second (where d is distanceBetweenWheelPairsCm), and moves it forwards
+    # at that rate times the distance from the rover's centre to the centre of
+    # the turning circle: v*(cos(a) - x*sin(a)/d), where x is how far the
+    # wheel is to the right of the centre. Averaging the four wheels gives the
+    # rover's motion. (A wheel pointing straight ahead is the same formula
+    # with a = 0.)
+    def motionRates(self):
+        if (self.speedL > 0 and self.speedR < 0) or (self.speedL < 0 and self.speedR > 0):
+            spinSpeed = max(abs(self.speedL), abs(self.speedR))
+            headingRate = (spinSpeed / 100.0) * fullSpinSpeedDegreesPerSecond
+            if self.speedL < 0:  # Spinning left
+                headingRate = -headingRate
+            return [0.0, headingRate]
+
+        forwardSpeed = 0.0
+        headingRateRadians = 0.0
+        d = self.distanceBetweenWheelPairsCm
+        for (servoId, wheelSpeed, wheelX) in ((servo_FL, self.speedL, -self.vehicleWidthCm / 2),
+                                               (servo_FR, self.speedR, self.vehicleWidthCm / 2),
+                                               (servo_RL, self.speedL, -self.vehicleWidthCm / 2),
+                                               (servo_RR, self.speedR, self.vehicleWidthCm / 2)):
+            wheelSpeedCmPerSecond = wheelSpeed / 100.0 * self.fullSpeedCmPerSecond
+            wheelAngleRadians = math.radians(self.servos[servoId])
+            sinAngle = math.sin(wheelAngleRadians)
+            forwardSpeed += wheelSpeedCmPerSecond * (math.cos(wheelAngleRadians) - wheelX * sinAngle / d)
+            headingRateRadians += wheelSpeedCmPerSecond * sinAngle / d
+        return [forwardSpeed / 4, math.degrees(headingRateRadians / 4)]
+
+    # Returns the [x, y, heading] the rover will have dt seconds from its last
+    # update, if nothing changes in the meantime, without changing anything.
+    # With constant forward speed u and turn rate w, the rover follows a
+    # circular arc, so the change in position is the chord of that arc:
+    # u*dt*sinc(w*dt/2) long, in the direction of the heading half way round.
+    def poseAfter(self, dt):
+        [forwardSpeed, headingRate] = self.motionRates()
+        headingChangeRadians = math.radians(headingRate * dt)
+        chordCm = forwardSpeed * dt * sinc(headingChangeRadians / 2)
+        chordHeadingRadians = math.radians(self.vehicleHeadingDegrees) + headingChangeRadians / 2
+        return [self.vehicleXcm + chordCm * math.sin(chordHeadingRadians),
+                self.vehicleYcm + chordCm * math.cos(chordHeadingRadians),
+                self.vehicleHeadingDegrees + headingRate * dt]
+
+    # Returns the [x, y, heading] the rover will have at the specified
+    # simulated time, assuming no further commands, without changing
+    # anything.
+    def poseAt(self, simTime):
+        return self.poseAfter(simTime - self.timeOfLastUpdate)
+
+    # Advances the simulation by dt seconds. If that would leave the rover
+    # touching something solid in its world, it stays where it was instead,
+    # as if its wheels were spinning against whatever it ran into.
+    def step(self, dt):
+        if self.speedL == 0 and self.speedR == 0:
+            # Nothing can move, so there's nothing to work out, or to bump
+            # into (and the rover is no longer pushing against anything).
+            self.colliding = False
+            return
+        [x, y] = [self.vehicleXcm, self.vehicleYcm]
+        if self.world is None or self.world.occupancy is None:
+            self.move(dt)
+        else:
+            self.moveUnlessBlocked(dt)
+        self.distanceTravelledCm += math.hypot(self.vehicleXcm - x, self.vehicleYcm - y)
+        self.turnWheels(dt)
+
+    # The wheels turn at the speed the motors are set to, even if the rover
+    # can't move (so a rover stuck against a wall still reaches its encoder
+    # targets).
+    def turnWheels(self, dt):
+        self.wheelDistanceLcm += abs(self.speedL) / 100.0 * self.fullSpeedCmPerSecond * dt
+        self.wheelDistanceRcm += abs(self.speedR) / 100.0 * self.fullSpeedCmPerSecond * dt
+        if self.encoderTargetLeft is not None or self.encoderTargetRight is not None:
+            self.stopAtEncoderTargets()
+
+    def moveUnlessBlocked(self, dt):
+        # Collisions are only checked at the end of each move, so the exact
+        # integrator (which can take steps of any length) mustn't be allowed
+        # to jump straight through something.
+        parts = max(1, math.ceil(dt / self.stepSeconds - 1e-9))
+        for i in range(parts):
+            before = [self.vehicleXcm, self.vehicleYcm, self.vehicleHeadingDegrees]
+            self.move(dt / parts)
+            if self.touchingAnything() and not self.touchingAnything(*before):
+                [self.vehicleXcm, self.vehicleYcm, self.vehicleHeadingDegrees] = before
+                if not self.colliding:
+                    self.collisionCount += 1
+                self.colliding = True
+                return
+        self.colliding = False
+
+    # Returns whether the rover (or a rover at the given pose) is touching
+    # anything solid in its world.
+    def touchingAnything(self, x=None, y=None, headingDegrees=None):
+        if x is None:
+            [x, y, headingDegrees] = [self.vehicleXcm, self.vehicleYcm, self.vehicleHeadingDegrees]
+        return self.world.collides(x, y, headingDegrees, self.footprintWidthCm, self.footprintLengthCm)
+
+    # Moves the rover as it would go in dt seconds, in substeps parts,
+    # regardless of anything in the way.
+    def move(self, dt):
+        if self.integrator == "exact":
+            [self.vehicleXcm, self.vehicleYcm, self.vehicleHeadingDegrees] = self.poseAfter(dt)
+            return
+        substepSeconds = dt / self.substeps
+        if self.integrator == "stepped":
+            for i in range(self.substeps):
+                self.stepAveragingWheels(substepSeconds)
+            return
+        # The speed and rate of turn can't change during a step.
+        [forwardSpeed, headingRate] = self.motionRates()
+        if self.integrator == "euler":
+            for i in range(self.substeps):
+                self.stepEuler(forwardSpeed, headingRate, substepSeconds)
+        else:
+            for i in range(self.substeps):
+                self.stepRungeKutta(forwardSpeed, headingRate, substepSeconds)
+
+    # Advances by dt seconds, assuming the heading stays as it is until the
+    # end of the step.
+    def stepEuler(self, forwardSpeed, headingRate, dt):
+        headingRadians = math.radians(self.vehicleHeadingDegrees)
+        self.vehicleXcm += forwardSpeed * dt * math.sin(headingRadians)
+        self.vehicleYcm += forwardSpeed * dt * math.cos(headingRadians)
+        self.vehicleHeadingDegrees += headingRate * dt
+
+    # Advances by dt seconds using the fourth-order Runge-Kutta method on
+    #   dx/dt = forwardSpeed * sin(heading)
+    #   dy/dt = forwardSpeed * cos(heading)
+    #   dheading/dt = headingRate
+    # Since the rate of change only depends on the heading, and the heading
+    # changes at a constant rate, the two midpoint estimates are the same.
+    def stepRungeKutta(self, forwardSpeed, headingRate, dt):
+        headingRadians = math.radians(self.vehicleHeadingDegrees)
+        headingChangeRadians = math.radians(headingRate * dt)
+        midHeadingRadians = headingRadians + headingChangeRadians / 2
+        endHeadingRadians = headingRadians + headingChangeRadians
+        self.vehicleXcm += forwardSpeed * dt * (math.sin(headingRadians) + 4 * math.sin(midHeadingRadians) + math.sin(endHeadingRadians)) / 6
+        self.vehicleYcm += forwardSpeed * dt * (math.cos(headingRadians) + 4 * math.cos(midHeadingRadians) + math.cos(endHeadingRadians)) / 6
+        self.vehicleHeadingDegrees += headingRate * dt
+
+    # Advances the simulation by dt seconds using the stepped model.
+    def stepAveragingWheels(self, dt):
+        # We'll work out where each steerable wheel is attempting to push the rover.
+        # For spinning in place, we need to handle opposite wheel directions specially
+        if (self.speedL > 0 and self.speedR < 0) or (self.speedL < 0 and self.speedR > 0):
+            # Spinning in place
+            spinSpeed = max(abs(self.speedL), abs(self.speedR))
+            headingChange = (spinSpeed / 100.0) * fullSpinSpeedDegreesPerSecond * dt
+            if self.speedL < 0:  # Spinning left
+                headingChange = -headingChange
+
+            self.vehicleHeadingDegrees += headingChange
+            # When spinning in place, position doesn't change
+            return
+
+        if self.speedL == 0 and self.speedR == 0:
+            # Parked, so there's nothing to work out.
+            return
+
+        # Normal movement calculation for non-spin cases
+        [updatedXFL, updatedYFL, updatedHeadingFL] = self.calculateSteeredPosition(True, True, self.servos[servo_FL], self.speedL, dt)
+        [updatedXFR, updatedYFR, updatedHeadingFR] = self.calculateSteeredPosition(False, True, self.servos[servo_FR], self.speedR, dt)
+        [updatedXBL, updatedYBL, updatedHeadingBL] = self.calculateSteeredPosition(True, False, self.servos[servo_RL], self.speedL, dt)
+        [updatedXBR, updatedYBR, updatedHeadingBR] = self.calculateSteeredPosition(False, False, self.servos[servo_RR], self.speedR, dt)
+
+        updatedXAverage = (updatedXFL + updatedXFR + updatedXBL + updatedXBR) / 4
+        updatedYAverage = (updatedYFL + updatedYFR + updatedYBL + updatedYBR) / 4
+        updatedHeadingAverage = (updatedHeadingFL + updatedHeadingFR + updatedHeadingBL + updatedHeadingBR) / 4
+
+        self.vehicleXcm = updatedXAverage
+        self.vehicleYcm = updatedYAverage
+        self.vehicleHeadingDegrees = updatedHeadingAverage
+
+        if showSteeringCalcs:
+            print("X,Y: " + str(self.vehicleXcm) + ", " + str(self.vehicleYcm))
+            print("Heading: " + str(self.vehicleHeadingDegrees))
@@ -0,0 +1,136 @@
+# 4tronix M.A.R.S. Rover Fleet Simulation
+#
+# Simulates lots of rovers at once. This is the same model as roverengine.Rover,
+# but instead of each rover being an object with its own numbers, a RoverFleet
+# keeps each quantity (position, heading, motor speeds, servo angles and so
+# on) for every rover in one NumPy array, and works out the next step for all
+# of them together. That makes it practical to try out thousands of
+# variations, e.g. of speed or wheel geometry:
+#
+#   import numpy as np
+#   from roverfleet import RoverFleet
+#   import roverengine
+#
+#   fleet = RoverFleet(10000)
+#   fleet.fullSpeedCmPerSecond = np.linspace(5, 15, 10000)
+#   fleet.setServo(roverengine.servo_FL, 20)
+#   fleet.setWheelMotorLeft(100, 0)
+#   fleet.setWheelMotorRight(100, 0)
+#   fleet.run(10, 0.1)
+#   print(fleet.vehicleXcm, fleet.vehicleYcm)
+#
+# Any of the settings can be given either as one value for every rover or as
+# an array with a value for each rover.
+
+import numpy as np
+
+import roverengine
+from roverengine import Rover, servo_FL, servo_FR, servo_RL, servo_RR, numServos
+
+# Works out motor speeds the same way Rover does: setting both directions at
+# once stops the motor.
+def motorSpeed(fwd, rev):
+    fwd = np.asarray(fwd, dtype=float)
+    rev = np.asarray(rev, dtype=float)
+    return np.where((fwd > 0) & (rev > 0), 0.0, fwd - rev)
+
+class RoverFleet:
+    def __init__(self, count):
+        self.count = count
+        self.vehicleXcm = np.zeros(count)
+        self.vehicleYcm = np.zeros(count)
+        self.vehicleHeadingDegrees = np.zeros(count)
+        self.speedL = np.zeros(count)
+        self.speedR = np.zeros(count)
+        self.servos = np.zeros((count, numServos))
+
+        # Each rover can have its own geometry and speed.
+        self.vehicleWidthCm = np.full(count, float(Rover.vehicleWidthCm))
+        self.distanceBetweenWheelPairsCm = np.full(count, float(Rover.distanceBetweenWheelPairsCm))
+        self.fullSpeedCmPerSecond = np.full(count, float(Rover.fullSpeedCmPerSecond))
+
+    def setServo(self, servoId, value):
+        self.servos[:, servoId] = value
+
+    def setWheelMotorLeft(self, fwd, rev):
+        self.speedL = np.broadcast_to(motorSpeed(fwd, rev), (self.count,)).copy()
+
+    def setWheelMotorRight(self, fwd, rev):
+        self.speedR = np.broadcast_to(motorSpeed(fwd, rev), (self.count,)).copy()
+
+    # Returns the [x, y, heading] of one rover.
+    def pose(self, index):
+        return [self.vehicleXcm[index], self.vehicleYcm[index], self.vehicleHeadingDegrees[index]]
+
+    # Works out where every rover would end up if it were moved only by
+    # one steerable wheel. This is Rover.calculateSteeredPosition, but for
+    # all of the rovers at once. Rovers whose wheel is pointing straight
+    # ahead and those that are steering are both worked out, and then the
+    # right answer picked for each rover. sinHeading and cosHeading are the
+    # same for all four wheels, so they're worked out once by step().
+    def calculateSteeredPositions(self, left, wheelAngleRelativeToVehicleDegrees, wheelSpeed, dt, sinHeading, cosHeading):
+        wheelSpeedCmPerSecond = wheelSpeed / 100.0 * self.fullSpeedCmPerSecond
+        distanceMovedCm = wheelSpeedCmPerSecond * dt
+
+        # Moving in a straight line
+        straight = wheelAngleRelativeToVehicleDegrees == 0
+        straightX = self.vehicleXcm + distanceMovedCm * sinHeading
+        straightY = self.vehicleYcm + distanceMovedCm * cosHeading
+
+        # Trying to steer. (The angle of the straight ones is replaced with
+        # anything non-zero, just to avoid dividing by zero. Those results
+        # get thrown away.)
+        wheelDistanceFromCentreX = self.vehicleWidthCm / 2
+        steerablePosRelativeToRoverX = -wheelDistanceFromCentreX if left else wheelDistanceFromCentreX
+        wheelAngleRelativeToVehicleRadians = np.radians(np.where(straight, 90.0, wheelAngleRelativeToVehicleDegrees))
+        turningRadiusToSteerableWheelCm = self.distanceBetweenWheelPairsCm / np.sin(wheelAngleRelativeToVehicleRadians)
+        headingChangeRadians = distanceMovedCm / turningRadiusToSteerableWheelCm
+
+        # The turning circle centre is this far to the right of the rover
+        # (or to the left, if negative).
+        turningCircleCentreDistanceFromVehicleCentre = np.cos(wheelAngleRelativeToVehicleRadians) * turningRadiusToSteerableWheelCm - steerablePosRelativeToRoverX
+
+        # Rather than converting the rover's position on the turning circle
+        # into an angle, adding the change, and converting back (as Rover
+        # does), rotate the rover's position relative to the centre directly.
+        # It comes to the same thing, with less trigonometry.
+        relativeX = -turningCircleCentreDistanceFromVehicleCentre * cosHeading
+        relativeY = turningCircleCentreDistanceFromVehicleCentre * sinHeading
+        cosChange = np.cos(headingChangeRadians)
+        sinChange = np.sin(headingChangeRadians)
+        steeredX = self.vehicleXcm - relativeX + relativeX * cosChange + relativeY * sinChange
+        steeredY = self.vehicleYcm - relativeY - relativeX * sinChange + relativeY * cosChange
+        steeredHeading = self.vehicleHeadingDegrees + np.degrees(headingChangeRadians)
+
+        return (np.where(straight, straightX, steeredX),
+                np.where(straight, straightY, steeredY),
+                np.where(straight, self.vehicleHeadingDegrees, steeredHeading))
+
+    # Advances every rover by dt seconds.
+    def step(self, dt):
+        spinning = ((self.speedL > 0) & (self.speedR < 0)) | ((self.speedL < 0) & (self.speedR > 0))
+        moving = ~spinning & ((self.speedL != 0) | (self.speedR != 0))
+
+        headingInRadians = np.radians(self.vehicleHeadingDegrees)
+        sinHeading = np.sin(headingInRadians)
+        cosHeading = np.cos(headingInRadians)
+        (xFL, yFL, headingFL) = self.calculateSteeredPositions(True, self.servos[:, servo_FL], self.speedL, dt, sinHeading, cosHeading)
+        (xFR, yFR, headingFR) = self.calculateSteeredPositions(False, self.servos[:, servo_FR], self.speedR, dt, sinHeading, cosHeading)
+        (xBL, yBL, headingBL) = self.calculateSteeredPositions(True, self.servos[:, servo_RL], self.speedL, dt, sinHeading, cosHeading)
+        (xBR, yBR, headingBR) = self.calculateSteeredPositions(False, self.servos[:, servo_RR], self.speedR, dt, sinHeading, cosHeading)
+
+        # Spinning in place only changes the heading.
+        spinSpeed = np.maximum(np.abs(self.speedL), np.abs(self.speedR))
+        headingChange = (spinSpeed / 100.0) * roverengine.fullSpinSpeedDegreesPerSecond * dt
+        spinHeading = self.vehicleHeadingDegrees + np.where(self.speedL < 0, -headingChange, headingChange)
+
+        self.vehicleXcm = np.where(moving, (xFL + xFR + xBL + xBR) / 4, self.vehicleXcm)
+        self.vehicleYcm = np.where(moving, (yFL + yFR + yBL + yBR) / 4, self.vehicleYcm)
+        self.vehicleHeadingDegrees = np.where(moving, (headingFL + headingFR + headingBL + headingBR) / 4,
+                                              np.where(spinning, spinHeading, self.vehicleHeadingDegrees))
+
+    # Advances every rover by duration seconds, in steps of dt.
+    def run(self, duration, dt):
+        steps = int(round(duration / dt))
+        for i in range(steps):
+            self.step(dt)
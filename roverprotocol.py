@@ -0,0 +1,391 @@
+# 4tronix M.A.R.S. Rover Simulator Binary Protocol
+#
+# This is an alternative to sending JSON over HTTP to the simulator UI. It
+# carries exactly the same messages (see the top of roversimui.py) but in a
+# fixed binary layout, over a connection that stays open for as long as the
+# client is running. There's no HTTP to parse and no JSON to encode or decode,
+# so each command takes a lot less time.
+#
+# Everything sent in either direction is a frame:
+#
+#   uint8   frame type
+#   uint16  length of the body in bytes
+#   ...     body
+#
+# All values are little-endian. The client sends a COMMAND frame, and the
+# simulator always replies with a RESPONSE frame. The body of a COMMAND frame
+# is any number of records, each of which starts with a uint8 record type:
+#
+#   RECORD_MOTOR_LEFT           float64 fwd, float64 rev
+#   RECORD_MOTOR_RIGHT          float64 fwd, float64 rev
+#   RECORD_SERVO                uint8 servo number, float64 degrees
+#   RECORD_RGB_LED              uint8 LED number, uint8 red, uint8 green, uint8 blue
+#   RECORD_ENCODER_TARGET_LEFT  float64 counts
+#   RECORD_ENCODER_TARGET_RIGHT float64 counts
+#
+# All the records in one frame are applied together, just as with a single
+# JSON message. The body of a RESPONSE frame is a snapshot of the rover just
+# after the command was applied (see roverengine.Rover.snapshot()):
+#
+#   float64 time, vehicleXcm, vehicleYcm, vehicleHeadingDegrees,
+#           distanceTravelledCm
+#   float32 speedL, speedR
+#   float32 servos (one for each servo)
+#   uint32  encoderCounts (left, then right)
+#   float32 ultrasonicRange
+#   uint8   flags: a bit for each of irLeft, irRight, irLeftLine and
+#           irRightLine (IR_LEFT etc.), set if that sensor is triggered, and
+#           COLLIDING
+#
+# The client can also send a WAIT frame, to wait for the rover to do
+# something (see roverengine.WaitCondition). The simulator doesn't reply
+# until it has, or the wait times out, and then replies with a WAIT_RESPONSE
+# frame. The body of a WAIT frame is records, as for COMMAND:
+#
+#   RECORD_WAIT_ENCODER_TARGETS (nothing else)
+#   RECORD_WAIT_TIMEOUT         float64 simulated seconds
+#   RECORD_WAIT_DISTANCE        float64 cm
+#   RECORD_WAIT_HEADING_CHANGE  float64 degrees
+#   RECORD_WAIT_RANGE_BELOW     float64 cm
+#
+# and the body of a WAIT_RESPONSE frame is a uint8, 1 if what was waited for
+# happened (0 if the wait timed out), followed by the body of a RESPONSE.
+#
+# A simulator can have more than one rover, each with an ID. Everything on a
+# connection goes to the simulator's default rover, unless the client sends
+# a SELECT frame, whose body is the ID of the rover (UTF-8 encoded) that
+# everything after it is for. The simulator replies with a RESPONSE for
+# that rover.
+#
+# Addresses are either "tcp:host:port" or (where the OS supports it)
+# "unix:path".
+
+import os
+import struct
+import socket
+import socketserver
+
+from roverengine import RoverCommand, WaitCondition, checkColour, numServos, numRgbLeds
+
+defaultAddress = "tcp:127.0.0.1:8524"
+
+FRAME_COMMAND = 1
+FRAME_RESPONSE = 2
+FRAME_WAIT = 3
+FRAME_WAIT_RESPONSE = 4
+FRAME_SELECT = 5
+
+RECORD_MOTOR_LEFT = 1
+RECORD_MOTOR_RIGHT = 2
+RECORD_SERVO = 3
+RECORD_RGB_LED = 4
+RECORD_ENCODER_TARGET_LEFT = 5
+RECORD_ENCODER_TARGET_RIGHT = 6
+
+RECORD_WAIT_ENCODER_TARGETS = 1
+RECORD_WAIT_TIMEOUT = 2
+RECORD_WAIT_DISTANCE = 3
+RECORD_WAIT_HEADING_CHANGE = 4
+RECORD_WAIT_RANGE_BELOW = 5
+waitValueRecords = (('timeout', RECORD_WAIT_TIMEOUT), ('distanceCm', RECORD_WAIT_DISTANCE),
+                    ('headingChangeDegrees', RECORD_WAIT_HEADING_CHANGE), ('rangeBelowCm', RECORD_WAIT_RANGE_BELOW))
+
+frameHeader = struct.Struct("<BH")
+recordType = struct.Struct("<B")
+motorRecord = struct.Struct("<dd")
+servoRecord = struct.Struct("<Bd")
+rgbLedRecord = struct.Struct("<BBBB")
+valueRecord = struct.Struct("<d")
+responseBody = struct.Struct("<5d2f" + str(numServos) + "f2IfB")
+waitResult = struct.Struct("<B")
+
+IR_LEFT = 0x01
+IR_RIGHT = 0x02
+IR_LEFT_LINE = 0x04
+IR_RIGHT_LINE = 0x08
+COLLIDING = 0x10
+irBits = (('irLeft', IR_LEFT), ('irRight', IR_RIGHT), ('irLeftLine', IR_LEFT_LINE), ('irRightLine', IR_RIGHT_LINE))
+
+# Raised when a frame can't be understood.
+class ProtocolError(Exception):
+    pass
+
+def encodeFrame(frameType, body):
+    return frameHeader.pack(frameType, len(body)) + body
+
+# Turns a message dictionary (as sent over HTTP) into a COMMAND frame.
+def encodeCommand(message):
+    parts = []
+    for key in message:
+        if key == 'wheelMotors':
+            wheelMotors = message['wheelMotors']
+            if 'l' in wheelMotors:
+                parts.append(recordType.pack(RECORD_MOTOR_LEFT))
+                parts.append(motorRecord.pack(*wheelMotors['l']))
+            if 'r' in wheelMotors:
+                parts.append(recordType.pack(RECORD_MOTOR_RIGHT))
+                parts.append(motorRecord.pack(*wheelMotors['r']))
+        elif key == 'servos':
+            servos = message['servos']
+            for servo in servos:
+                parts.append(recordType.pack(RECORD_SERVO))
+                parts.append(servoRecord.pack(int(servo), servos[servo]))
+        elif key == 'rgbLeds':
+            rgbLeds = message['rgbLeds']
+            for led in rgbLeds:
+                parts.append(recordType.pack(RECORD_RGB_LED))
+                # Checked the same way as the simulator checks them, so that
+                # a colour that doesn't fit in a byte is an InvalidCommand
+                # here too.
+                parts.append(rgbLedRecord.pack(int(led), *[checkColour(value) for value in rgbLeds[led]]))
+        elif key == 'encoderTargets':
+            encoderTargets = message['encoderTargets']
+            if 'l' in encoderTargets:
+                parts.append(recordType.pack(RECORD_ENCODER_TARGET_LEFT))
+                parts.append(valueRecord.pack(encoderTargets['l']))
+            if 'r' in encoderTargets:
+                parts.append(recordType.pack(RECORD_ENCODER_TARGET_RIGHT))
+                parts.append(valueRecord.pack(encoderTargets['r']))
+        else:
+            raise ProtocolError("Cannot encode '" + key + "'")
+    return encodeFrame(FRAME_COMMAND, b"".join(parts))
+
+# Turns the body of a COMMAND frame into a roverengine.RoverCommand. The
+# fixed layout means there's very little to check.
+def decodeCommand(body):
+    command = RoverCommand()
+    offset = 0
+    try:
+        while offset < len(body):
+            (record,) = recordType.unpack_from(body, offset)
+            offset += recordType.size
+            if record == RECORD_MOTOR_LEFT:
+                command.wheelMotorLeft = list(motorRecord.unpack_from(body, offset))
+                offset += motorRecord.size
+            elif record == RECORD_MOTOR_RIGHT:
+                command.wheelMotorRight = list(motorRecord.unpack_from(body, offset))
+                offset += motorRecord.size
+            elif record == RECORD_SERVO:
+                (servoId, degrees) = servoRecord.unpack_from(body, offset)
+                if servoId >= numServos:
+                    raise ProtocolError("Servo " + str(servoId) + " is out of range")
+                command.servos.append((servoId, degrees))
+                offset += servoRecord.size
+            elif record == RECORD_RGB_LED:
+                (ledId, red, green, blue) = rgbLedRecord.unpack_from(body, offset)
+                if ledId >= numRgbLeds:
+                    raise ProtocolError("LED " + str(ledId) + " is out of range")
+                command.rgbLeds.append((ledId, [red, green, blue]))
+                offset += rgbLedRecord.size
+            elif record == RECORD_ENCODER_TARGET_LEFT:
+                (command.encoderTargetLeft,) = valueRecord.unpack_from(body, offset)
+                offset += valueRecord.size
+            elif record == RECORD_ENCODER_TARGET_RIGHT:
+                (command.encoderTargetRight,) = valueRecord.unpack_from(body, offset)
+                offset += valueRecord.size
+            else:
+                raise ProtocolError("Unknown record type " + str(record))
+    except struct.error:
+        raise ProtocolError("Truncated record")
+    return command
+
+# Turns a wait message (see roverengine.WaitCondition) into a WAIT frame.
+def encodeWait(message):
+    parts = []
+    records = dict(waitValueRecords)
+    for key in message:
+        if key == 'encoderTargets':
+            if message['encoderTargets']:
+                parts.append(recordType.pack(RECORD_WAIT_ENCODER_TARGETS))
+        elif key in records:
+            if message[key] is not None:
+                parts.append(recordType.pack(records[key]))
+                parts.append(valueRecord.pack(message[key]))
+        else:
+            raise ProtocolError("Cannot encode '" + key + "'")
+    return encodeFrame(FRAME_WAIT, b"".join(parts))
+
+# Turns the body of a WAIT frame into a roverengine.WaitCondition.
+def decodeWait(body):
+    condition = WaitCondition()
+    keys = { record: key for (key, record) in waitValueRecords }
+    offset = 0
+    try:
+        while offset < len(body):
+            (record,) = recordType.unpack_from(body, offset)
+            offset += recordType.size
+            if record == RECORD_WAIT_ENCODER_TARGETS:
+                condition.encoderTargets = True
+            elif record in keys:
+                (value,) = valueRecord.unpack_from(body, offset)
+                setattr(condition, keys[record], value)
+                offset += valueRecord.size
+            else:
+                raise ProtocolError("Unknown wait record type " + str(record))
+    except struct.error:
+        raise ProtocolError("Truncated record")
+    return condition
+
+def encodeResponse(response):
+    flags = COLLIDING if response.get('colliding') else 0
+    for (name, bit) in irBits:
+        if response.get(name):
+            flags |= bit
+    return encodeFrame(FRAME_RESPONSE, responseBody.pack(
+        response.get('time', 0), response.get('vehicleXcm', 0), response.get('vehicleYcm', 0),
+        response.get('vehicleHeadingDegrees', 0), response.get('distanceTravelledCm', 0),
+        response.get('speedL', 0), response.get('speedR', 0), *response.get('servos', [0] * numServos),
+        *response.get('encoderCounts', [0, 0]), response.get('ultrasonicRange', 0), flags))
+
+# The response to a WAIT is the usual response, plus 'met', which is True if
+# what was waited for happened, and False if the wait timed out.
+def encodeWaitResponse(response):
+    body = encodeResponse(response)[frameHeader.size:]
+    return encodeFrame(FRAME_WAIT_RESPONSE, waitResult.pack(1 if response.get('met') else 0) + body)
+
+def decodeWaitResponse(body):
+    (met,) = waitResult.unpack_from(body, 0)
+    response = decodeResponse(body[waitResult.size:])
+    response['met'] = bool(met)
+    return response
+
+def decodeResponse(body):
+    values = responseBody.unpack(body)
+    response = {
+        'time': values[0],
+        'vehicleXcm': values[1],
+        'vehicleYcm': values[2],
+        'vehicleHeadingDegrees': values[3],
+        'distanceTravelledCm': values[4],
+        'speedL': values[5],
+        'speedR': values[6],
+        'servos': list(values[7:7 + numServos]),
+        'encoderCounts': list(values[7 + numServos:9 + numServos]),
+        'ultrasonicRange': values[9 + numServos],
+    }
+    flags = values[10 + numServos]
+    response['colliding'] = bool(flags & COLLIDING)
+    for (name, bit) in irBits:
+        response[name] = bool(flags & bit)
+    response['irAll'] = response['irLeft'] or response['irRight']
+    return response
+
+def recvExactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return bytes(data)
+
+# Reads one frame, returning its type and body.
+def readFrame(sock):
+    (frameType, length) = frameHeader.unpack(recvExactly(sock, frameHeader.size))
+    return frameType, recvExactly(sock, length)
+
+def parseAddress(address):
+    [kind, rest] = address.split(":", 1)
+    if kind == "tcp":
+        [host, port] = rest.rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    if kind == "unix":
+        return socket.AF_UNIX, rest
+    raise ValueError("Address must start with tcp: or unix:")
+
+def connect(address=defaultAddress):
+    (family, sockAddress) = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(sockAddress)
+    if family == socket.AF_INET:
+        # We always wait for the response before sending anything else, so
+        # there's nothing to be gained by holding back small frames.
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+# Client end of a connection to the simulator, for the rover with the given
+# ID (or the simulator's default rover).
+class Connection:
+    def __init__(self, address=defaultAddress, roverId=None):
+        self.sock = connect(address)
+        if roverId is not None:
+            self.sock.sendall(encodeFrame(FRAME_SELECT, roverId.encode("utf-8")))
+            (frameType, body) = readFrame(self.sock)
+            if frameType != FRAME_RESPONSE:
+                raise ProtocolError("Expected a response, got frame type " + str(frameType))
+
+    def send(self, message):
+        self.sock.sendall(encodeCommand(message))
+        (frameType, body) = readFrame(self.sock)
+        if frameType != FRAME_RESPONSE:
+            raise ProtocolError("Expected a response, got frame type " + str(frameType))
+        return decodeResponse(body)
+
+    # Waits until the rover has done what the wait message describes, and
+    # returns the response (see decodeWaitResponse).
+    def wait(self, message):
+        self.sock.sendall(encodeWait(message))
+        (frameType, body) = readFrame(self.sock)
+        if frameType != FRAME_WAIT_RESPONSE:
+            raise ProtocolError("Expected a wait response, got frame type " + str(frameType))
+        return decodeWaitResponse(body)
+
+    def close(self):
+        self.sock.close()
+
+class CommandHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        if self.server.address_family == socket.AF_INET:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Which rover this connection is for (None for the default).
+        self.roverId = None
+
+    def handle(self):
+        while True:
+            try:
+                (frameType, body) = readFrame(self.request)
+            except ConnectionError:
+                return
+            if frameType == FRAME_COMMAND:
+                response = self.server.handleCommand(decodeCommand(body), self.roverId)
+                self.request.sendall(encodeResponse(response))
+            elif frameType == FRAME_WAIT and self.server.handleWait is not None:
+                response = self.server.handleWait(decodeWait(body), self.roverId)
+                self.request.sendall(encodeWaitResponse(response))
+            elif frameType == FRAME_SELECT:
+                self.roverId = body.decode("utf-8")
+                # An empty command: nothing changes, but the rover is
+                # created if need be, and its state comes back.
+                response = self.server.handleCommand(RoverCommand(), self.roverId)
+                self.request.sendall(encodeResponse(response))
+            else:
+                raise ProtocolError("Expected a command, got frame type " + str(frameType))
+
+class TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# Unix domain sockets aren't available everywhere (e.g. older Windows).
+if hasattr(socketserver, "ThreadingUnixStreamServer"):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+# Creates a server listening on address. Each connection gets its own thread,
+# which passes each incoming roverengine.RoverCommand to handleCommand, along
+# with the ID of the rover it's for (None for the default), and sends back
+# whatever response dictionary that returns. Likewise each
+# roverengine.WaitCondition goes to handleWait, if given, which should return
+# once the wait is over. Call serve_forever() on the result to start handling
+# connections.
+def createServer(address, handleCommand, handleWait=None):
+    (family, sockAddress) = parseAddress(address)
+    if family == socket.AF_INET:
+        server = TcpServer(sockAddress, CommandHandler)
+    else:
+        # A socket file left behind by a previous run would stop us binding.
+        if os.path.exists(sockAddress):
+            os.remove(sockAddress)
+        server = UnixServer(sockAddress, CommandHandler)
+    server.handleCommand = handleCommand
+    server.handleWait = handleWait
+    return server
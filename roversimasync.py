@@ -0,0 +1,361 @@
+#!/usr/bin/python
+#
+# roversimasync.py
+#
+# An asyncio flavour of roversimulator.py. The functions are the same, but
+# each is a coroutine on an AsyncRover, so a program can get on with other
+# things (reading sensors, driving another rover) while a command is on its
+# way to the simulator. E.g.:
+#
+#   import asyncio
+#   from roversimasync import AsyncRover
+#
+#   async def main():
+#       rover = await AsyncRover.connect()
+#       await rover.forward(100)
+#       await rover.sleep(3)
+#       await rover.stop()
+#       await rover.close()
+#
+#   asyncio.run(main())
+#
+# This talks to the simulator UI using the binary protocol in
+# roverprotocol.py. Commands are pipelined: each one is written to the
+# connection as soon as it is issued, without waiting for earlier ones to be
+# answered, and the simulator's responses (which always come back in the
+# order the commands were sent) complete each command's await in turn. Any
+# number of AsyncRovers can share one event loop, each with its own
+# connection.
+
+import asyncio
+import collections
+import socket
+from contextlib import asynccontextmanager
+
+import roverprotocol
+import simclock
+# These don't talk to the simulator, so they're exactly as in roversimulator.
+from roversimulator import mergeMessage, toRGB, wheel
+
+class AsyncRover:
+    numPixels = 4
+
+    def __init__(self, reader, writer, clock=None):
+        self.reader = reader
+        self.writer = writer
+        self.clock = clock if clock is not None else simclock.fromEnvironment()
+        # One future for each command that has been sent but not answered,
+        # oldest first.
+        self.pendingResponses = collections.deque()
+        self.pendingBatch = None
+        # The snapshot from the latest response, and the simulated time it
+        # arrived. See roversimulator.getSnapshot().
+        self.latestSnapshot = None
+        self.latestSnapshotTime = None
+        self.snapshotMaxAge = 0.02
+        self.lDir = 0
+        self.rDir = 0
+        self.pixels = [0] * self.numPixels
+        self.readerTask = asyncio.get_running_loop().create_task(self.readResponses())
+
+    # Connects to the simulator UI, which must be listening for the binary
+    # protocol at address, to drive the rover with the given ID (or the
+    # simulator's default rover).
+    @classmethod
+    async def connect(cls, address=roverprotocol.defaultAddress, clock=None, roverId=None):
+        (family, sockAddress) = roverprotocol.parseAddress(address)
+        if family == socket.AF_INET:
+            (host, port) = sockAddress
+            (reader, writer) = await asyncio.open_connection(host, port)
+            writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            (reader, writer) = await asyncio.open_unix_connection(sockAddress)
+        rover = cls(reader, writer, clock)
+        if roverId is not None:
+            await rover.sendFrame(roverprotocol.encodeFrame(roverprotocol.FRAME_SELECT, roverId.encode("utf-8")))
+        return rover
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.readerTask.cancel()
+
+    async def readResponses(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(roverprotocol.frameHeader.size)
+                (frameType, length) = roverprotocol.frameHeader.unpack(header)
+                body = await self.reader.readexactly(length)
+                if frameType == roverprotocol.FRAME_RESPONSE:
+                    response = roverprotocol.decodeResponse(body)
+                elif frameType == roverprotocol.FRAME_WAIT_RESPONSE:
+                    response = roverprotocol.decodeWaitResponse(body)
+                else:
+                    raise roverprotocol.ProtocolError("Expected a response, got frame type " + str(frameType))
+                future = self.pendingResponses.popleft()
+                if not future.cancelled():
+                    future.set_result(response)
+        except Exception as e:
+            # Nothing more is coming back on this connection, so anything
+            # still waiting for a response would wait forever.
+            while self.pendingResponses:
+                future = self.pendingResponses.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to simulator lost: " + repr(e)))
+
+    # Sends a message in the roversimui.py format, and returns the response.
+    # Inside a batch(), the message is held back until the batch ends (and
+    # this returns None).
+    async def sendToSimulator(self, message):
+        if self.pendingBatch != None:
+            mergeMessage(self.pendingBatch, message)
+            return None
+        return await self.sendNow(message)
+
+    # Returns a snapshot of the rover from the simulator, without changing
+    # anything (even inside a batch()).
+    async def querySimulator(self):
+        return await self.sendNow({})
+
+    # Returns the snapshot that came back with the latest response, if it's
+    # no more than snapshotMaxAge simulated seconds old, or else asks the
+    # simulator for a new one.
+    async def getSnapshot(self):
+        snapshot = self.latestSnapshot
+        if snapshot is not None and self.clock.time() - self.latestSnapshotTime <= self.snapshotMaxAge:
+            return snapshot
+        return await self.querySimulator()
+
+    async def sendNow(self, message):
+        return await self.sendFrame(roverprotocol.encodeCommand(message))
+
+    # Returns the response once the simulator says the rover has done what
+    # message describes. See roversimulator.waitForSimulator(). Commands
+    # sent on this connection after this one aren't applied until the wait
+    # is over.
+    async def waitForSimulator(self, message):
+        if self.pendingBatch != None:
+            raise RuntimeError("Can't wait for the simulator inside a batch()")
+        return await self.sendFrame(roverprotocol.encodeWait(message))
+
+    async def sendFrame(self, frame):
+        future = asyncio.get_running_loop().create_future()
+        self.pendingResponses.append(future)
+        self.writer.write(frame)
+        response = await future
+        self.latestSnapshot = response
+        self.latestSnapshotTime = self.clock.time()
+        return response
+
+    # Collects everything sent inside it into one message, sent when the
+    # batch ends. See roversimulator.batch().
+    @asynccontextmanager
+    async def batch(self):
+        if self.pendingBatch != None:
+            yield
+            return
+        self.pendingBatch = {}
+        try:
+            yield
+        except:
+            self.pendingBatch = None
+            raise
+        message = self.pendingBatch
+        self.pendingBatch = None
+        if message:
+            await self.sendToSimulator(message)
+
+    async def sleep(self, seconds):
+        await self.clock.sleepAsync(seconds)
+
+    #======================================================================
+    # General Functions
+
+    async def init(self, brightness=0, PiBit=False):
+        pass
+
+    async def cleanup(self):
+        await self.stop()
+
+    # End of General Functions
+    #======================================================================
+
+    #======================================================================
+    # Motor Functions
+
+    # Gives the motors time to stop before changing direction. Only this
+    # rover's commands wait; everything else on the event loop carries on.
+    async def brakeBeforeChangingDirection(self):
+        await self.brake()
+        if self.pendingBatch == None:
+            await self.sleep(0.2)
+
+    async def setMotors(self, left, right, lDir, rDir):
+        self.lDir = lDir
+        self.rDir = rDir
+        return await self.sendToSimulator({ 'wheelMotors': { 'l': left, 'r': right }})
+
+    async def stop(self):
+        return await self.setMotors([0, 0], [0, 0], 0, 0)
+
+    async def brake(self):
+        return await self.setMotors([0, 0], [0, 0], 0, 0)
+
+    async def forward(self, speed):
+        if (self.lDir == -1 or self.rDir == -1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([speed, 0], [speed, 0], 1, 1)
+
+    async def reverse(self, speed):
+        if (self.lDir == 1 or self.rDir == 1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([0, speed], [0, speed], -1, -1)
+
+    async def spinLeft(self, speed):
+        if (self.lDir == 1 or self.rDir == -1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([0, speed], [speed, 0], -1, 1)
+
+    async def spinRight(self, speed):
+        if (self.lDir == -1 or self.rDir == 1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([speed, 0], [0, speed], 1, -1)
+
+    async def turnForward(self, leftSpeed, rightSpeed):
+        if (self.lDir == -1 or self.rDir == -1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([leftSpeed, 0], [rightSpeed, 0], 1, 1)
+
+    async def turnReverse(self, leftSpeed, rightSpeed):
+        if (self.lDir == 1 or self.rDir == 1):
+            await self.brakeBeforeChangingDirection()
+        return await self.setMotors([0, leftSpeed], [0, rightSpeed], -1, -1)
+
+    # End of Motor Functions
+    #======================================================================
+
+    #======================================================================
+    # Wheel Sensor Functions
+    #
+    # The simulator stops each motor when it reaches its encoder target. See
+    # roversimulator.stepForward() and friends.
+
+    async def stopL(self):
+        return await self.sendToSimulator({ 'wheelMotors': { 'l': [100, 100] }})
+
+    async def stopR(self):
+        return await self.sendToSimulator({ 'wheelMotors': { 'r': [100, 100] }})
+
+    async def stepMotors(self, move, speed, counts):
+        await self.sendToSimulator({ 'encoderTargets': { 'l': counts, 'r': counts }})
+        await move(speed)
+        return await self.waitForSimulator({ 'encoderTargets': True })
+
+    async def stepForward(self, speed, counts):
+        return await self.stepMotors(self.forward, speed, counts)
+
+    async def stepReverse(self, speed, counts):
+        return await self.stepMotors(self.reverse, speed, counts)
+
+    async def stepSpinL(self, speed, counts):
+        return await self.stepMotors(self.spinLeft, speed, counts)
+
+    async def stepSpinR(self, speed, counts):
+        return await self.stepMotors(self.spinRight, speed, counts)
+
+    # End of Wheel Sensor Functions
+    #======================================================================
+
+    #======================================================================
+    # Wait Functions
+    #
+    # See roversimulator.waitUntilTravelled() and friends.
+
+    async def waitUntilTravelled(self, distanceCm, timeout=None):
+        return (await self.waitForSimulator({ 'distanceCm': distanceCm, 'timeout': timeout }))['met']
+
+    async def waitUntilTurned(self, degrees, timeout=None):
+        return (await self.waitForSimulator({ 'headingChangeDegrees': degrees, 'timeout': timeout }))['met']
+
+    async def waitUntilRangeBelow(self, rangeCm, timeout=None):
+        return (await self.waitForSimulator({ 'rangeBelowCm': rangeCm, 'timeout': timeout }))['met']
+
+    # End of Wait Functions
+    #======================================================================
+
+    #======================================================================
+    # IR Sensor Functions
+
+    async def irLeft(self):
+        return (await self.getSnapshot())['irLeft']
+
+    async def irRight(self):
+        return (await self.getSnapshot())['irRight']
+
+    async def irAll(self):
+        return (await self.getSnapshot())['irAll']
+
+    async def irLeftLine(self):
+        return (await self.getSnapshot())['irLeftLine']
+
+    async def irRightLine(self):
+        return (await self.getSnapshot())['irRightLine']
+
+    # All of the IR sensors at once, in one trip to the simulator. See
+    # roversimulator.readIrSensors().
+    async def readIrSensors(self):
+        readings = await self.getSnapshot()
+        return { name: readings[name] for name in ('irLeft', 'irRight', 'irAll', 'irLeftLine', 'irRightLine') }
+
+    # End of IR Sensor Functions
+    #======================================================================
+
+    #======================================================================
+    # UltraSonic Functions
+
+    async def getDistance(self):
+        response = await self.getSnapshot()
+        return response['ultrasonicRange']
+
+    # End of UltraSonic Functions
+    #======================================================================
+
+    #======================================================================
+    # RGB LED Functions
+    #
+    # As with the real rover, setColor, setPixel, clear and rainbow only
+    # change the LED array. show() sends it to the simulator.
+
+    async def setColor(self, color):
+        for i in range(self.numPixels):
+            await self.setPixel(i, color)
+
+    async def setPixel(self, ID, color):
+        if (ID < self.numPixels):
+            self.pixels[ID] = color
+
+    async def show(self):
+        rgbLeds = {}
+        for i in range(self.numPixels):
+            rgbLeds[i] = list(toRGB(self.pixels[i]))
+        return await self.sendToSimulator({ 'rgbLeds': rgbLeds })
+
+    async def clear(self):
+        for i in range(self.numPixels):
+            await self.setPixel(i, 0)
+
+    async def rainbow(self):
+        for x in range(self.numPixels):
+            await self.setPixel(x, int(wheel(x * 256 / self.numPixels)))
+
+    # End of RGB LED Functions
+    #======================================================================
+
+    #======================================================================
+    # Servo Functions
+
+    async def setServo(self, Servo, Degrees):
+        return await self.sendToSimulator({ 'servos': { Servo: Degrees }})
+
+    # End of Servo Functions
+    #======================================================================
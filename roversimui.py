@@ -5,12 +5,18 @@
 # if the virtual rover is set in motion, it will continue to move until further
 # instructions are sent telling it to stop.
 #
+# The model itself lives in roverengine.py, which has no dependency on Qt or
+# Flask. This program feeds incoming messages into it, and draws the rover
+# wherever the model says it is.
+#
 # This receives incoming HTTP requests to control the rover. Incoming messages
-# are in JSON form. The following properties may be set in the top-level
-# message:
+# are in JSON form. (The same messages can also be sent in binary form over a
+# persistent socket connection, which is much quicker - see roverprotocol.py.)
+# The following properties may be set in the top-level message:
 #   wheelMotors
 #   servos
 #   rgbLeds
+#   encoderTargets
 #
 # A request setting both might look like this:
 # {
@@ -42,260 +48,257 @@
 # There are 16 servo outputs, although with a standard setup only 5 are used.
 # Any servos not specified in the message will not have their positions
 # changed.
+# encoderTargets ({ "l": 30, "r": 30 }) makes each motor listed stop by
+# itself after its wheel encoder has counted that many more times, like the
+# real rover's stepForward() and friends.
 #
 # The response is always of the same format (even if the request is empty):
+# a snapshot of the rover just after the message was applied (see
+# roverengine.Rover.snapshot()), e.g.
 # {
-#   "ultrasonicRange": 80
+#   "time": 12.3,
+#   "vehicleXcm": 10.5,
+#   "vehicleYcm": 42.0,
+#   "vehicleHeadingDegrees": 90.0,
+#   "speedL": 100,
+#   "speedR": 100,
+#   "ultrasonicRange": 80,
+#   "irLeft": false,
+#   ...
 # }
 #
-# This reports the detected range from the ultrasonic sensor.
+# ultrasonicRange is the detected range from the ultrasonic sensor, in cm,
+# or 0 if there's nothing in range. Start this with --world to give the
+# sensors something to detect (see roverworld.py).
+#
+# GET /telemetry is a stream of Server-Sent Events, each a JSON snapshot of
+# the rover's state (see roverengine.Rover.snapshot()), sent --telemetry-rate
+# times a second for as long as the client stays connected. Any number of
+# clients can listen at once.
+#
+# A request to /wait, with a message describing something to wait for (see
+# roverengine.WaitCondition), e.g. { "encoderTargets": true }, isn't answered
+# until the rover has done it. The response is as above, plus "met", which is
+# false if the wait timed out.
    
 import sys
-import math
-from time import time
 import json
-
-from PyQt6.QtCore import QThread, QObject, QTimer, pyqtSignal, QRectF, Qt
-from PyQt6.QtWidgets import QApplication, QLabel, QWidget, QGraphicsScene, QGraphicsView,QGraphicsRectItem, QGraphicsItemGroup, QGraphicsPixmapItem
+import argparse
+import logging
+import threading
+import collections
+from time import monotonic, sleep
+
+from PyQt6.QtCore import QThread, QObject, QTimer, QRectF, Qt
+from PyQt6.QtWidgets import QApplication, QLabel, QWidget, QGraphicsScene, QGraphicsView, QGraphicsItem, QGraphicsRectItem, QGraphicsItemGroup, QGraphicsPixmapItem
 from PyQt6.QtGui import QPixmap, QTransform, QColor, QPen, QBrush
 
-from flask import Flask, request
-
-# Servo assignments
-servo_FL = 9
-servo_FR = 15
-servo_RL = 11
-servo_RR = 13
-servo_MA = 0
+from flask import Flask, Response, request
+
+import roverengine
+from roverengine import Rover, RoverCommand, WaitCondition, InvalidCommand, servo_FL, servo_FR, servo_RL, servo_RR
+import simclock
+import roverprotocol
+import trajectory
+import commandlog
+import roverworld
+
+# Keeps the most recent messages in memory, rather than printing every one
+# (which, at high message rates, takes longer than simulating them). Printing
+# is limited to echoPerSecond messages each second; anything more is just
+# counted. The messages themselves are only turned into text if they are
+# printed or looked at.
+class MessageLog:
+    def __init__(self, capacity=1000, echoPerSecond=5):
+        self.entries = collections.deque(maxlen=capacity) if capacity > 0 else None
+        self.echoPerSecond = echoPerSecond
+        self.lock = threading.Lock()
+        self.echoWindowStart = 0
+        self.echoedInWindow = 0
+        self.notEchoedInWindow = 0
+
+    def record(self, source, command):
+        now = monotonic()
+        with self.lock:
+            if self.entries is not None:
+                self.entries.append((now, source, command))
+            if self.echoPerSecond <= 0:
+                return
+            if now - self.echoWindowStart >= 1:
+                if self.notEchoedInWindow > 0:
+                    print("(" + str(self.notEchoedInWindow) + " more messages not shown)")
+                self.echoWindowStart = now
+                self.echoedInWindow = 0
+                self.notEchoedInWindow = 0
+            if self.echoedInWindow < self.echoPerSecond:
+                self.echoedInWindow += 1
+                print(source + ": " + str(command))
+            else:
+                self.notEchoedInWindow += 1
+
+    # Returns the most recent messages (oldest first) as dictionaries.
+    def recent(self, count=None):
+        with self.lock:
+            entries = list(self.entries) if self.entries is not None else []
+        if count is not None:
+            entries = entries[-count:]
+        return [{ 'time': t, 'source': source, 'message': command.toMessage() } for (t, source, command) in entries]
+
+# Sends snapshots of the rover's state to any number of subscribers, as
+# Server-Sent Events. Each snapshot is taken and turned into text just once,
+# however many subscribers there are, and a subscriber that falls behind
+# skips to the latest snapshot rather than building up a backlog. Nothing
+# is taken while nobody is subscribed.
+class TelemetryBroadcaster:
+    def __init__(self, takeSnapshot, ratePerSecond=10):
+        self.takeSnapshot = takeSnapshot
+        self.ratePerSecond = ratePerSecond
+        self.condition = threading.Condition()
+        self.subscriberCount = 0
+        # The latest event, and how many there have been.
+        self.event = None
+        self.eventCount = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-showSteeringCalcs = False
+    def run(self):
+        nextTime = monotonic()
+        while True:
+            with self.condition:
+                while self.subscriberCount == 0:
+                    self.condition.wait()
+            event = ("data: " + json.dumps(self.takeSnapshot()) + "\n\n").encode("utf-8")
+            with self.condition:
+                self.event = event
+                self.eventCount += 1
+                self.condition.notify_all()
+            # Keep to the rate, however long taking the snapshot took.
+            nextTime = max(nextTime + 1 / self.ratePerSecond, monotonic())
+            sleep(max(0, nextTime - monotonic()))
+
+    # Yields each new event for as long as the subscriber keeps reading.
+    def subscribe(self):
+        with self.condition:
+            self.subscriberCount += 1
+            self.condition.notify_all()
+            seen = self.eventCount
+        try:
+            while True:
+                with self.condition:
+                    while self.eventCount == seen:
+                        self.condition.wait()
+                    seen = self.eventCount
+                    event = self.event
+                yield event
+        finally:
+            with self.condition:
+                self.subscriberCount -= 1
 
 # Receives requests
 class ServerWorker(QObject):
-    mysignal = pyqtSignal(str)
     http_server = Flask("RoverSimUi")
 
+    def __init__(self, handleCommand, handleWait, messageLog, telemetryFor, snapshots):
+        QObject.__init__(self)
+        self.handleCommand = handleCommand
+        self.handleWait = handleWait
+        self.messageLog = messageLog
+        self.telemetryFor = telemetryFor
+        self.snapshots = snapshots
+
     def run(self):
+        # Flask logs every request otherwise, which costs more than handling it.
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
         self.http_server.route('/', methods=['POST'])(self.result)
+        self.http_server.route('/wait', methods=['POST'])(self.wait)
+        self.http_server.route('/log', methods=['GET'])(self.log)
+        self.http_server.route('/telemetry', methods=['GET'])(self.telemetryStream)
+        self.http_server.route('/rovers', methods=['GET'])(self.rovers)
+        self.http_server.route('/rovers/<roverId>/', methods=['POST'])(self.result)
+        self.http_server.route('/rovers/<roverId>/wait', methods=['POST'])(self.wait)
+        self.http_server.route('/rovers/<roverId>/telemetry', methods=['GET'])(self.telemetryStream)
         self.http_server.run(port=8523)
 
-    def result(self): #, *args, **kwargs):
-        bodyText = json.dumps(request.json)
-        print(request.data)
-        self.mysignal.emit(bodyText)
-        return request.data
-
-fullSpeedCmPerSecond = 9
-
-class Rover:
-    vehicleWidthCm = 16
-    vehicleHeightCm = 18
-    distanceBetweenWheelPairsCm = 8
-    timeOfLastUpdate = time()
-    vehicleXcm = 0
-    vehicleYcm = 0
-    vehicleHeadingDegrees = 0
-    speedL = 0
-    speedR = 0
-    servos = [0] * 16
-    rgbLeds = [[0,0,0]] * 4
-
-    def setServo(self, servoId, value):
-        self.servos[servoId] = value
-
-    def setWheelMotorLeft(self, fwd, rev):
-        if fwd > 0 and rev > 0:
-            self.speedL = 0
-        else:
-            self.speedL = fwd - rev
-
-    def setWheelMotorRight(self, fwd, rev):
-        if fwd > 0 and rev > 0:
-            self.speedR = 0
-        else:
-            self.speedR = fwd - rev
-
-    def setRgbLed(self, ledId, rgbValues):
-        self.rgbLeds[ledId] = rgbValues
-    
-    def updateState(self):
-        currentTime = time()
-        timeSinceLastUpdate = currentTime - self.timeOfLastUpdate
-        self.timeOfLastUpdate = currentTime
-
-        # Working out the direction and distance of travel is surprisingly
-        # complex, not least because there's no guarantee that all 4 steerable
-        # wheels are working together - they could be fighting one another.
-        # There are a few ways we could try to work it out:
-        #   1. an idealised model in which we presume the wheels cannot slip
-        #       sideways and work out the rotation and direction of travel
-        #   2. determine the resultant force and moment on the rover by
-        #       considering the forces from all 6 driven wheels.
-        #   3. work out where each wheel is trying to travel and by how much,
-        #       and then average these to work out the net motion and
-        #       separately calculate the rotation
-        # With 1, we can do this one steerable wheel at a time. If the
-        # steerable wheel is pointing dead ahead, then it won't be attempting
-        # to turn - it will just be trying to push forwards or backwards. But
-        # if it is not dead ahead, then it will be attempting to steer. The two
-        # fixed middle wheels constrain it to turn around a point somewhere
-        # along the imaginary line joining those two wheels together. We need
-        # to calculate the size of that turning circle, because from that, we
-        # can calculate the rate of turn for a given speed.
-        # We have the angle and also the length of the 'opposite' (the distance
-        # between the middle and front wheel), and we want the radius.
-        # r*sin(a) = opp, so r = opp/(sin(a))
-
-        def calculateSteeredPosition(left, front, wheelAngleRelativeToVehicleDegrees, wheelSpeed, dt):
-            # The motor speed is just a number from 0 (not moving)
-            # to 100 (full speed). We need to convert that to an
-            # actual speed:
-            wheelSpeedCmPerSecond = wheelSpeed / 100.0 * fullSpeedCmPerSecond
-
-            if wheelAngleRelativeToVehicleDegrees == 0:
-                # We're moving in a straight line, so we just need to work
-                # out what that means given the way we're facing
-                headingInRadians = (self.vehicleHeadingDegrees / 180.0) * math.pi
-
-                distanceMovedCmSinceLastUpdate = wheelSpeedCmPerSecond * dt 
-                xChangeCm = distanceMovedCmSinceLastUpdate * math.sin(headingInRadians)
-                yChangeCm = distanceMovedCmSinceLastUpdate * math.cos(headingInRadians)
-                headingChangeDegrees = 0
-
-                updatedVehicleX = self.vehicleXcm + xChangeCm
-                updatedVehicleY = self.vehicleYcm + yChangeCm
-            else:
-                # Trying to steer
-                wheelDistanceFromCentreX = self.vehicleWidthCm / 2
-                steerablePosRelativeToRoverX = -wheelDistanceFromCentreX if left else wheelDistanceFromCentreX
-                steerablePosRelativeToRoverY = self.distanceBetweenWheelPairsCm if front else self.distanceBetweenWheelPairsCm
-                distanceBetweenWheelsCm = steerablePosRelativeToRoverY
-
-                wheelAngleRelativeToVehicleRadians = (wheelAngleRelativeToVehicleDegrees / 180.0) * math.pi
-                turningRadiusToSteerableWheelCm = distanceBetweenWheelsCm / math.sin(wheelAngleRelativeToVehicleRadians)
-                circumferenceCm = 2*math.pi*turningRadiusToSteerableWheelCm
-
-                # Now work out the rate of turn, then the amount of turn given the time difference
-                revolutionsPerSecond = wheelSpeedCmPerSecond / circumferenceCm
-                revolutionsTurned = revolutionsPerSecond * dt
-                headingChangeDegrees = revolutionsTurned * 360
-                headingChangeRadians = revolutionsTurned * 2 * math.pi
-
-                # Now work out the turning circle centre.
-                turningCircleCentreDistanceFromVehicleCentre = math.cos(wheelAngleRelativeToVehicleRadians) * turningRadiusToSteerableWheelCm - steerablePosRelativeToRoverX
-                vehicleHeadingRadians = math.radians(self.vehicleHeadingDegrees)
-                turningCircleRelativeToVehicleX = turningCircleCentreDistanceFromVehicleCentre * math.cos(-vehicleHeadingRadians)
-                turningCircleRelativeToVehicleY = turningCircleCentreDistanceFromVehicleCentre * math.sin(-vehicleHeadingRadians)
-                turningCircleX = turningCircleRelativeToVehicleX + self.vehicleXcm
-                turningCircleY = turningCircleRelativeToVehicleY + self.vehicleYcm
-
-                if showSteeringCalcs:
-                    print("Turning circle centre: " + str([int(turningCircleX),int(turningCircleY)]))
-                
-
-                # Work out where vehicle will go as it moves around the turning circle
-                currentAngleOnTurningCircleRadians = math.atan2(self.vehicleYcm - turningCircleY, self.vehicleXcm - turningCircleX)
-                updatedAngleOnTurningCircleRadians = currentAngleOnTurningCircleRadians - headingChangeRadians
-                updatedVehicleX = turningCircleX + abs(turningCircleCentreDistanceFromVehicleCentre) * math.cos(updatedAngleOnTurningCircleRadians)
-                updatedVehicleY = turningCircleY + abs(turningCircleCentreDistanceFromVehicleCentre) * math.sin(updatedAngleOnTurningCircleRadians)
-
-            return [updatedVehicleX, updatedVehicleY, self.vehicleHeadingDegrees + headingChangeDegrees]
-
-        # We'll work out where each steerable wheel is attempting to push the rover.
-        # For spinning in place, we need to handle opposite wheel directions specially
-        if (self.speedL > 0 and self.speedR < 0) or (self.speedL < 0 and self.speedR > 0):
-            # Spinning in place
-            spinSpeed = max(abs(self.speedL), abs(self.speedR))
-            spinSpeedRadiansPerSecond = (spinSpeed / 100.0) * (36.0 * math.pi / 180.0)  # Full speed = 36 degrees per second
-            headingChange = spinSpeedRadiansPerSecond * timeSinceLastUpdate * (180.0 / math.pi)
-            if self.speedL < 0:  # Spinning left
-                headingChange = -headingChange
-            
-            self.vehicleHeadingDegrees += headingChange
-            # When spinning in place, position doesn't change
-            return
+    def result(self, roverId=None): #, *args, **kwargs):
+        try:
+            command = RoverCommand.fromMessage(request.get_json(silent=True))
+        except InvalidCommand as e:
+            return str(e), 400
+        response = self.handleCommand("http", command, roverId)
+        return json.dumps(response), 200, { 'Content-Type': 'application/json' }
+
+    # Long poll: this doesn't return until the wait is over. Each request
+    # has its own thread, so everything else carries on meanwhile.
+    def wait(self, roverId=None):
+        try:
+            condition = WaitCondition.fromMessage(request.get_json(silent=True))
+        except InvalidCommand as e:
+            return str(e), 400
+        response = self.handleWait("http", condition, roverId)
+        return json.dumps(response), 200, { 'Content-Type': 'application/json' }
+
+    def log(self):
+        count = request.args.get('count', type=int)
+        return json.dumps(self.messageLog.recent(count))
+
+    def telemetryStream(self, roverId=None):
+        return Response(self.telemetryFor(roverId).subscribe(), mimetype="text/event-stream",
+                        headers={ 'Cache-Control': 'no-cache' })
+
+    def rovers(self):
+        return json.dumps(self.snapshots()), 200, { 'Content-Type': 'application/json' }
+
+# Receives messages over the binary protocol in roverprotocol.py. These are
+# decoded straight into a RoverCommand, with no text involved.
+class SocketServerWorker(QObject):
+    def __init__(self, address, handleCommand, handleWait):
+        QObject.__init__(self)
+        self.address = address
+        self.handleCommand = handleCommand
+        self.handleWait = handleWait
 
-        # Normal movement calculation for non-spin cases
-        [updatedXFL, updatedYFL, updatedHeadingFL] = calculateSteeredPosition(True, True, self.servos[servo_FL], self.speedL, timeSinceLastUpdate)
-        [updatedXFR, updatedYFR, updatedHeadingFR] = calculateSteeredPosition(False, True, self.servos[servo_FR], self.speedR, timeSinceLastUpdate)
-        [updatedXBL, updatedYBL, updatedHeadingBL] = calculateSteeredPosition(True, False, self.servos[servo_RL], self.speedL, timeSinceLastUpdate)
-        [updatedXBR, updatedYBR, updatedHeadingBR] = calculateSteeredPosition(False, False, self.servos[servo_RR], self.speedR, timeSinceLastUpdate)
-
-        updatedXAverage = (updatedXFL + updatedXFR + updatedXBL + updatedXBR) / 4
-        updatedYAverage = (updatedYFL + updatedYFR + updatedYBL + updatedYBR) / 4
-        updatedHeadingAverage = (updatedHeadingFL + updatedHeadingFR + updatedHeadingBL + updatedHeadingBR) / 4
-
-        self.vehicleXcm = updatedXAverage
-        self.vehicleYcm = updatedYAverage
-        self.vehicleHeadingDegrees = updatedHeadingAverage
-
-        # # This is a bit too basic. We need to take into
-        # # account wheel servo orientation to work out how
-        # # much each side moves, and in which direction,
-        # # and to deduce the rotation of the rover from that.
-        # # But it will do for now.
-        # averageSpeed = (self.speedL + self.speedR) / 2
-
-        # # The motor speed is just a number from 0 (not moving)
-        # # to 100 (full speed). We need to convert that to an
-        # # actual speed:
-        # averageSpeedCmPerSecond = averageSpeed / 100.0 * fullSpeedCmPerSecond
-
-        # # The program probably won't manage to update at exactly the
-        # # same interval - when the computer's busy or running slowly for
-        # # some reason, there might be longer gaps between updates. So we
-        # # need to work out how far the rover will have travelled based
-        # # not just on its speed, but also on how long it has been since the
-        # # last update.
-        # distanceMovedCmSinceLastUpdate = averageSpeedCmPerSecond * timeSinceLastUpdate 
-        
-        # # Of course, the rover probably isn't heading exactly up/down/left/right,
-        # # so we can't just add the distance moved to vehicleXcm or vehicleYcm. We need to
-        # # work out how to split the distance between those two directions based on
-        # # the direction the rover is pointing. For this, we use trigonometry! Yay!
-        # # First, computers always want things in Radians, not Degrees, because reasons
-        # headingInRadians = (self.vehicleHeadingDegrees / 180) * math.pi
-        # xChangeCm = -distanceMovedCmSinceLastUpdate * math.sin(headingInRadians)
-        # yChangeCm = distanceMovedCmSinceLastUpdate * math.cos(headingInRadians)
-        # self.vehicleXcm += xChangeCm
-        # self.vehicleYcm += yChangeCm
-        if showSteeringCalcs:
-            print("X,Y: " + str(self.vehicleXcm) + ", " + str(self.vehicleYcm))
-            print("Heading: " + str(self.vehicleHeadingDegrees))
-
-
-class MainWindow(QWidget):
-    rover = Rover()
-    updateTimer = QTimer()
-
-    # Visualized Rover parts
-
-    # This is the whole Rover. All the parts (wheel, head) are attached to
-    # this, and will move with it.
-    visRoverGroup = QGraphicsItemGroup()
-
-    # Rotatable wheels
-    visRoverWheelFL = QGraphicsItemGroup()
-    visRoverWheelFR = QGraphicsItemGroup()
-    visRoverWheelBL = QGraphicsItemGroup()
-    visRoverWheelBR = QGraphicsItemGroup()
-
-    def __init__(self, parent=None):
-        QWidget.__init__(self, parent)
-
-        self.setWindowTitle("M.A.R.S. Rover")
-        self.setGeometry(100, 100, 750, 750)
-        # self.helloMsg = QLabel("<h1>Hello, World!</h1>", parent=self)
-        # self.helloMsg.move(60, 0)
+    def run(self):
+        server = roverprotocol.createServer(self.address, self.result, self.wait)
+        server.serve_forever()
+
+    def result(self, command, roverId=None):
+        return self.handleCommand("socket", command, roverId)
+
+    def wait(self, condition, roverId=None):
+        return self.handleWait("socket", condition, roverId)
+
+# The drawing of one rover: its body, and its steerable wheels, which turn
+# with the servos. Most of the time most rovers (often all of them) haven't
+# moved, so show() only touches the items whose state has changed since it
+# last drew them, and reuses the same transforms each time rather than
+# making new ones. If nothing has changed, Qt has nothing to redraw.
+class RoverGraphics:
+    normalBrush = QBrush(Qt.GlobalColor.lightGray)
+    collidingBrush = QBrush(Qt.GlobalColor.red)
+
+    def __init__(self, scene):
+        # This is the whole Rover. All the parts (wheel, head) are attached to
+        # this, and will move with it.
+        self.visRoverGroup = QGraphicsItemGroup()
+
+        # Rotatable wheels
+        self.visRoverWheelFL = QGraphicsItemGroup()
+        self.visRoverWheelFR = QGraphicsItemGroup()
+        self.visRoverWheelBL = QGraphicsItemGroup()
+        self.visRoverWheelBR = QGraphicsItemGroup()
 
         # roverImage = QPixmap("rover.png")
         # self.visRoverGroup.addToGroup(QGraphicsPixmapItem(roverImage))
-        vw = self.rover.vehicleWidthCm
-        vh = self.rover.vehicleHeightCm
+        vw = Rover.vehicleWidthCm
+        vh = Rover.vehicleHeightCm
         body = QGraphicsRectItem(QRectF(-vw/2, -vh/2, vw, vh))
         body.setPen(Qt.GlobalColor.black)
-        body.setBrush(Qt.GlobalColor.lightGray)
+        body.setBrush(self.normalBrush)
+        # The body only changes colour, so it's drawn once, in its own
+        # coordinates, and then just moved around.
+        body.setCacheMode(QGraphicsItem.CacheMode.ItemCoordinateCache)
         self.visRoverGroup.addToGroup(body)
+        self.visRoverBody = body
 
         # For each wheel, we create a QGraphicsItemGroup container that
         # is at a fixed position relative to the rover. This does not
@@ -311,6 +314,7 @@ class MainWindow(QWidget):
             wheel = QGraphicsRectItem(QRectF(-2, -4, 4, 8))
             wheel.setPen(Qt.GlobalColor.lightGray)
             wheel.setBrush(Qt.GlobalColor.black)
+            wheel.setCacheMode(QGraphicsItem.CacheMode.ItemCoordinateCache)
             wheelRotatingContainer.addToGroup(wheel)
 
             wheelNonRotatingContainer.addToGroup(wheelRotatingContainer)
@@ -322,16 +326,139 @@ class MainWindow(QWidget):
         makeWheel(False, True, self.visRoverWheelBL)
         makeWheel(False, False, self.visRoverWheelBR)
 
-        # tx = QTransform()
-        # tx.rotate(90)
-        # self.visRoverGroup.setTransform(tx)
+        scene.addItem(self.visRoverGroup)
+        # Keep the rover on top of anything in the world
+        self.visRoverGroup.setZValue(1)
+
+        # What was shown last time (None until the first time), and the
+        # transforms used to show it, which are reset and reused.
+        self.shownPose = None
+        self.shownWheelAngles = [None] * 4
+        self.shownColliding = False
+        self.roverTransform = QTransform()
+        self.wheels = [self.visRoverWheelFL, self.visRoverWheelFR, self.visRoverWheelBL, self.visRoverWheelBR]
+        self.wheelTransforms = [QTransform() for wheel in self.wheels]
+
+        # The rover's state after each of the last two physics updates, each
+        # (x, y, heading, wheelAngles, colliding). Frames are drawn in
+        # between the two (see showBetween()).
+        self.previousState = None
+        self.latestState = None
+        # Whether there's anything left to draw before the next update.
+        self.drawing = False
+
+    # Called with the rover's state after each physics update.
+    def setState(self, state):
+        self.previousState = self.latestState if self.latestState is not None else state
+        self.latestState = state
+        self.drawing = True
+
+    # Shows the rover the given fraction (0 to 1) of the way from its
+    # previous state to its latest. The wheels and the colour aren't part
+    # way between anything, so they're shown as they are in the latest.
+    def showBetween(self, fraction):
+        if not self.drawing:
+            return
+        (x0, y0, heading0, wheelAngles0, colliding0) = self.previousState
+        (x1, y1, heading1, wheelAngles, colliding) = self.latestState
+        # The engine never wraps the heading round, so this turns the way
+        # the rover did, however far that was.
+        self.show(x0 + (x1 - x0) * fraction, y0 + (y1 - y0) * fraction, heading0 + (heading1 - heading0) * fraction,
+                  wheelAngles, colliding)
+        if fraction >= 1 or (x0, y0, heading0) == (x1, y1, heading1):
+            self.drawing = False
+
+    # wheelAngles are the angles of the FL, FR, RL and RR servos.
+    def show(self, vehicleXcm, vehicleYcm, vehicleHeadingDegrees, wheelAngles, colliding):
+        pose = (vehicleXcm, vehicleYcm, vehicleHeadingDegrees)
+        if pose != self.shownPose:
+            tx = self.roverTransform
+            tx.reset()
+            # Negating Y because we're using the mathematical convention that increasing Y
+            # values go higher up the page, but the drawing system we're using has increasing
+            # Y values go down the screen.
+            tx.translate(vehicleXcm, -vehicleYcm)
+            tx.rotate(vehicleHeadingDegrees)
+            self.visRoverGroup.setTransform(tx)
+            self.shownPose = pose
+
+        for i in range(4):
+            if wheelAngles[i] != self.shownWheelAngles[i]:
+                tx = self.wheelTransforms[i]
+                tx.reset()
+                tx.rotate(wheelAngles[i])
+                self.wheels[i].setTransform(tx)
+                self.shownWheelAngles[i] = wheelAngles[i]
+
+        if colliding != self.shownColliding:
+            self.visRoverBody.setBrush(self.collidingBrush if colliding else self.normalBrush)
+            self.shownColliding = colliding
+
+class MainWindow(QWidget):
+    # The physics (bringing every rover up to date) and the drawing run on
+    # separate timers, so each can go at its own rate: the physics only as
+    # often as it needs to, and the drawing at the display's frame rate.
+    # Frames are drawn one physics update behind, part way between the last
+    # two, so the rovers move smoothly however rarely the physics runs.
+    updateTimer = QTimer()
+    renderTimer = QTimer()
+
+    # Any number of rovers can be simulated at once, each known by an ID
+    # (any string), which goes in the request path, or in a SELECT frame for
+    # the binary protocol. They're created as soon as anything is sent to
+    # them. Messages that don't say which rover they're for go to this one.
+    defaultRoverId = "default"
+
+    # Each new rover starts this far (in cm) to the side of the last, in a
+    # row either side of the first, facing up.
+    roverSpacingCm = 40
+
+    def __init__(self, clock=None, socketAddress=roverprotocol.defaultAddress, messageLog=None, integrator=None, telemetryRate=10,
+                 physicsRate=10, frameRate=60, parent=None):
+        QWidget.__init__(self, parent)
+        self.clock = clock if clock is not None else simclock.SimClock()
+        self.telemetryRate = telemetryRate
+        # Commands are applied to the model directly on the server threads
+        # (rather than being queued up for this window's thread), so the
+        # model must only be used while holding this.
+        self.modelLock = threading.Lock()
+        # Notified whenever the model has been brought up to date, so that
+        # anything waiting for the rover to do something can check whether
+        # it has.
+        self.modelUpdated = threading.Condition(self.modelLock)
+        self.messageLog = messageLog if messageLog is not None else MessageLog()
+
+        # All of the rovers, by ID. The default one is also self.rover, and
+        # new ones get their settings (integrator, world and so on) from it.
+        self.rovers = {}
+        self.rover = Rover(self.clock, integrator)
+        # Each physics update is one step of the simulation (in simulated
+        # time, so running with a time warp takes several), so a lower
+        # physicsRate means fewer steps as well as fewer updates.
+        self.rover.stepSeconds = 1 / physicsRate
+        self.rovers[self.defaultRoverId] = self.rover
+        # Graphics can only be created on this window's thread, so they're
+        # created for each rover the first time it is drawn.
+        self.roverGraphics = {}
+        self.telemetryBroadcasters = {}
+        # When (in real time) the last two physics updates happened.
+        self.previousUpdateTime = None
+        self.latestUpdateTime = None
+
+        self.setWindowTitle("M.A.R.S. Rover")
+        self.setGeometry(100, 100, 750, 750)
+        # self.helloMsg = QLabel("<h1>Hello, World!</h1>", parent=self)
+        # self.helloMsg.move(60, 0)
 
         scene = QGraphicsScene()
+        self.scene = scene
+        # The rovers move all the time and nothing else moves at all, so an
+        # index to find items by position would mostly be getting rebuilt.
+        scene.setItemIndexMethod(QGraphicsScene.ItemIndexMethod.NoIndex)
         scene.setSceneRect(QRectF(-200, -200, 400, 400))
-        scene.addRect(QRectF(-200, -150, 400, 300), QPen(QColor(100,0,0)), QBrush(QColor(99,66,0)))
+        self.floor = scene.addRect(QRectF(-200, -150, 400, 300), QPen(QColor(100,0,0)), QBrush(QColor(99,66,0)))
+        self.floor.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
         #self.scRover = scene.addPixmap(roverImage)
-        scene.addItem(self.visRoverGroup)
-        #self.scRover.setTransform(tx)
         self.roverIcon = QGraphicsView(scene, parent=self)
         self.roverIcon.move(0, 0)
         self.roverIcon.resize(720, 720)
@@ -340,67 +467,240 @@ class MainWindow(QWidget):
         # self.roverIcon.setPixmap(roverImage.transformed(tx))
         # self.roverIcon.resize(roverImage.width(), roverImage.height())
 
-        self.server = ServerWorker()
+        self.server = ServerWorker(self.handleCommand, self.handleWait, self.messageLog, self.telemetryFor, self.snapshots)
         self.serverThread = QThread()
         self.server.moveToThread(self.serverThread)
         self.serverThread.started.connect(self.server.run)
 
-        self.server.mysignal.connect(self.on_change) #, Qt.QueuedConnection)
-
         self.serverThread.start()
 
-        self.updateTimer.timeout.connect(self.on_update_timer)
-        self.updateTimer.start(100)
-
-    def on_change(self, s):
-        print(s)
-        data = json.loads(s)
-        if 'servos' in data:
-            servos = data['servos']
-            for servo in servos:
-                servoId = int(servo)
-                self.rover.setServo(servoId, servos[servo])
-
-        if 'wheelMotors' in data:
-            wheelMotors = data['wheelMotors']
-            if 'l' in wheelMotors:
-                [fwd, rev] = wheelMotors['l']
-                self.rover.setWheelMotorLeft(fwd, rev)
-            if 'r' in wheelMotors:
-                [fwd, rev] = wheelMotors['r']
-                self.rover.setWheelMotorRight(fwd, rev)
-
-        if 'rgbLeds' in data:
-            rgbLeds = data['rgbLeds']
-            for led in rgbLeds:
-                ledId = int(led)
-                self.rover.setRgbLed(ledId, rgbLeds[led])
-
-
-        # self.helloMsg.setText(s)
-        # self.scRover.setPos(data['location']['x'], data['location']['y'])
-        # tx = QTransform()
-        # tx.rotate(data['rotation'])
-        # self.scRover.setTransform(tx)
-        # #self.roverIcon.move(data['location']['x'], data['location']['y'])
+        if socketAddress:
+            self.socketServer = SocketServerWorker(socketAddress, self.handleCommand, self.handleWait)
+            self.socketServerThread = QThread()
+            self.socketServer.moveToThread(self.socketServerThread)
+            self.socketServerThread.started.connect(self.socketServer.run)
+            self.socketServerThread.start()
 
+        self.updateTimer.timeout.connect(self.on_update_timer)
+        self.updateTimer.start(round(1000 / physicsRate))
+        self.renderTimer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.renderTimer.timeout.connect(self.on_render_timer)
+        self.renderTimer.setInterval(round(1000 / frameRate))
+
+    # Returns the rover with the given ID (or the default rover if that's
+    # None), creating it if it doesn't exist yet. Must be called with the
+    # modelLock held.
+    def roverFor(self, roverId):
+        if roverId is None:
+            return self.rover
+        rover = self.rovers.get(roverId)
+        if rover is None:
+            rover = Rover(self.clock, self.rover.integrator, self.rover.substeps)
+            rover.stepSeconds = self.rover.stepSeconds
+            rover.fixedStep = self.rover.fixedStep
+            rover.world = self.rover.world
+            count = len(self.rovers)
+            rover.vehicleXcm = self.roverSpacingCm * ((count + 1) // 2) * (1 if count % 2 else -1)
+            self.rovers[roverId] = rover
+        return rover
+
+    # Gives the rovers a world to sense and bump into, and draws it. (Y is
+    # negated, as in RoverGraphics.)
+    def setWorld(self, world):
+        with self.modelLock:
+            for rover in self.rovers.values():
+                rover.world = world
+        if world.bounds is not None:
+            (xMin, yMin, xMax, yMax) = world.bounds
+            self.floor.setRect(QRectF(xMin, -yMax, xMax - xMin, yMax - yMin))
+            self.scene.setSceneRect(QRectF(xMin - 10, -yMax - 10, xMax - xMin + 20, yMax - yMin + 20))
+        # None of the world ever changes, so each part of it is drawn once
+        # and kept as a picture, and redrawing around a rover that has moved
+        # just copies from that.
+        items = []
+        linePen = QPen(Qt.GlobalColor.black, world.lineWidthCm)
+        for line in world.lines:
+            for (x1, y1, x2, y2) in roverworld.lineSegmentsOf(line):
+                items.append(self.scene.addLine(x1, -y1, x2, -y2, linePen))
+        obstaclePen = QPen(QColor(230, 230, 230))
+        obstacleBrush = QBrush(QColor(160, 160, 160))
+        for (xMin, yMin, xMax, yMax) in world.boxes:
+            items.append(self.scene.addRect(QRectF(xMin, -yMax, xMax - xMin, yMax - yMin), obstaclePen, obstacleBrush))
+        wallPen = QPen(QColor(230, 230, 230), world.wallThicknessCm)
+        for (x1, y1, x2, y2) in world.walls:
+            items.append(self.scene.addLine(x1, -y1, x2, -y2, wallPen))
+        for item in items:
+            item.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
+
+    # Called on the server threads with each incoming command. Returns the
+    # response.
+    def handleCommand(self, source, command, roverId=None):
+        with self.modelLock:
+            rover = self.roverFor(roverId)
+            # Bring the model up to date first, so that whatever it was
+            # doing before this command carries on right up until now.
+            rover.updateState()
+            rover.applyCommand(command)
+            response = rover.snapshot()
+            self.modelUpdated.notify_all()
+        self.messageLog.record(source if roverId is None else source + " " + roverId, command)
+        return response
+
+    # Called on the server threads with each incoming WaitCondition. Returns
+    # the response once the wait is over. The model only moves on when the
+    # update timer (or a command) updates it, and each time it does, this
+    # checks again, so there's no polling.
+    def handleWait(self, source, condition, roverId=None):
+        self.messageLog.record(source if roverId is None else source + " " + roverId, condition)
+        with self.modelUpdated:
+            rover = self.roverFor(roverId)
+            rover.updateState()
+            condition.start(rover)
+            self.modelUpdated.wait_for(lambda: condition.finished(rover))
+            response = rover.snapshot()
+            response['met'] = condition.met(rover)
+        return response
+
+    # Returns the telemetry for the given rover (see handleCommand), which
+    # is only set up once something subscribes to it.
+    def telemetryFor(self, roverId):
+        with self.modelLock:
+            rover = self.roverFor(roverId)
+            telemetry = self.telemetryBroadcasters.get(rover)
+            if telemetry is None:
+                telemetry = TelemetryBroadcaster(lambda: self.takeSnapshot(rover), self.telemetryRate)
+                self.telemetryBroadcasters[rover] = telemetry
+            return telemetry
+
+    # Called on the telemetry threads. The model is brought up to date
+    # first, so snapshots can be sent more often than the window updates.
+    def takeSnapshot(self, rover):
+        with self.modelLock:
+            rover.updateState()
+            self.modelUpdated.notify_all()
+            return rover.snapshot()
+
+    # Returns a snapshot of every rover, by ID.
+    def snapshots(self):
+        with self.modelLock:
+            for rover in self.rovers.values():
+                rover.updateState()
+            self.modelUpdated.notify_all()
+            return { roverId: rover.snapshot() for (roverId, rover) in self.rovers.items() }
+
+    # All of the rovers are brought up to date together, then drawn.
     def on_update_timer(self):
-        self.rover.updateState()
-        tx = QTransform()
-        # Negating Y because we're using the mathematical convention that increasing Y
-        # values go higher up the page, but the drawing system we're using has increasing
-        # Y values go down the screen.
-        tx.translate(self.rover.vehicleXcm, -self.rover.vehicleYcm)
-        tx.rotate(self.rover.vehicleHeadingDegrees)
-        self.visRoverGroup.setTransform(tx)
-
-        self.visRoverWheelFL.setTransform(QTransform().rotate(self.rover.servos[servo_FL]))
-        self.visRoverWheelFR.setTransform(QTransform().rotate(self.rover.servos[servo_FR]))
-        self.visRoverWheelBL.setTransform(QTransform().rotate(self.rover.servos[servo_RL]))
-        self.visRoverWheelBR.setTransform(QTransform().rotate(self.rover.servos[servo_RR]))
-
-app = QApplication([])
-
-window = MainWindow()
-window.show()
-sys.exit(app.exec())
+        with self.modelLock:
+            states = []
+            for (roverId, rover) in self.rovers.items():
+                rover.updateState()
+                servos = rover.servos
+                states.append((roverId, (rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees,
+                               (servos[servo_FL], servos[servo_FR], servos[servo_RL], servos[servo_RR]), rover.colliding)))
+            self.modelUpdated.notify_all()
+        self.previousUpdateTime = self.latestUpdateTime
+        self.latestUpdateTime = monotonic()
+        for (roverId, state) in states:
+            graphics = self.roverGraphics.get(roverId)
+            if graphics is None:
+                graphics = RoverGraphics(self.scene)
+                self.roverGraphics[roverId] = graphics
+            graphics.setState(state)
+        if not self.renderTimer.isActive():
+            self.renderTimer.start()
+
+    # Draws a frame. This only uses the states saved by on_update_timer, so
+    # it doesn't need the modelLock, and doesn't hold up the server threads.
+    def on_render_timer(self):
+        if self.latestUpdateTime is None:
+            return
+        if self.previousUpdateTime is None:
+            fraction = 1
+        else:
+            # How far through the physics update interval that has just
+            # finished the next frame should be, as that interval is about
+            # how long until the next update.
+            interval = self.latestUpdateTime - self.previousUpdateTime
+            fraction = min(1, (monotonic() - self.latestUpdateTime) / interval) if interval > 0 else 1
+        drawing = False
+        for graphics in self.roverGraphics.values():
+            graphics.showBetween(fraction)
+            drawing = drawing or graphics.drawing
+        if not drawing:
+            # Nothing is moving, so there's nothing to draw until the next
+            # physics update, which starts this again.
+            self.renderTimer.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="M.A.R.S. Rover Simulator UI")
+    parser.add_argument("--timewarp", type=float, default=1.0,
+                        help="how many times faster than real time to run the simulation")
+    parser.add_argument("--socket", default=roverprotocol.defaultAddress,
+                        help="where to listen for the binary protocol (tcp:host:port or unix:path), or none")
+    parser.add_argument("--integrator", choices=roverengine.integrators, default=Rover.integrator,
+                        help="how to work out the rover's motion (exact doesn't depend on the update rate)")
+    parser.add_argument("--substeps", type=int, default=Rover.substeps,
+                        help="how many parts to split each simulation step into")
+    parser.add_argument("--fixed-step", type=float, metavar="SECONDS",
+                        help="only ever move the rover in whole steps of this length")
+    parser.add_argument("--world", metavar="FILE",
+                        help="a world file (see roverworld.py) with things for the sensors to detect")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the rover's trajectory to this file (see trajectory.py)")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="capture every command received to this file (see commandlog.py)")
+    parser.add_argument("--log-size", type=int, default=1000,
+                        help="how many recent messages to keep (see http://127.0.0.1:8523/log)")
+    parser.add_argument("--log-echo", type=int, default=5,
+                        help="the most messages to print each second (0 for none)")
+    parser.add_argument("--telemetry-rate", type=float, default=10,
+                        help="how many snapshots a second to send to http://127.0.0.1:8523/telemetry")
+    parser.add_argument("--physics-rate", type=float, default=10,
+                        help="how many times a second to bring the rovers up to date, each a simulation step of 1/rate seconds (unless --fixed-step says otherwise)")
+    parser.add_argument("--fps", type=float, default=60,
+                        help="how many frames a second to draw")
+    args = parser.parse_args()
+    if args.timewarp == simclock.asFastAsPossible:
+        # Running as fast as possible only makes sense when nothing has to
+        # wait for a window to update. Use the in-process simulator for that.
+        parser.error("--timewarp must be finite")
+
+    app = QApplication([])
+
+    socketAddress = None if args.socket == "none" else args.socket
+    messageLog = MessageLog(args.log_size, args.log_echo)
+    if not args.telemetry_rate > 0:
+        parser.error("--telemetry-rate must be greater than 0")
+    if not args.substeps >= 1:
+        parser.error("--substeps must be at least 1")
+    if args.fixed_step is not None and not args.fixed_step > 0:
+        parser.error("--fixed-step must be greater than 0")
+    if not args.physics_rate > 0:
+        parser.error("--physics-rate must be greater than 0")
+    if not args.fps > 0:
+        parser.error("--fps must be greater than 0")
+    window = MainWindow(simclock.SimClock(args.timewarp), socketAddress, messageLog, args.integrator, args.telemetry_rate,
+                        args.physics_rate, args.fps)
+    window.rover.substeps = args.substeps
+    if args.fixed_step:
+        window.rover.stepSeconds = args.fixed_step
+        window.rover.fixedStep = True
+    if args.world:
+        window.setWorld(roverworld.load(args.world))
+    if args.record:
+        window.rover.recorder = trajectory.TrajectoryRecorder(args.record)
+    if args.capture:
+        window.rover.commandLog = commandlog.CommandLogWriter(args.capture, window.rover)
+    window.show()
+    exitCode = app.exec()
+    with window.modelLock:
+        recorder = window.rover.recorder
+        commandLog = window.rover.commandLog
+        window.rover.recorder = None
+        window.rover.commandLog = None
+        if commandLog:
+            commandLog.close()
+    if recorder:
+        recorder.close()
+    sys.exit(exitCode)
+
@@ -71,13 +71,279 @@
 #======================================================================
 
 import sys
-from time import sleep, time
-import requests
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+
+import simclock
 
 simulatorUiUrl = "http://127.0.0.1:8523/"
-# A session means that after the first connection, we should remain
-# connected to the simulator UI so it shouldn't be so slow
-requestSession = requests.Session()
+
+# All waiting done by this module goes through this clock, so a program
+# driving the simulator can run faster than real time. Set ROVERSIM_TIMEWARP
+# (e.g. to 10, or to max) to choose the time warp without changing any code;
+# in that case time.sleep and time.time are also replaced, so that existing
+# programs run on simulated time unmodified. (Run roversimui.py with the same
+# --timewarp so that the simulator keeps up.)
+clock = simclock.fromEnvironment()
+if os.environ.get("ROVERSIM_TIMEWARP"):
+    clock.install()
+
+# Sends messages to the simulator UI over HTTP. The message format is
+# described at the top of roversimui.py.
+class HttpTransport:
+    def __init__(self, url=simulatorUiUrl):
+        # Only needed when talking to the UI, so the in-process simulator
+        # works without it.
+        import requests
+        self.url = url
+        # A session means that after the first connection, we should remain
+        # connected to the simulator UI so it shouldn't be so slow
+        self.requestSession = requests.Session()
+
+    def send(self, message):
+        response = self.requestSession.post(self.url, json=message)
+        self.checkStatus(response)
+        return response.json()
+
+    # The simulator holds on to the request until the wait is over.
+    def wait(self, message):
+        response = self.requestSession.post(self.url + "wait", json=message)
+        self.checkStatus(response)
+        return response.json()
+
+    # Raises an HTTPError if the simulator rejected a message, with its
+    # reason (e.g. "Servo 99 is out of range") in the error.
+    def checkStatus(self, response):
+        import requests
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            raise requests.HTTPError(str(e) + ": " + response.text, response=response) from None
+
+# Sends messages to the simulator UI using the binary protocol described in
+# roverprotocol.py, over a connection that stays open.
+class SocketTransport:
+    def __init__(self, address, roverId=None):
+        import roverprotocol
+        self.connection = roverprotocol.Connection(address, roverId)
+
+    def send(self, message):
+        return self.connection.send(message)
+
+    def wait(self, message):
+        return self.connection.wait(message)
+
+# Runs the simulation model in this process, and applies messages to it
+# directly, with no HTTP, Qt or JSON involved. There is no window, but
+# you can look at rover to see where it has got to.
+class InProcessTransport:
+    def __init__(self, clock, integrator=None):
+        import roverengine
+        self.rover = roverengine.Rover(clock, integrator)
+
+    def send(self, message):
+        self.rover.updateState()
+        self.rover.applyMessage(message)
+        return self.rover.snapshot()
+
+    # Nothing else is going to move the rover on, so this does, sleeping
+    # until the next time the wait might be over (e.g. exactly when a motor
+    # will reach its encoder target) rather than polling.
+    def wait(self, message):
+        import roverengine
+        condition = roverengine.WaitCondition.fromMessage(message)
+        self.rover.updateState()
+        condition.start(self.rover)
+        while not condition.finished(self.rover):
+            if self.rover.speedL == 0 and self.rover.speedR == 0 and condition.timeout is None:
+                # Nothing else can move this rover, so it would never end.
+                raise RuntimeError("The rover isn't moving, so " + str(condition) + " would never finish")
+            before = self.progress(condition)
+            self.rover.clock.sleep(condition.secondsUntilCheck(self.rover))
+            self.rover.updateState()
+            if self.progress(condition) == before and condition.timeout is None and not condition.finished(self.rover):
+                # It's up against something, and with nothing else to move
+                # it, it will stay there.
+                raise RuntimeError("The rover is stuck, so " + str(condition) + " would never finish")
+        response = self.rover.snapshot()
+        response['met'] = condition.met(self.rover)
+        return response
+
+    # Everything that the condition could be waiting for depends on: where
+    # the rover is, and (for encoder targets) how far its wheels have turned,
+    # which they do even when it can't move.
+    def progress(self, condition):
+        rover = self.rover
+        pose = (rover.vehicleXcm, rover.vehicleYcm, rover.vehicleHeadingDegrees)
+        if condition.encoderTargets:
+            return pose + (rover.wheelDistanceLcm, rover.wheelDistanceRcm)
+        return pose
+
+# Wraps another transport, recording every message sent through it, with
+# the time it was sent, in a command log (see commandlog.py).
+class CapturingTransport:
+    def __init__(self, transport, clock, path):
+        import commandlog
+        self.transport = transport
+        self.clock = clock
+        self.writer = commandlog.CommandLogWriter(path)
+
+    def send(self, message):
+        import roverengine
+        self.writer.advanced(self.clock.time())
+        self.writer.applied(roverengine.RoverCommand.fromMessage(message))
+        return self.transport.send(message)
+
+    # Waiting doesn't change anything, so there's nothing to record.
+    def wait(self, message):
+        return self.transport.wait(message)
+
+    def close(self):
+        self.writer.close()
+
+# Wraps another transport so that sending a command doesn't wait for the
+# simulator: the command is queued, and a background thread sends it. If
+# commands arrive faster than they can be sent, newer values for a motor,
+# servo or LED replace older ones still waiting in the queue (there's no point
+# sending a servo position that has already been superseded), and everything
+# waiting is sent as one message.
+#
+# Messages that don't set anything (i.e., queries of sensors) need an answer,
+# so those wait for the queue to empty, and then go straight through.
+class QueuedTransport:
+    def __init__(self, transport):
+        self.transport = transport
+        self.condition = threading.Condition()
+        # Serialises use of the underlying transport between the sender
+        # thread and queries.
+        self.sendLock = threading.Lock()
+        self.pending = {}
+        self.sending = False
+        # depth is the number of motor, servo and LED values currently
+        # waiting. dropped counts values that were replaced before being
+        # sent.
+        self.depth = 0
+        self.maxDepth = 0
+        self.dropped = 0
+        self.sent = 0
+        # If sending fails, the sender thread carries on with whatever is
+        # queued next, and the exception is raised by the next send(),
+        # flush() or wait() instead.
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, message):
+        if not message:
+            self.flush()
+            with self.sendLock:
+                return self.transport.send(message)
+        with self.condition:
+            self.raiseError()
+            for key in message:
+                if isinstance(message[key], dict):
+                    waiting = self.pending.get(key, {})
+                    for item in message[key]:
+                        if item in waiting:
+                            self.dropped += 1
+                        else:
+                            self.depth += 1
+                elif key in self.pending:
+                    self.dropped += 1
+                else:
+                    self.depth += 1
+            self.maxDepth = max(self.maxDepth, self.depth)
+            mergeMessage(self.pending, message)
+            self.condition.notify_all()
+        return None
+
+    # Whatever is being waited for probably depends on the commands still
+    # in the queue, so those go first.
+    def wait(self, message):
+        self.flush()
+        with self.sendLock:
+            return self.transport.wait(message)
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.pending:
+                        self.condition.wait()
+                    message = self.pending
+                    self.pending = {}
+                    self.depth = 0
+                    self.sending = True
+                error = None
+                try:
+                    with self.sendLock:
+                        self.transport.send(message)
+                except Exception as e:
+                    error = e
+                with self.condition:
+                    self.sending = False
+                    if error is None:
+                        self.sent += 1
+                    else:
+                        self.error = error
+                    self.condition.notify_all()
+        finally:
+            # Make sure nothing is left waiting for a thread that has gone.
+            with self.condition:
+                self.sending = False
+                self.condition.notify_all()
+
+    # Raises the exception from a failed send, if there was one (once).
+    # Must be called with the condition held.
+    def raiseError(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    # Waits until everything queued has been sent.
+    def flush(self):
+        with self.condition:
+            while (self.pending or self.sending) and self.error is None and self.thread.is_alive():
+                self.condition.wait()
+            self.raiseError()
+            if self.pending and not self.thread.is_alive():
+                raise RuntimeError("The send queue has stopped sending")
+
+    def stats(self):
+        with self.condition:
+            return { 'depth': self.depth, 'maxDepth': self.maxDepth, 'dropped': self.dropped, 'sent': self.sent }
+
+# Where messages go. This is created on first use: set ROVERSIM_BACKEND to
+# socket to use the binary protocol instead of HTTP (ROVERSIM_ADDRESS says
+# where to connect, if not the default), or to inprocess to use the
+# in-process simulator instead of the UI (ROVERSIM_INTEGRATOR picks its
+# roverengine integrator, ROVERSIM_WORLD names a world file for its sensors
+# - see roverworld.py - and ROVERSIM_RECORD names a file to record its
+# trajectory to - see trajectory.py). Or call one of the use...()
+# functions below. Set ROVERSIM_CAPTURE to the name of a file to capture
+# every command sent (see captureCommands()), ROVERSIM_SENDQUEUE to 1 to
+# send through a QueuedTransport, and ROVERSIM_ROVER to the ID of the rover
+# in the simulator UI to drive (see useHttpSimulator()). With the in-process
+# simulator, ROVERSIM_RESULT names a file to write the rover's final state to
+# when the program ends (see writeResult()).
+transport = None
+
+# Every response from the simulator is a snapshot of the rover (see
+# roverengine.Rover.snapshot()). The latest one is kept, with the simulated
+# time it arrived, so that reading a sensor straight after a command doesn't
+# need another trip to the simulator. getSnapshot() uses it if it's no more
+# than snapshotMaxAge simulated seconds old (see setSnapshotMaxAge()).
+latestSnapshot = None
+latestSnapshotTime = None
+snapshotMaxAge = 0.02
+
+# While inside a batch(), messages are merged into this instead of being
+# sent straight away.
+pendingBatch = None
+batchDepth = 0
 
 
 # Define RGB LEDs
@@ -112,12 +378,264 @@ def cleanup():
     if (leds != None):
         clear()
         show()
+    flushSendQueue()
     #sleep(0.1)
     # GPIO.cleanup()
 
 # End of General Functions
 #======================================================================
 
+#======================================================================
+# Simulation Clock Functions
+#
+# sleep(seconds): Waits for the specified number of simulated seconds
+# time(): Returns the current simulated time in seconds
+# setTimeWarp(timeWarp): Sets how many times faster than real time the clock runs (simclock.asFastAsPossible for no waiting at all)
+
+def sleep(seconds):
+    clock.sleep(seconds)
+
+def time():
+    return clock.time()
+
+def setTimeWarp(timeWarp):
+    clock.setTimeWarp(timeWarp)
+
+# End of Simulation Clock Functions
+#======================================================================
+
+#======================================================================
+# Simulator Connection Functions
+#
+# useHttpSimulator(url, roverId): Sends commands to the simulator UI (the default)
+# useSocketSimulator(address, roverId): Sends commands to the simulator UI using the binary protocol (much faster than HTTP)
+# useInProcessSimulator(integrator): Simulates the rover in this process, and returns the roverengine.Rover
+# writeResult(path, rover): Writes an in-process rover's final state to a JSON file (done at exit when ROVERSIM_RESULT is set)
+# sendToSimulator(message): Sends a message in the roversimui.py format, and returns the response
+# querySimulator(): Returns a snapshot of the rover from the simulator, without changing anything (even inside a batch)
+# getSnapshot(): Returns the snapshot from the latest response, if recent enough, or else from querySimulator()
+# setSnapshotMaxAge(seconds): Sets how old (in simulated seconds) a snapshot getSnapshot() returns can be (0 to always ask)
+# subscribeTelemetry(url, roverId): Yields a snapshot of the simulator UI's rover (see roverengine.Rover.snapshot()) each time it sends one
+# waitForSimulator(message): Waits until the simulator says the rover has done what message describes (see roverengine.WaitCondition)
+# batch(): Context manager that collects all commands issued inside it into a single message
+# captureCommands(path): Records every command sent in a command log, for replaying with commandlog.py
+# useSendQueue(): Makes commands return immediately, sending them from a background thread
+# flushSendQueue(): Waits until all queued commands have been sent
+# sendQueueStats(): Returns the queue's depth, maxDepth, dropped and sent counts
+
+# The simulator UI can simulate many rovers at once, each with an ID (any
+# string you like). Give a roverId to drive that rover, rather than the UI's
+# default rover. It's created as soon as anything is sent to it.
+def useHttpSimulator(url=simulatorUiUrl, roverId=None):
+    global transport
+    transport = HttpTransport(roverUrl(url, roverId))
+
+def useSocketSimulator(address=None, roverId=None):
+    global transport
+    import roverprotocol
+    transport = SocketTransport(address or roverprotocol.defaultAddress, roverId)
+
+# Returns where to send HTTP requests for the rover with the given ID.
+def roverUrl(url, roverId):
+    if roverId is None:
+        return url
+    from urllib.parse import quote
+    return url + "rovers/" + quote(roverId, safe="") + "/"
+
+def useInProcessSimulator(integrator=None):
+    global transport
+    transport = InProcessTransport(clock, integrator)
+    return transport.rover
+
+# Sets up the transport picked by the environment variables, if nothing has
+# been chosen yet.
+def connectToSimulator():
+    if transport != None:
+        return
+    roverId = os.environ.get("ROVERSIM_ROVER")
+    backend = os.environ.get("ROVERSIM_BACKEND", "http").lower()
+    if backend == "inprocess":
+        rover = useInProcessSimulator(os.environ.get("ROVERSIM_INTEGRATOR"))
+        if os.environ.get("ROVERSIM_WORLD"):
+            import roverworld
+            rover.world = roverworld.load(os.environ["ROVERSIM_WORLD"])
+        if os.environ.get("ROVERSIM_RECORD"):
+            import trajectory
+            rover.recorder = trajectory.TrajectoryRecorder(os.environ["ROVERSIM_RECORD"])
+            atexit.register(rover.recorder.close)
+    elif backend == "socket":
+        useSocketSimulator(os.environ.get("ROVERSIM_ADDRESS"), roverId)
+    else:
+        useHttpSimulator(simulatorUiUrl, roverId)
+    if os.environ.get("ROVERSIM_CAPTURE"):
+        captureCommands(os.environ["ROVERSIM_CAPTURE"])
+    if os.environ.get("ROVERSIM_SENDQUEUE") == "1":
+        useSendQueue()
+    if backend == "inprocess" and os.environ.get("ROVERSIM_RESULT"):
+        # Registered last so that it runs first, before the capture and the
+        # recording are closed.
+        atexit.register(writeResult, os.environ["ROVERSIM_RESULT"], rover)
+
+# Writes the in-process rover's state, brought up to the current simulated
+# time, to a JSON file: a snapshot (see roverengine.Rover.snapshot()) plus
+# collisionCount. scenariorunner.py uses this to find out where each program
+# it runs left the rover.
+def writeResult(path, rover):
+    import json
+    flushSendQueue()
+    rover.updateState()
+    result = rover.snapshot()
+    result['collisionCount'] = rover.collisionCount
+    with open(path, "w") as f:
+        json.dump(result, f)
+
+def sendToSimulator(message):
+    if pendingBatch != None:
+        mergeMessage(pendingBatch, message)
+        return None
+    connectToSimulator()
+    return rememberSnapshot(transport.send(message))
+
+# Keeps the snapshot that came back with a response (if there was one: the
+# send queue doesn't wait for responses).
+def rememberSnapshot(response):
+    global latestSnapshot, latestSnapshotTime
+    if response is not None:
+        latestSnapshot = response
+        latestSnapshotTime = clock.time()
+    return response
+
+def getSnapshot():
+    snapshot = latestSnapshot
+    if snapshot is not None and clock.time() - latestSnapshotTime <= snapshotMaxAge:
+        return snapshot
+    return querySimulator()
+
+def setSnapshotMaxAge(seconds):
+    global snapshotMaxAge
+    snapshotMaxAge = seconds
+
+# With the in-process simulator, the log records everything that happens to
+# the rover, so replaying it ends up exactly where this program left the
+# rover. Otherwise it records what was sent and when, which replays to very
+# nearly (but not exactly) where the simulator UI put the rover. This has to
+# be called before useSendQueue(), if that's used.
+def captureCommands(path):
+    global transport
+    import commandlog
+    connectToSimulator()
+    if isinstance(transport, QueuedTransport):
+        raise RuntimeError("captureCommands() must be called before useSendQueue()")
+    if isinstance(transport, InProcessTransport):
+        writer = commandlog.CommandLogWriter(path, transport.rover)
+        transport.rover.commandLog = writer
+    else:
+        transport = CapturingTransport(transport, clock, path)
+        writer = transport.writer
+    # Anything still in the send queue has to go through the log before it's
+    # closed.
+    def finishCapture():
+        flushSendQueue()
+        writer.close()
+    atexit.register(finishCapture)
+
+def querySimulator():
+    connectToSimulator()
+    return rememberSnapshot(transport.send({}))
+
+# This opens its own connection to the simulator UI, so it can be used from
+# another thread (or another program) while this one drives the rover. E.g.:
+#
+#   for snapshot in rover.subscribeTelemetry():
+#       print(snapshot['vehicleXcm'], snapshot['vehicleYcm'])
+def subscribeTelemetry(url=simulatorUiUrl, roverId=None):
+    import json
+    import requests
+    with requests.get(roverUrl(url, roverId) + "telemetry", stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line.startswith(b"data: "):
+                yield json.loads(line[len(b"data: "):])
+
+# Returns the response once the wait is over, with 'met' False if it timed
+# out. Waiting inside a batch() would wait for commands that haven't been
+# sent, so that's not allowed.
+def waitForSimulator(message):
+    if pendingBatch != None:
+        raise RuntimeError("Can't wait for the simulator inside a batch()")
+    connectToSimulator()
+    return rememberSnapshot(transport.wait(message))
+
+# When the clock runs as fast as possible, sleeping takes no time at all, so
+# the sender thread would never get a chance to send anything before the
+# next command replaced it (forward() and then stop() a simulated minute
+# later would never get as far as forward()). So in that case, everything
+# queued is sent before each sleep.
+def useSendQueue():
+    global transport
+    connectToSimulator()
+    if not isinstance(transport, QueuedTransport):
+        transport = QueuedTransport(transport)
+        clock.beforeSleep = flushSendQueue
+
+def flushSendQueue():
+    if isinstance(transport, QueuedTransport):
+        transport.flush()
+
+def sendQueueStats():
+    if isinstance(transport, QueuedTransport):
+        return transport.stats()
+    return None
+
+# Without this, commands still in the queue when the program ends would be
+# lost, because the sender thread doesn't keep the program running.
+atexit.register(flushSendQueue)
+
+# Merges message into target. Where both set the same motor, servo or LED,
+# the value in message wins.
+def mergeMessage(target, message):
+    for key in message:
+        if key in target and isinstance(target[key], dict):
+            target[key].update(message[key])
+        elif isinstance(message[key], dict):
+            target[key] = dict(message[key])
+        else:
+            target[key] = message[key]
+
+# Everything sent inside a batch is collected up and sent as one message
+# when the batch ends, so the simulator applies it all at once. E.g.:
+#
+#   with rover.batch():
+#       rover.setServo(servo_FL, 0)
+#       rover.setServo(servo_FR, 0)
+#       rover.forward(50)
+#
+# sends a single message setting both servos and the motors. Batches can be
+# nested; the message is sent when the outermost one ends. If an exception
+# escapes from the batch, nothing is sent.
+@contextmanager
+def batch():
+    global pendingBatch, batchDepth
+    if batchDepth == 0:
+        pendingBatch = {}
+    batchDepth += 1
+    try:
+        yield
+    except:
+        batchDepth -= 1
+        if batchDepth == 0:
+            pendingBatch = None
+        raise
+    batchDepth -= 1
+    if batchDepth == 0:
+        message = pendingBatch
+        pendingBatch = None
+        if message:
+            sendToSimulator(message)
+
+# End of Simulator Connection Functions
+#======================================================================
+
 #======================================================================
 # Motor Functions
 #
@@ -131,7 +649,14 @@ def stop():
     lDir = 0
     rDir = 0
     message = { 'wheelMotors': { 'l': [0,0], 'r': [0,0] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
+
+# pauseAfterBrake(): Gives the motors time to stop before changing direction
+def pauseAfterBrake():
+    # Inside a batch, the brake just gets replaced by whatever comes next in
+    # the same message, so there's nothing to wait for.
+    if pendingBatch == None:
+        sleep(0.2)
 
 # brake(): Stops both motors - regenrative braking to stop quickly
 def brake():
@@ -143,14 +668,14 @@ def brake():
     lDir = 0
     rDir = 0
     message = { 'wheelMotors': { 'l': [0, 0], 'r': [0, 0] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # forward(speed): Sets both motors to move forward at speed. 0 <= speed <= 100
 def forward(speed):
     global lDir, rDir
     if (lDir == -1 or rDir == -1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(speed)
     # q.ChangeDutyCycle(0)
     # a.ChangeDutyCycle(speed)
@@ -160,14 +685,14 @@ def forward(speed):
     lDir = 1
     rDir = 1
     message = { 'wheelMotors': { 'l': [speed, 0], 'r': [speed, 0] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # reverse(speed): Sets both motors to reverse at speed. 0 <= speed <= 100
 def reverse(speed):
     global lDir, rDir
     if (lDir == 1 or rDir == 1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(0)
     # q.ChangeDutyCycle(speed)
     # a.ChangeDutyCycle(0)
@@ -177,14 +702,14 @@ def reverse(speed):
     lDir = -1
     rDir = -1
     message = { 'wheelMotors': { 'l': [0, speed], 'r': [0, speed] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # spinLeft(speed): Sets motors to turn opposite directions at speed. 0 <= speed <= 100
 def spinLeft(speed):
     global lDir, rDir
     if (lDir == 1 or rDir == -1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(0)
     # q.ChangeDutyCycle(speed)
     # a.ChangeDutyCycle(speed)
@@ -194,14 +719,14 @@ def spinLeft(speed):
     lDir = -1
     rDir = 1
     message = { 'wheelMotors': { 'l': [0, speed], 'r': [speed, 0] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # spinRight(speed): Sets motors to turn opposite directions at speed. 0 <= speed <= 100
 def spinRight(speed):
     global lDir, rDir
     if (lDir == -1 or rDir == 1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(speed)
     # q.ChangeDutyCycle(0)
     # a.ChangeDutyCycle(0)
@@ -211,7 +736,7 @@ def spinRight(speed):
     lDir = 1
     rDir = -1
     message = { 'wheelMotors': { 'l': [speed, 0], 'r': [0, speed] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 
 # turnForward(leftSpeed, rightSpeed): Moves forwards in an arc by setting different speeds. 0 <= leftSpeed,rightSpeed <= 100
@@ -219,7 +744,7 @@ def turnForward(leftSpeed, rightSpeed):
     global lDir, rDir
     if (lDir == -1 or rDir == -1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(leftSpeed)
     # q.ChangeDutyCycle(0)
     # a.ChangeDutyCycle(rightSpeed)
@@ -229,14 +754,14 @@ def turnForward(leftSpeed, rightSpeed):
     lDir = 1
     rDir = 1
     message = { 'wheelMotors': { 'l': [leftSpeed, 0], 'r': [rightSpeed, 0] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # turnReverse(leftSpeed, rightSpeed): Moves backwards in an arc by setting different speeds. 0 <= leftSpeed,rightSpeed <= 100
 def turnReverse(leftSpeed, rightSpeed):
     global lDir, rDir
     if (lDir == 1 or rDir == 1):
         brake()
-        sleep(0.2)
+        pauseAfterBrake()
     # p.ChangeDutyCycle(0)
     # q.ChangeDutyCycle(leftSpeed)
     # a.ChangeDutyCycle(0)
@@ -246,7 +771,7 @@ def turnReverse(leftSpeed, rightSpeed):
     lDir = -1
     rDir = -1
     message = { 'wheelMotors': { 'l': [0, leftSpeed], 'r': [0, rightSpeed] }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 # End of Motor Functions
 #======================================================================
@@ -254,116 +779,115 @@ def turnReverse(leftSpeed, rightSpeed):
 
 #======================================================================
 # Wheel Sensor Functions
+#
+# The simulator counts each wheel encoder's pulses as the wheels turn, and
+# stops each motor itself when it reaches its target (as the real rover's
+# interrupt handlers do), so these just wait to hear that both have. The
+# real rover.py asks for speed/20 fewer counts, because its motors take
+# that long to stop; the simulated ones stop dead, so they get the full
+# count.
+#
+# stopL(): Brakes the left motor
+# stopR(): Brakes the right motor
+# stepForward(speed, counts): Moves forward specified number of counts, then stops
+# stepReverse(speed, counts): Moves backward specified number of counts, then stops
+# stepSpinL(speed, counts): Spins left specified number of counts, then stops
+# stepSpinR(speed, counts): Spins right specified number of counts, then stops
 
 def stopL():
-    p.ChangeDutyCycle(100)
-    q.ChangeDutyCycle(100)
+    message = { 'wheelMotors': { 'l': [100, 100] }}
+    sendToSimulator(message)
 
 def stopR():
-    a.ChangeDutyCycle(100)
-    b.ChangeDutyCycle(100)
-
-    
-def lCounter(pin):
-    global countL, targetL
-    countL += 1
-    if countL == targetL:
-        stopL()
-        targetL = -1
-
-def rCounter(pin):
-    global countR, targetR
-    countR += 1
-    if countR == targetR:
-        stopR()
-        targetR = -1
-
-# stepForward(speed, steps): Moves forward specified number of counts, then stops
+    message = { 'wheelMotors': { 'r': [100, 100] }}
+    sendToSimulator(message)
+
+# Sets both encoder targets, runs the motors, and waits until both have
+# stopped. The targets go first, so that counting starts before the motors
+# do, just as the real rover.py zeroes its counts first.
+def stepMotors(move, speed, counts):
+    message = { 'encoderTargets': { 'l': counts, 'r': counts }}
+    sendToSimulator(message)
+    move(speed)
+    waitForSimulator({ 'encoderTargets': True })
+
 def stepForward(speed, counts):
-    global countL, countR, targetL, targetR
-    countL = 0
-    countR = 0
-    targetL = counts-(speed/20)
-    targetR = counts-(speed/20)
-    forward(speed)
-    while (targetL != -1) or (targetR != -1):
-        sleep(0.002)
-
-# stepReverse(speed, steps): Moves backward specified number of counts, then stops
+    stepMotors(forward, speed, counts)
+
 def stepReverse(speed, counts):
-    global countL, countR, targetL, targetR
-    countL = 0
-    countR = 0
-    targetL = counts-(speed/20)
-    targetR = counts-(speed/20)
-    reverse(speed)
-    while (targetL != -1) or (targetR != -1):
-        sleep(0.002)
-
-# stepSpinL(speed, steps): Spins left specified number of counts, then stops
+    stepMotors(reverse, speed, counts)
+
 def stepSpinL(speed, counts):
-    global countL, countR, targetL, targetR
-    countL = 0
-    countR = 0
-    targetL = counts-(speed/20)
-    targetR = counts-(speed/20)
-    spinLeft(speed)
-    while (targetL != -1) or (targetR != -1):
-        sleep(0.002)
-
-# stepSpinR(speed, steps): Spins right specified number of counts, then stops
+    stepMotors(spinLeft, speed, counts)
+
 def stepSpinR(speed, counts):
-    global countL, countR, targetL, targetR
-    countL = 0
-    countR = 0
-    targetL = counts-(speed/20)
-    targetR = counts-(speed/20)
-    spinRight(speed)
-    while (targetL != -1) or (targetR != -1):
-        sleep(0.002)
+    stepMotors(spinRight, speed, counts)
 
 
 # End of Wheel Sensor Functions
 #======================================================================
 
 
+#======================================================================
+# Wait Functions
+#
+# These aren't on the real rover. Rather than guessing how long to sleep to
+# go a certain distance, or asking over and over whether the rover has got
+# there yet, a program can ask the simulator to say when it has. Each
+# returns True once the rover has done it, or False if it took longer than
+# timeout simulated seconds (if given). The rover keeps doing whatever it
+# was doing either way. E.g.:
+#
+#   rover.forward(100)
+#   rover.waitUntilTravelled(100)
+#   rover.stop()
+#
+# waitUntilTravelled(distanceCm, timeout): Waits until the rover has travelled distanceCm further
+# waitUntilTurned(degrees, timeout): Waits until the rover's heading has changed by degrees (either way)
+# waitUntilRangeBelow(rangeCm, timeout): Waits until the ultrasonic sensor sees something closer than rangeCm
+
+def waitUntilTravelled(distanceCm, timeout=None):
+    return waitForSimulator({ 'distanceCm': distanceCm, 'timeout': timeout })['met']
+
+def waitUntilTurned(degrees, timeout=None):
+    return waitForSimulator({ 'headingChangeDegrees': degrees, 'timeout': timeout })['met']
+
+def waitUntilRangeBelow(rangeCm, timeout=None):
+    return waitForSimulator({ 'rangeBelowCm': rangeCm, 'timeout': timeout })['met']
+
+# End of Wait Functions
+#======================================================================
+
+
 #======================================================================
 # IR Sensor Functions
 #
 # irLeft(): Returns state of Left IR Obstacle sensor
 def irLeft():
-    # if GPIO.input(irFL)==0:
-        return True
-    # else:
-    #     return False
+    return getSnapshot()['irLeft']
 
 # irRight(): Returns state of Right IR Obstacle sensor
 def irRight():
-    # if GPIO.input(irFR)==0:
-        return True
-    # else:
-    #     return False
+    return getSnapshot()['irRight']
 
 # irAll(): Returns true if either of the Obstacle sensors are triggered
 def irAll():
-    # if GPIO.input(irFL)==0 or GPIO.input(irFR)==0:
-        return True
-    # else:
-    #     return False
+    return getSnapshot()['irAll']
 
 # irLeftLine(): Returns state of Left IR Line sensor
 def irLeftLine():
-    # if GPIO.input(lineLeft)==0:
-        return True
-    # else:
-    #     return False
+    return getSnapshot()['irLeftLine']
 
 # irRightLine(): Returns state of Right IR Line sensor
 def irRightLine():
-    # if GPIO.input(lineRight)==0:
-        return True
-    # else:
-    #     return False
+    return getSnapshot()['irRightLine']
+
+# readIrSensors(): Returns the state of all of the IR sensors at once, as a
+# dictionary with irLeft, irRight, irAll, irLeftLine and irRightLine. This
+# takes one trip to the simulator (at most), rather than one for each sensor.
+def readIrSensors():
+    readings = getSnapshot()
+    return { name: readings[name] for name in ('irLeft', 'irRight', 'irAll', 'irLeftLine', 'irRightLine') }
 
 # End of IR Sensor Functions
 #======================================================================
@@ -375,26 +899,7 @@ def irRightLine():
 # getDistance(). Returns the distance in cm to the nearest reflecting object. 0 == no object
 #
 def getDistance(): # default to front sensor
-    GPIO.setup(sonar, GPIO.OUT)
-    # Send 10us pulse to trigger
-    GPIO.output(sonar, True)
-    sleep(0.00001)
-    GPIO.output(sonar, False)
-    start = time.time()
-    count=time.time()
-    GPIO.setup(sonar,GPIO.IN)
-    while GPIO.input(sonar)==0 and time.time()-count<0.1:
-        start = time.time()
-    count=time.time()
-    stop=count
-    while GPIO.input(sonar)==1 and time.time()-count<0.1:
-        stop = time.time()
-    # Calculate pulse length
-    elapsed = stop-start
-    # Distance pulse travelled in that time is time
-    # multiplied by the speed of sound 34000(cm/s) divided by 2
-    distance = elapsed * 17000
-    return distance
+    return getSnapshot()['ultrasonicRange']
 
 # End of UltraSonic Functions
 #======================================================================
@@ -449,7 +954,7 @@ def wheel(pos):
 
 def setServo(Servo, Degrees):
     message = { 'servos': { Servo: Degrees }}
-    requestSession.post(simulatorUiUrl, json=message)
+    sendToSimulator(message)
 
 def stopServos():
     for i in range(16):
@@ -0,0 +1,407 @@
+# 4tronix M.A.R.S. Rover Simulator World
+#
+# The things around the rover that it can detect and bump into. A world is
+# loaded from a JSON file, with everything in cm, using the same coordinates
+# as roverengine (the rover starts at 0, 0 facing up the Y axis):
+#
+#   {
+#     "bounds": [-200, -150, 200, 150],
+#     "walls": [
+#       [-100, 50, 100, 50],
+#       [100, 50, 100, -50]
+#     ],
+#     "boxes": [
+#       [20, -80, 50, -60]
+#     ],
+#     "lines": [
+#       [0, 0, 0, 40, 30, 70, 80, 70]
+#     ]
+#   }
+#
+# bounds is the arena, [xMin, yMin, xMax, yMax]: the rover can't leave it.
+# Each wall is a straight line from (x1, y1) to (x2, y2), and each box is a
+# solid rectangle with opposite corners at (x1, y1) and (x2, y2). lines are
+# dark lines on the floor for the line sensors to follow, each going from
+# point to point: [x1, y1, x2, y2, x3, y3, ...]. All of these are optional.
+#
+# To find out what the ultrasonic sensor can see, a ray is cast out from it
+# until it hits a wall. So that this doesn't have to check every wall in the
+# world, each wall is recorded in a uniform grid of cells (cellSizeCm square)
+# against every cell it passes through. A ray then only has to look at the
+# walls in the cells it passes through, nearest first, and can stop as soon
+# as it hits something, so it costs about the same however many walls there
+# are in the world. (The edges of the arena and of each box count as walls
+# for this.)
+#
+# To find out whether the rover has bumped into anything, the world is also
+# drawn once, when it's loaded, into an occupancy grid: a bitmap with a byte
+# for each occupancyCellCm square, which is 1 where there's something solid
+# (walls are wallThicknessCm thick) and 0 elsewhere. Checking whether the
+# rover is touching anything is then just a matter of looking up the points
+# around its outline in that grid, which takes the same time however much is
+# in the world. The lines are drawn into a floor bitmap in the same way
+# (lineWidthCm wide), so each line sensor reading is a single lookup.
+
+import json
+import math
+
+class World:
+    # The size of the cells in the grid used to find walls quickly. Smaller
+    # cells mean fewer walls to check in each, but more cells to go through.
+    cellSizeCm = 25.0
+
+    # The size of the cells in the occupancy grid, and how thick walls are.
+    occupancyCellCm = 1.0
+    wallThicknessCm = 2.0
+
+    # The size of the cells in the floor bitmap, and how wide lines are.
+    floorCellCm = 0.5
+    lineWidthCm = 2.0
+
+    # How far apart the points checked around the rover's outline are. This
+    # is less than the thickness of a wall, so the rover can't slip through
+    # one between two points.
+    outlineSpacingCm = 1.0
+
+    def __init__(self, walls=(), boxes=(), bounds=None, lines=()):
+        # As given: each wall is (x1, y1, x2, y2), each box is (xMin, yMin,
+        # xMax, yMax), bounds is (xMin, yMin, xMax, yMax) or None, and each
+        # line is (x1, y1, x2, y2, ...).
+        self.walls = []
+        self.boxes = []
+        self.bounds = None
+        self.lines = [tuple(line) for line in lines]
+        # Every straight edge the ultrasonic sensor can see: the walls, and
+        # the edges of the boxes and the arena. Each is (x1, y1, x2, y2).
+        self.segments = []
+        # Maps (column, row) to a list of indexes into segments.
+        self.grid = {}
+        # The occupancy grid and floor bitmap, made by rasterise().
+        self.occupancy = None
+        self.floor = None
+        # The points around the outline of each size of rover that has been
+        # checked for collisions (see outline()).
+        self.outlines = {}
+
+        if bounds is not None:
+            (xMin, yMin, xMax, yMax) = bounds
+            self.bounds = (min(xMin, xMax), min(yMin, yMax), max(xMin, xMax), max(yMin, yMax))
+            self.addRectangleSegments(self.bounds)
+        for (x1, y1, x2, y2) in walls:
+            self.walls.append((x1, y1, x2, y2))
+            self.addSegment(x1, y1, x2, y2)
+        for (x1, y1, x2, y2) in boxes:
+            box = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+            self.boxes.append(box)
+            self.addRectangleSegments(box)
+        self.rasterise()
+
+    # Creates a world from the contents of a world file (see above).
+    @classmethod
+    def fromData(cls, data):
+        if not isinstance(data, dict):
+            raise ValueError("A world must be an object")
+        for key in data:
+            if key not in ('bounds', 'walls', 'boxes', 'lines'):
+                raise ValueError("Unknown world property '" + str(key) + "'")
+        bounds = data.get('bounds')
+        if bounds is not None:
+            bounds = readFourNumbers(bounds, "bounds must be [xMin, yMin, xMax, yMax]")
+        walls = [readFourNumbers(wall, "Walls must be [x1, y1, x2, y2]") for wall in data.get('walls', [])]
+        boxes = [readFourNumbers(box, "Boxes must be [x1, y1, x2, y2]") for box in data.get('boxes', [])]
+        lines = []
+        for line in data.get('lines', []):
+            if not isinstance(line, (list, tuple)) or len(line) < 4 or len(line) % 2 != 0:
+                raise ValueError("Lines must be [x1, y1, x2, y2, ...]")
+            lines.append([float(value) for value in line])
+        return cls(walls, boxes, bounds, lines)
+
+    # Turns this back into the contents of a world file.
+    def toData(self):
+        data = {
+            'walls': [list(wall) for wall in self.walls],
+            'boxes': [list(box) for box in self.boxes],
+            'lines': [list(line) for line in self.lines],
+        }
+        if self.bounds is not None:
+            data['bounds'] = list(self.bounds)
+        return data
+
+    def addRectangleSegments(self, rectangle):
+        (xMin, yMin, xMax, yMax) = rectangle
+        self.addSegment(xMin, yMin, xMax, yMin)
+        self.addSegment(xMax, yMin, xMax, yMax)
+        self.addSegment(xMax, yMax, xMin, yMax)
+        self.addSegment(xMin, yMax, xMin, yMin)
+
+    def addSegment(self, x1, y1, x2, y2):
+        index = len(self.segments)
+        self.segments.append((x1, y1, x2, y2))
+        length = math.hypot(x2 - x1, y2 - y1)
+        if length == 0:
+            cells = [self.cellAt(x1, y1)]
+        else:
+            cells = [cell for (cell, exitDistance) in self.cellsAlong(x1, y1, (x2 - x1) / length, (y2 - y1) / length, length)]
+        for cell in cells:
+            self.grid.setdefault(cell, []).append(index)
+
+    # Draws the world into the occupancy grid and the floor bitmap. These
+    # cover the arena, if there is one (everything outside it counts as
+    # occupied), or otherwise everything in the world (and everything
+    # outside that is empty).
+    def rasterise(self):
+        halfThickness = self.wallThicknessCm / 2
+        extent = self.extent(self.walls + self.boxes, halfThickness)
+        if extent is None:
+            self.occupancy = None
+        else:
+            self.occupancy = Raster(extent, self.occupancyCellCm, 1 if self.bounds is not None else 0)
+            for box in self.boxes:
+                self.occupancy.fillRectangle(box)
+            # (The edges of the arena don't need drawing, as everything
+            # outside counts as occupied.)
+            for wall in self.walls:
+                self.occupancy.drawLine(wall, halfThickness)
+
+        halfWidth = self.lineWidthCm / 2
+        lineSegments = [segment for line in self.lines for segment in lineSegmentsOf(line)]
+        extent = self.extent(lineSegments, halfWidth)
+        if not lineSegments or extent is None:
+            self.floor = None
+        else:
+            self.floor = Raster(extent, self.floorCellCm)
+            for segment in lineSegments:
+                self.floor.drawLine(segment, halfWidth)
+
+    # Returns the area a raster of the world needs to cover: the arena, if
+    # there is one, or otherwise the given things (walls, boxes or lines,
+    # each (x1, y1, x2, y2)), plus a margin. Returns None if there's nothing.
+    def extent(self, things, margin):
+        if self.bounds is not None:
+            return self.bounds
+        if not things:
+            return None
+        xs = [x for (x1, y1, x2, y2) in things for x in (x1, x2)]
+        ys = [y for (x1, y1, x2, y2) in things for y in (y1, y2)]
+        return (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+
+    # Returns whether there's something solid at (x, y).
+    def isOccupied(self, x, y):
+        return self.occupancy is not None and self.occupancy.valueAt(x, y) == 1
+
+    # Returns whether there's a line on the floor at (x, y).
+    def isOnLine(self, x, y):
+        return self.floor is not None and self.floor.valueAt(x, y) == 1
+
+    # Returns points (relative to the rover's centre, facing up the Y axis)
+    # all the way around the outline of a rover of the given size.
+    def outline(self, widthCm, lengthCm):
+        key = (widthCm, lengthCm)
+        if key not in self.outlines:
+            points = []
+            halfWidth = widthCm / 2
+            halfLength = lengthCm / 2
+            across = max(1, math.ceil(widthCm / self.outlineSpacingCm))
+            along = max(1, math.ceil(lengthCm / self.outlineSpacingCm))
+            for i in range(across):
+                x = -halfWidth + widthCm * i / across
+                points.append((x, halfLength))
+                points.append((-x, -halfLength))
+            for i in range(along):
+                y = halfLength - lengthCm * i / along
+                points.append((halfWidth, y))
+                points.append((-halfWidth, -y))
+            self.outlines[key] = points
+        return self.outlines[key]
+
+    # Returns whether a rover of the given size, at the given position and
+    # heading, is touching anything solid. This looks up the same number of
+    # points whatever is in the world.
+    def collides(self, x, y, headingDegrees, widthCm, lengthCm):
+        if self.occupancy is None:
+            return False
+        headingRadians = math.radians(headingDegrees)
+        sinHeading = math.sin(headingRadians)
+        cosHeading = math.cos(headingRadians)
+        # This is Raster.valueAt(), unrolled, as it's called for every point
+        # on every step.
+        raster = self.occupancy
+        (xMin, yMin) = (raster.xMin, raster.yMin)
+        scale = 1 / raster.cellSize
+        columns = raster.columns
+        rows = raster.rows
+        cells = raster.cells
+        for (px, py) in self.outline(widthCm, lengthCm):
+            # Rotate clockwise by the heading, as the rover itself is.
+            column = math.floor((x + px * cosHeading + py * sinHeading - xMin) * scale)
+            row = math.floor((y - px * sinHeading + py * cosHeading - yMin) * scale)
+            if 0 <= column < columns and 0 <= row < rows:
+                if cells[row * columns + column]:
+                    return True
+            elif raster.outsideValue:
+                return True
+        return False
+
+    def cellAt(self, x, y):
+        return (math.floor(x / self.cellSizeCm), math.floor(y / self.cellSizeCm))
+
+    # Yields each grid cell that a line from (x, y) in the direction (dx, dy)
+    # (which must be of length 1) passes through, in order, until it has gone
+    # maxDistance, along with how far along the line it leaves the cell.
+    # This is the usual way of walking a grid (Amanatides and Woo): work out
+    # how far it is to the next column and the next row, and step to
+    # whichever is nearer.
+    def cellsAlong(self, x, y, dx, dy, maxDistance):
+        size = self.cellSizeCm
+        (column, row) = self.cellAt(x, y)
+        if dx > 0:
+            stepColumn = 1
+            nextColumnDistance = ((column + 1) * size - x) / dx
+            columnDistance = size / dx
+        elif dx < 0:
+            stepColumn = -1
+            nextColumnDistance = (column * size - x) / dx
+            columnDistance = -size / dx
+        else:
+            stepColumn = 0
+            nextColumnDistance = columnDistance = math.inf
+        if dy > 0:
+            stepRow = 1
+            nextRowDistance = ((row + 1) * size - y) / dy
+            rowDistance = size / dy
+        elif dy < 0:
+            stepRow = -1
+            nextRowDistance = (row * size - y) / dy
+            rowDistance = -size / dy
+        else:
+            stepRow = 0
+            nextRowDistance = rowDistance = math.inf
+
+        while True:
+            exitDistance = min(nextColumnDistance, nextRowDistance)
+            yield ((column, row), exitDistance)
+            if exitDistance >= maxDistance:
+                return
+            if nextColumnDistance < nextRowDistance:
+                column += stepColumn
+                nextColumnDistance += columnDistance
+            else:
+                row += stepRow
+                nextRowDistance += rowDistance
+
+    # Returns how far a ray from (x, y), heading in the direction given (in
+    # degrees clockwise from the Y axis, as with the rover's heading), goes
+    # before hitting a wall, or None if it doesn't hit one within
+    # maxDistance.
+    def castRay(self, x, y, headingDegrees, maxDistance):
+        headingRadians = math.radians(headingDegrees)
+        dx = math.sin(headingRadians)
+        dy = math.cos(headingRadians)
+        nearest = None
+        checked = set()
+        for (cell, exitDistance) in self.cellsAlong(x, y, dx, dy, maxDistance):
+            for index in self.grid.get(cell, ()):
+                if index in checked:
+                    continue
+                checked.add(index)
+                distance = self.rayHitsWall(x, y, dx, dy, self.segments[index])
+                if distance is not None and (nearest is None or distance < nearest):
+                    nearest = distance
+            # Anything in cells further along is further away than this.
+            if nearest is not None and nearest <= exitDistance:
+                break
+        if nearest is not None and nearest <= maxDistance:
+            return nearest
+        return None
+
+    # Returns how far along the ray from (x, y) in the direction (dx, dy) it
+    # meets the wall (or any other segment), or None if it doesn't.
+    @staticmethod
+    def rayHitsWall(x, y, dx, dy, wall):
+        (x1, y1, x2, y2) = wall
+        wallDx = x2 - x1
+        wallDy = y2 - y1
+        denominator = dx * wallDy - dy * wallDx
+        if denominator == 0:
+            # Parallel (a ray running along a wall doesn't count as hitting it)
+            return None
+        offsetX = x1 - x
+        offsetY = y1 - y
+        distance = (offsetX * wallDy - offsetY * wallDx) / denominator
+        alongWall = (offsetX * dy - offsetY * dx) / denominator
+        if distance < 0 or alongWall < 0 or alongWall > 1:
+            return None
+        return distance
+
+# A bitmap covering part of the world, with a byte for each cellSize square.
+# Anywhere outside it has the value outsideValue.
+class Raster:
+    def __init__(self, extent, cellSize, outsideValue=0):
+        (self.xMin, self.yMin, xMax, yMax) = extent
+        self.cellSize = cellSize
+        self.columns = max(1, math.ceil((xMax - self.xMin) / cellSize))
+        self.rows = max(1, math.ceil((yMax - self.yMin) / cellSize))
+        self.outsideValue = outsideValue
+        self.cells = bytearray(self.columns * self.rows)
+
+    def valueAt(self, x, y):
+        column = math.floor((x - self.xMin) / self.cellSize)
+        row = math.floor((y - self.yMin) / self.cellSize)
+        if column < 0 or row < 0 or column >= self.columns or row >= self.rows:
+            return self.outsideValue
+        return self.cells[row * self.columns + column]
+
+    # Returns the column and row of the cell whose centre is the first at or
+    # after (x, y), clamped to the raster.
+    def cellFrom(self, x, y):
+        column = math.ceil((x - self.xMin) / self.cellSize - 0.5)
+        row = math.ceil((y - self.yMin) / self.cellSize - 0.5)
+        return (min(max(column, 0), self.columns), min(max(row, 0), self.rows))
+
+    # Sets every cell whose centre is inside the rectangle.
+    def fillRectangle(self, rectangle, value=1):
+        (xMin, yMin, xMax, yMax) = rectangle
+        (firstColumn, firstRow) = self.cellFrom(xMin, yMin)
+        (lastColumn, lastRow) = self.cellFrom(xMax, yMax)
+        for row in range(firstRow, lastRow):
+            start = row * self.columns
+            self.cells[start + firstColumn:start + lastColumn] = bytes([value]) * (lastColumn - firstColumn)
+
+    # Sets every cell whose centre is within halfWidth of the line.
+    def drawLine(self, line, halfWidth, value=1):
+        (x1, y1, x2, y2) = line
+        (firstColumn, firstRow) = self.cellFrom(min(x1, x2) - halfWidth, min(y1, y2) - halfWidth)
+        (lastColumn, lastRow) = self.cellFrom(max(x1, x2) + halfWidth, max(y1, y2) + halfWidth)
+        for row in range(firstRow, lastRow):
+            y = self.yMin + (row + 0.5) * self.cellSize
+            start = row * self.columns
+            for column in range(firstColumn, lastColumn):
+                x = self.xMin + (column + 0.5) * self.cellSize
+                if distanceToSegment(x, y, x1, y1, x2, y2) <= halfWidth:
+                    self.cells[start + column] = value
+
+def readFourNumbers(value, description):
+    if not isinstance(value, (list, tuple)) or len(value) != 4:
+        raise ValueError(description)
+    return [float(number) for number in value]
+
+# Splits a line going from point to point, (x1, y1, x2, y2, x3, y3, ...),
+# into straight lines (x1, y1, x2, y2), (x2, y2, x3, y3) and so on.
+def lineSegmentsOf(line):
+    return [tuple(line[i:i + 4]) for i in range(0, len(line) - 2, 2)]
+
+# Returns the distance from (x, y) to the nearest point on the line from
+# (x1, y1) to (x2, y2).
+def distanceToSegment(x, y, x1, y1, x2, y2):
+    dx = x2 - x1
+    dy = y2 - y1
+    lengthSquared = dx * dx + dy * dy
+    if lengthSquared == 0:
+        return math.hypot(x - x1, y - y1)
+    along = min(max(((x - x1) * dx + (y - y1) * dy) / lengthSquared, 0), 1)
+    return math.hypot(x - (x1 + along * dx), y - (y1 + along * dy))
+
+# Loads a world file.
+def load(path):
+    with open(path) as f:
+        return World.fromData(json.load(f))
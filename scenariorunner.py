@@ -0,0 +1,213 @@
+# Scenario runner
+#
+# Runs a set of programs written against roversimulator (such as square.py
+# and very-simple-example.py) many times over, each in its own process with
+# its own headless in-process simulator running as fast as possible, on as
+# many CPU cores as there are. Because none of them needs the simulator UI,
+# any number can run at once. Each program can be run with every combination
+# of a grid of settings, and where each run left the rover ends up in one
+# table:
+#
+#   python scenariorunner.py square.py very-simple-example.py --integrator stepped exact --world example-world.json
+#   python scenariorunner.py scenarios --set SPEED=50,100 --set SIDE_CM=50,100 --csv results.csv
+#
+# Given a directory, this runs every .py file in it that imports
+# roversimulator, so a directory of scenarios shouldn't have anything else
+# in it that does (such as interactive programs like driveRover.py). The
+# grid is made of:
+#
+#   --integrator    roverengine integrators (ROVERSIM_INTEGRATOR)
+#   --world         world files (ROVERSIM_WORLD, see roverworld.py)
+#   --set NAME=A,B  any environment variable, for programs that read their
+#                   own settings with os.environ
+#
+# and every program is run once for each combination. The table has the
+# rover's final x, y and heading, how far it travelled (the distance along
+# its path, not from the start), how many times it ran into something, the
+# simulated time at the end and how long the run took. --json and --csv write
+# the table to a file as well.
+#
+# Each run gets ROVERSIM_BACKEND=inprocess, ROVERSIM_TIMEWARP (max, unless
+# --timewarp says otherwise) and ROVERSIM_RESULT, which makes roversimulator
+# write the rover's final state to a file when the program ends (see
+# roversimulator.writeResult()).
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import roverengine
+
+# The columns of the table: name, width, and how to print the values (None
+# for text, which is left-aligned).
+columns = [
+    ('script', 26, None),
+    ('parameters', 30, None),
+    ('status', 8, None),
+    ('x', 9, "%.2f"),
+    ('y', 9, "%.2f"),
+    ('heading', 9, "%.2f"),
+    ('pathCm', 9, "%.2f"),
+    ('collisions', 10, "%d"),
+    ('simSeconds', 10, "%.2f"),
+    ('wallSeconds', 11, "%.3f"),
+]
+
+# Finds the programs to run: every .py file in a directory that imports
+# roversimulator, and any files named directly.
+def findScripts(paths):
+    scripts = []
+    for path in paths:
+        if not os.path.isdir(path):
+            scripts.append(path)
+            continue
+        for name in sorted(os.listdir(path)):
+            script = os.path.join(path, name)
+            if (name.endswith(".py") and os.path.isfile(script) and importsRoverSimulator(script)
+                    and os.path.abspath(script) != os.path.abspath(__file__)):
+                scripts.append(script)
+    return scripts
+
+def importsRoverSimulator(script):
+    with open(script, encoding="utf-8", errors="replace") as f:
+        source = f.read()
+    return "import roversimulator" in source
+
+# Turns the grid into a list of settings, one for each combination, each a
+# dictionary of environment variables.
+def makeGrid(args):
+    dimensions = []
+    if args.integrator:
+        dimensions.append([('ROVERSIM_INTEGRATOR', i) for i in args.integrator])
+    if args.world:
+        dimensions.append([('ROVERSIM_WORLD', os.path.abspath(w)) for w in args.world])
+    for setting in args.set or []:
+        (name, separator, values) = setting.partition("=")
+        if not separator or not name:
+            raise SystemExit("--set needs NAME=VALUE[,VALUE...], not " + setting)
+        dimensions.append([(name, value) for value in values.split(",")])
+    return [dict(combination) for combination in itertools.product(*dimensions)]
+
+# Describes a set of settings briefly, for the table.
+def describe(settings):
+    names = { 'ROVERSIM_INTEGRATOR': "integrator", 'ROVERSIM_WORLD': "world" }
+    parts = []
+    for (name, value) in settings.items():
+        if name == 'ROVERSIM_WORLD':
+            value = os.path.basename(value)
+        parts.append(names.get(name, name) + "=" + value)
+    return " ".join(parts)
+
+# Runs one program with one set of settings, and returns its row of the
+# table. The program runs in the directory it's in, so that it can find
+# anything it imports from there, as it would if run by hand.
+def runScenario(script, settings, args, resultPath):
+    env = dict(os.environ)
+    env.update(settings)
+    env['ROVERSIM_BACKEND'] = "inprocess"
+    env['ROVERSIM_TIMEWARP'] = args.timewarp
+    env['ROVERSIM_RESULT'] = resultPath
+    env.pop('ROVERSIM_CAPTURE', None)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+    script = os.path.abspath(script)
+
+    row = { 'script': os.path.basename(script), 'parameters': describe(settings) }
+    start = time.perf_counter()
+    try:
+        process = subprocess.run([sys.executable, script], env=env, cwd=os.path.dirname(script),
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                 timeout=args.timeout)
+        row['status'] = "ok" if process.returncode == 0 else "failed"
+        error = process.stderr.decode("utf-8", "replace").strip()
+    except subprocess.TimeoutExpired:
+        row['status'] = "timeout"
+        error = "took longer than %g seconds" % args.timeout
+    row['wallSeconds'] = time.perf_counter() - start
+
+    if os.path.exists(resultPath):
+        with open(resultPath) as f:
+            result = json.load(f)
+        row.update({
+            'x': result['vehicleXcm'],
+            'y': result['vehicleYcm'],
+            'heading': result['vehicleHeadingDegrees'],
+            'pathCm': result['distanceTravelledCm'],
+            'collisions': result['collisionCount'],
+            'simSeconds': result['time'],
+        })
+    elif row['status'] == "ok":
+        # It never sent the simulator anything.
+        row['status'] = "noresult"
+    if row['status'] != "ok" and error:
+        row['error'] = error.splitlines()[-1]
+    return row
+
+def runAll(scripts, grid, args):
+    runs = [(script, settings) for script in scripts for settings in grid]
+    with tempfile.TemporaryDirectory(prefix="scenarios") as resultDirectory:
+        # Each run is a separate process, so the threads only wait for them.
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [pool.submit(runScenario, script, settings, args, os.path.join(resultDirectory, "%d.json" % i))
+                       for (i, (script, settings)) in enumerate(runs)]
+            return [future.result() for future in futures]
+
+def printTable(rows):
+    print(" ".join(cell(name, width, None) for (name, width, fmt) in columns))
+    for row in rows:
+        print(" ".join(cell(row.get(name, "-"), width, fmt if name in row else None) for (name, width, fmt) in columns))
+        if 'error' in row:
+            print("    " + row['error'])
+
+def cell(value, width, fmt):
+    if fmt is None:
+        return str(value).ljust(width)
+    return (fmt % value).rjust(width)
+
+def writeCsv(path, rows):
+    names = [name for (name, width, fmt) in columns] + ['error']
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=names)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run roversimulator programs in parallel on headless simulators")
+    parser.add_argument("paths", nargs="+", help="programs to run, or directories of them")
+    parser.add_argument("--integrator", nargs="+", choices=roverengine.integrators)
+    parser.add_argument("--world", nargs="+", help="world files to run each program in")
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE[,VALUE...]",
+                        help="run with each of these values of an environment variable (can be given more than once)")
+    parser.add_argument("--timewarp", default="max", help="ROVERSIM_TIMEWARP for each run")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="how many to run at once")
+    parser.add_argument("--timeout", type=float, default=300, help="real seconds to allow each run")
+    parser.add_argument("--json", help="file to write the table to")
+    parser.add_argument("--csv", help="file to write the table to, as CSV")
+    args = parser.parse_args()
+
+    scripts = findScripts(args.paths)
+    if not scripts:
+        raise SystemExit("No programs using roversimulator found")
+    grid = makeGrid(args)
+
+    start = time.perf_counter()
+    rows = runAll(scripts, grid, args)
+    elapsed = time.perf_counter() - start
+
+    printTable(rows)
+    print("%d runs in %.2f s on up to %d at once" % (len(rows), elapsed, args.jobs))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    if args.csv:
+        writeCsv(args.csv, rows)
+    return 0 if all(row['status'] == "ok" for row in rows) else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,113 @@
+# Simulation Clock
+#
+# Programs that drive the rover usually work out how far to go by starting the
+# motors, sleeping for a while, and then stopping. In real time that means a
+# lap of square.py takes nearly a minute. A SimClock lets the simulator and the
+# programs driving it agree on a different idea of time:
+#
+#   SimClock()              runs at real time
+#   SimClock(10)            runs 10 times faster than real time
+#   SimClock(math.inf)      runs as fast as possible: sleep() returns
+#                           immediately, having just moved the clock forward
+#
+# Simulated time starts at 0. When running as fast as possible, time only ever
+# moves when something calls sleep(), so the same sequence of calls always
+# produces exactly the same times, and so the same simulation results.
+#
+# The ROVERSIM_TIMEWARP environment variable can be used to pick the time warp
+# without changing any code, e.g. ROVERSIM_TIMEWARP=10, or ROVERSIM_TIMEWARP=max
+# for as fast as possible. See fromEnvironment().
+
+import os
+import math
+import time
+import asyncio
+
+# The real clock functions, captured before anything gets a chance to
+# install() a simulated clock over the top of them.
+realTime = time.time
+realMonotonic = time.monotonic
+realSleep = time.sleep
+
+asFastAsPossible = math.inf
+
+class SimClock:
+    def __init__(self, timeWarp=1.0):
+        self.simTimeAtBase = 0.0
+        self.realTimeAtBase = realMonotonic()
+        self.timeWarp = timeWarp
+        self.setTimeWarp(timeWarp)
+        # Called with no arguments before each sleep when running as fast as
+        # possible, for anything that has to catch up before time jumps on
+        # (e.g. roversimulator's send queue, which would otherwise have no
+        # time at all to send anything).
+        self.beforeSleep = None
+
+    def isAsFastAsPossible(self):
+        return self.timeWarp == asFastAsPossible
+
+    # Changes the rate at which time passes. Time so far is unaffected, so the
+    # clock carries on from wherever it has got to.
+    def setTimeWarp(self, timeWarp):
+        if not timeWarp > 0:
+            raise ValueError("timeWarp must be greater than 0")
+        self.simTimeAtBase = self.time()
+        self.realTimeAtBase = realMonotonic()
+        self.timeWarp = timeWarp
+
+    # Returns the current simulated time in seconds.
+    def time(self):
+        if self.isAsFastAsPossible():
+            return self.simTimeAtBase
+        return self.simTimeAtBase + (realMonotonic() - self.realTimeAtBase) * self.timeWarp
+
+    # Waits for the specified number of simulated seconds to pass.
+    def sleep(self, seconds):
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        if self.isAsFastAsPossible():
+            if self.beforeSleep is not None:
+                self.beforeSleep()
+            self.simTimeAtBase += seconds
+        else:
+            realSleep(seconds / self.timeWarp)
+
+    # Like sleep(), but for asyncio code, so other tasks carry on running
+    # while this one waits.
+    async def sleepAsync(self, seconds):
+        if seconds < 0:
+            raise ValueError("sleep length must be non-negative")
+        if self.isAsFastAsPossible():
+            if self.beforeSleep is not None:
+                self.beforeSleep()
+            self.simTimeAtBase += seconds
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(seconds / self.timeWarp)
+
+    # Replaces time.time and time.sleep with this clock's, so that existing
+    # programs that just call time.sleep() run on simulated time without
+    # modification.
+    def install(self):
+        time.time = self.time
+        time.sleep = self.sleep
+
+# Puts the real time.time and time.sleep back.
+def uninstall():
+    time.time = realTime
+    time.sleep = realSleep
+
+# Parses a time warp, which is either a number, or "max" for as fast as
+# possible.
+def parseTimeWarp(text):
+    if text.strip().lower() in ("max", "inf"):
+        return asFastAsPossible
+    return float(text)
+
+# Creates a clock with the time warp given by the ROVERSIM_TIMEWARP environment
+# variable, if set, and real time otherwise.
+def fromEnvironment():
+    timeWarpText = os.environ.get("ROVERSIM_TIMEWARP")
+    if timeWarpText:
+        return SimClock(parseTimeWarp(timeWarpText))
+    return SimClock()
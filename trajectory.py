@@ -0,0 +1,159 @@
+# Trajectory recording
+#
+# Records the state of a roverengine.Rover after every step into a compact
+# binary file, for long runs where printing text (as showSteeringCalcs does)
+# would be far too slow and far too big. Every record is the same size, so the
+# file can be mapped straight into memory as NumPy arrays, however big it is,
+# without reading it all in or parsing anything:
+#
+#   import roverengine, trajectory
+#   rover = roverengine.Rover()
+#   rover.recorder = trajectory.TrajectoryRecorder("soak.trj")
+#   ...
+#   rover.recorder.close()
+#
+#   t = trajectory.load("soak.trj")
+#   print(t['time'][-1], t['vehicleXcm'].max(), t['servos'][:, roverengine.servo_FL])
+#
+# Recording only needs the standard library; load() needs NumPy. The simulator
+# UI records with --record, and this can be run to summarise a recording:
+#
+#   python trajectory.py soak.trj
+#
+# The file starts with a 16 byte header (see headerFormat) followed by the
+# records, each laid out as recordFormat, little-endian. A record that was
+# only partly written (say because the program was killed) is ignored, and
+# is dropped if more records are appended later.
+
+import argparse
+import os
+import struct
+
+from roverengine import numServos
+
+magic = b"ROVERTRJ"
+version = 1
+headerFormat = struct.Struct("<8sII")   # magic, version, record size
+
+# Time, x, y and heading as doubles, since these accumulate over hours of
+# simulated time. Motor speeds and servo angles are only ever set to whole
+# numbers by the programs driving the rover, so floats are plenty.
+recordFormat = struct.Struct("<dddd" + "ff" + str(numServos) + "f")
+recordFields = [
+    ('time', '<f8'),
+    ('vehicleXcm', '<f8'),
+    ('vehicleYcm', '<f8'),
+    ('vehicleHeadingDegrees', '<f8'),
+    ('speedL', '<f4'),
+    ('speedR', '<f4'),
+    ('servos', '<f4', (numServos,)),
+]
+
+class TrajectoryRecorder:
+    # Records are collected in memory and written this many at a time.
+    bufferRecords = 4096
+
+    # Appends to the file if it already exists (and is a recording), so a
+    # run can be recorded in several parts.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(headerFormat.pack(magic, version, recordFormat.size))
+            self.file.flush()
+        else:
+            checkHeader(path)
+            # Drop any record that was only partly written last time, so that
+            # the new ones line up.
+            count = (self.file.tell() - headerFormat.size) // recordFormat.size
+            self.file.truncate(headerFormat.size + count * recordFormat.size)
+            self.file.seek(0, os.SEEK_END)
+        self.buffer = bytearray()
+        self.bufferedCount = 0
+        self.recordCount = 0
+
+    # Records the rover's current state. This is what Rover calls after each
+    # step when it has a recorder.
+    def record(self, rover):
+        self.buffer += recordFormat.pack(rover.timeOfLastUpdate, rover.vehicleXcm, rover.vehicleYcm,
+                                         rover.vehicleHeadingDegrees, rover.speedL, rover.speedR, *rover.servos)
+        self.bufferedCount += 1
+        self.recordCount += 1
+        if self.bufferedCount >= self.bufferRecords:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+            self.bufferedCount = 0
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+# Raises ValueError unless the file starts with a header this module can read.
+def checkHeader(path):
+    with open(path, "rb") as f:
+        header = f.read(headerFormat.size)
+    if len(header) < headerFormat.size:
+        raise ValueError(path + " is not a trajectory recording")
+    (fileMagic, fileVersion, recordSize) = headerFormat.unpack(header)
+    if fileMagic != magic:
+        raise ValueError(path + " is not a trajectory recording")
+    if fileVersion != version or recordSize != recordFormat.size:
+        raise ValueError(path + " is a trajectory recording in an unsupported format (version " + str(fileVersion) + ")")
+
+# Returns the NumPy dtype of one record.
+def recordDtype():
+    import numpy as np
+    dtype = np.dtype(recordFields)
+    assert dtype.itemsize == recordFormat.size
+    return dtype
+
+# Maps a recording into memory (read only), and returns it as a NumPy
+# structured array with a field for each of the recordFields, e.g.
+# load(path)['vehicleXcm']. Nothing is read from the file until it's used.
+def load(path):
+    import numpy as np
+    checkHeader(path)
+    dtype = recordDtype()
+    count = (os.path.getsize(path) - headerFormat.size) // dtype.itemsize
+    if count == 0:
+        # np.memmap can't map nothing
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=headerFormat.size, shape=(count,))
+
+# Returns some headline numbers about a recording.
+def summarise(trajectory):
+    import numpy as np
+    if len(trajectory) == 0:
+        return { 'records': 0 }
+    x = trajectory['vehicleXcm']
+    y = trajectory['vehicleYcm']
+    return {
+        'records': len(trajectory),
+        'startTime': float(trajectory['time'][0]),
+        'endTime': float(trajectory['time'][-1]),
+        'pathLengthCm': float(np.hypot(np.diff(x), np.diff(y)).sum()),
+        'finalPose': [float(x[-1]), float(y[-1]), float(trajectory['vehicleHeadingDegrees'][-1])],
+        'xRangeCm': [float(x.min()), float(x.max())],
+        'yRangeCm': [float(y.min()), float(y.max())],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a trajectory recording")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    for (name, value) in summarise(load(args.path)).items():
+        print("%-14s %s" % (name, value))
+
+if __name__ == "__main__":
+    main()